@@ -56,6 +56,9 @@ class Config:
         effect of slowing down transactions.
     PSYCOPG2_PGEVENTS_DEBUG: bool, optional
         Whether or not to print debug logs for psycopg2-pgevents package.
+    PGEVENTS_BATCH_SESSION: bool
+        Whether or not event listeners share one application context and
+        session per poll cycle.
     """
 
     SECRET_KEY: str = environ.get("SECRET_KEY", b64encode(urandom(48)).decode("utf-8"))
@@ -64,6 +67,7 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
 
     PSYCOPG2_PGEVENTS_DEBUG: bool = environ.get("PSYCOPG2_PGEVENTS_DEBUG", False)
+    PGEVENTS_BATCH_SESSION: bool = True
 
 
 # Create app
@@ -243,9 +247,9 @@ def useraccount_event_listener(event_id: UUID, row_id: str, identifier: str) ->
     None
 
     """
-    with APP.app_context():
-        acct = UserAccount.query.filter_by(id=row_id).first()
-        print("New user account created!!! {}".format(acct))
+    # PGEVENTS_BATCH_SESSION already provides an application context
+    acct = UserAccount.query.filter_by(id=row_id).first()
+    print("New user account created!!! {}".format(acct))
 
 
 #
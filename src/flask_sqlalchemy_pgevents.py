@@ -1,252 +1,6826 @@
 """This module manages the flask-sqlalchemy-pgevents extension. """
 
 import atexit
-from collections import defaultdict
-from typing import Callable, Optional, Set
+import concurrent.futures
+import contextlib
+import fnmatch
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import select
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import date, datetime, time as datetime_time
+from decimal import Decimal
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, Union
+from uuid import UUID, uuid4
 
 import attr
+import click
+import psycopg2
 import psycopg2_pgevents as pgevts
-from flask import Flask
+from flask import Flask, current_app, has_request_context
+from flask.cli import AppGroup
 from flask_sqlalchemy.model import Model
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
 from psycopg2.extensions import connection as Psycopg2Connection
+from psycopg2.extras import LogicalReplicationConnection
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy import func
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy import select as sqlalchemy_select
+from sqlalchemy import ARRAY, JSON, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine.base import Connection as SQLAlchemyConnection
+from sqlalchemy.orm import Session
 
 IDENTIFIERS = {"insert", "update", "delete"}
+MODES = {"trigger", "orm"}
+GROUPS = {"transaction"}
+
+DEFAULT_EVENT_SOURCE = "notify"
+DEFAULT_REPLICATION_SLOT = "flask_sqlalchemy_pgevents"
+DEFAULT_PUBLICATION = "flask_sqlalchemy_pgevents"
+DEFAULT_POLL_BATCH_SIZE = 100
+DEFAULT_POLL_MIN_INTERVAL = 0.01
+DEFAULT_POLL_MAX_INTERVAL = 1.0
+DEFAULT_POLL_CONSUMER = "default"
+# Number of allocated event IDs a polling source waits on to be committed, beyond
+# which the latest ones are merged
+POLL_MAX_CHECKPOINTS = 100
+DEFAULT_ACK_BATCH_SIZE = 100
+DEFAULT_ACK_INTERVAL = 1.0
+DEFAULT_RETRY_BACKOFF = 0.1
+DEFAULT_RETRY_MAX_BACKOFF = 60.0
+DEFAULT_PRIORITY = 1
+DEFAULT_LANE_CAPACITY = 1000
+DEFAULT_CACHE_MAXSIZE = 128
+DEFAULT_SYNC_CHUNK_SIZE = 1000
+DEFAULT_REBALANCE_INTERVAL = 5.0
+DEFAULT_REPLAY_CHUNK_SIZE = 10000
+# Number of ID ranges per replay worker, so that workers finishing early take more
+REPLAY_RANGES_PER_WORKER = 4
+DEFAULT_MULTIPLEXER_SOCKET = "/tmp/flask_sqlalchemy_pgevents.sock"
+DEFAULT_MULTIPLEXER_BUFFER_SIZE = 16 * 1024 * 1024
+DEFAULT_MULTIPLEXER_GRACE_PERIOD = 60.0
+DEFAULT_GEVENT_POOL_SIZE = 10
+DEFAULT_BULKHEAD_QUEUE_SIZE = 100
+DEFAULT_BULKHEAD_TIMEOUT = 30.0
+# Seconds between the watchdog's checks of callbacks that have not yet started
+BULKHEAD_WATCHDOG_INTERVAL = 0.05
+DEFAULT_TARGET_LAG_MS = 1000
+ADAPTIVE_MIN_FETCH_SIZE = 10
+# Weight of the latest observation in the adaptive controller's moving averages
+ADAPTIVE_SMOOTHING = 0.2
+
+# Seconds that iter_events blocks in each poll, when it has no timeout
+ITER_EVENTS_POLL_TIMEOUT = 1.0
+
+# Projects a row's columns, according to a trigger's capture argument: '' for
+# no columns, '*' for the whole row, or a comma-separated list of columns.
+INSTALL_CAPTURE_FUNCTION_STATEMENT = """
+CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_capture(row_ jsonb, columns_ text)
+RETURNS jsonb AS $function$
+  SELECT CASE
+    WHEN row_ IS NULL OR columns_ = '' THEN NULL
+    WHEN columns_ = '*' THEN row_
+    ELSE (
+      SELECT coalesce(jsonb_object_agg(key, value), '{}'::jsonb)
+      FROM jsonb_each(row_)
+      WHERE key = ANY(string_to_array(columns_, ','))
+    )
+  END;
+$function$
+LANGUAGE sql IMMUTABLE;
+"""
+
+# Hashes a row's partition key column into one of a table's partitions, or
+# returns NULL if the table is not partitioned (no column is given).
+INSTALL_PARTITION_FUNCTION_STATEMENT = """
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_partition(row_ jsonb, column_ text, partitions_ text)
+RETURNS int AS $function$
+  SELECT CASE
+    WHEN coalesce(column_, '') = '' THEN NULL
+    ELSE mod(coalesce(hashtext(row_ ->> column_), 0)::bigint + 2147483648, partitions_::bigint)::int
+  END;
+$function$
+LANGUAGE sql IMMUTABLE;
+"""
+
+INSTALL_NOTIFY_FUNCTION_STATEMENT = """
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_notify_event()
+RETURNS TRIGGER AS $function$
+  DECLARE
+    new_row jsonb;
+    old_row jsonb;
+    partition_ int;
+    payload jsonb;
+  BEGIN
+    IF (TG_OP <> 'INSERT') THEN
+      old_row = to_jsonb(OLD);
+    END IF;
+    IF (TG_OP <> 'DELETE') THEN
+      new_row = to_jsonb(NEW);
+    END IF;
+    partition_ = public.flask_sqlalchemy_pgevents_partition(coalesce(new_row, old_row), TG_ARGV[1], TG_ARGV[2]);
+    payload = jsonb_build_object(
+      'event_id', uuid_generate_v4(),
+      'event_type', TG_OP,
+      'schema_name', TG_TABLE_SCHEMA,
+      'table_name', TG_TABLE_NAME,
+      'row_id', coalesce(new_row, old_row) -> 'id',
+      'data', CASE WHEN coalesce(TG_ARGV[0], '') <> '' THEN jsonb_build_object(
+        'new', public.flask_sqlalchemy_pgevents_capture(new_row, TG_ARGV[0]),
+        'old', public.flask_sqlalchemy_pgevents_capture(old_row, TG_ARGV[0])
+      ) END,
+      'txid', txid_current(),
+      'trace_id', nullif(current_setting('pgevents.trace_id', true), ''),
+      'partition', partition_
+    );
+    -- NOTIFY payloads must be shorter than 8000 bytes, and a larger one would
+    -- fail the writer's transaction: drop the captured data instead
+    IF octet_length(payload::text) >= 8000 THEN
+      payload = payload || '{"data": {"new": null, "old": null, "truncated": true}}'::jsonb;
+    END IF;
+    PERFORM pg_notify(
+      CASE
+        WHEN partition_ IS NULL THEN 'psycopg2_pgevents_channel'
+        ELSE format('psycopg2_pgevents_channel_%s_%s', TG_RELID, partition_)
+      END,
+      payload::text
+    );
+    RETURN NULL;
+  END;
+$function$
+LANGUAGE plpgsql;
+"""
+
+INSTALL_NOTIFY_TRIGGER_STATEMENT = """
+DROP TRIGGER IF EXISTS psycopg2_pgevents_trigger ON "{schema}"."{table}";
+
+CREATE TRIGGER psycopg2_pgevents_trigger
+AFTER INSERT OR UPDATE OR DELETE ON "{schema}"."{table}"
+FOR EACH ROW
+EXECUTE PROCEDURE public.flask_sqlalchemy_pgevents_notify_event('{capture}', '{partition_by}', '{partitions}');
+"""
+
+UNINSTALL_TRIGGER_STATEMENT = """
+DROP TRIGGER IF EXISTS psycopg2_pgevents_trigger ON "{schema}"."{table}";
+"""
+
+# Patterns of the tables to install when created, with each event source's
+# installation statement, whose "{schema}" and "{table}" placeholders are
+# replaced by the new table's names. The event trigger is a no-op once the
+# patterns table is dropped.
+INSTALL_PATTERNS_STATEMENT = """
+CREATE TABLE IF NOT EXISTS public.flask_sqlalchemy_pgevents_pattern (
+  schema_pattern text NOT NULL,
+  table_pattern text NOT NULL,
+  event_source text NOT NULL,
+  statement text NOT NULL,
+  PRIMARY KEY (schema_pattern, table_pattern, event_source)
+);
+
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_install_new_tables()
+RETURNS event_trigger AS $$
+DECLARE
+  table_ record;
+  pattern_ record;
+BEGIN
+  IF to_regclass('public.flask_sqlalchemy_pgevents_pattern') IS NULL THEN
+    RETURN;
+  END IF;
+
+  FOR table_ IN
+    SELECT n.nspname AS schema_name, c.relname AS table_name
+    FROM pg_event_trigger_ddl_commands() d
+    JOIN pg_class c ON c.oid = d.objid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE d.classid = 'pg_class'::regclass AND c.relkind IN ('r', 'p')
+  LOOP
+    FOR pattern_ IN
+      SELECT statement FROM public.flask_sqlalchemy_pgevents_pattern
+      WHERE table_.schema_name LIKE schema_pattern AND table_.table_name LIKE table_pattern
+    LOOP
+      EXECUTE replace(replace(pattern_.statement, '{schema}', table_.schema_name), '{table}', table_.table_name);
+    END LOOP;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_event_trigger WHERE evtname = 'flask_sqlalchemy_pgevents_new_table') THEN
+    CREATE EVENT TRIGGER flask_sqlalchemy_pgevents_new_table ON ddl_command_end
+    WHEN TAG IN ('CREATE TABLE', 'CREATE TABLE AS', 'SELECT INTO')
+    EXECUTE PROCEDURE public.flask_sqlalchemy_pgevents_install_new_tables();
+  END IF;
+END;
+$$;
+"""
+
+UPSERT_PATTERN_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_pattern (schema_pattern, table_pattern, event_source, statement)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (schema_pattern, table_pattern, event_source) DO UPDATE SET statement = excluded.statement;
+"""
+
+DELETE_PATTERN_STATEMENT = """
+DELETE FROM public.flask_sqlalchemy_pgevents_pattern
+WHERE schema_pattern = %s AND table_pattern = %s AND event_source = %s;
+"""
+
+SELECT_PATTERN_TABLES_STATEMENT = """
+SELECT n.nspname, c.relname
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'p') AND n.nspname LIKE %s AND c.relname LIKE %s
+ORDER BY n.nspname, c.relname;
+"""
+
+# Tables with an event trigger, whichever event source or deploy installed it
+SELECT_TRIGGER_TABLES_STATEMENT = """
+SELECT n.nspname, c.relname
+FROM pg_trigger t
+JOIN pg_class c ON c.oid = t.tgrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE t.tgname = 'psycopg2_pgevents_trigger' AND NOT t.tgisinternal;
+"""
+
+INSTALL_EVENT_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS public.flask_sqlalchemy_pgevents_event (
+  id bigserial PRIMARY KEY,
+  event_id uuid NOT NULL DEFAULT uuid_generate_v4(),
+  event_type text NOT NULL,
+  schema_name text NOT NULL,
+  table_name text NOT NULL,
+  row_id text,
+  created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE public.flask_sqlalchemy_pgevents_event ADD COLUMN IF NOT EXISTS data jsonb;
+ALTER TABLE public.flask_sqlalchemy_pgevents_event ADD COLUMN IF NOT EXISTS txid bigint DEFAULT txid_current();
+ALTER TABLE public.flask_sqlalchemy_pgevents_event
+  ADD COLUMN IF NOT EXISTS trace_id text DEFAULT nullif(current_setting('pgevents.trace_id', true), '');
+ALTER TABLE public.flask_sqlalchemy_pgevents_event ADD COLUMN IF NOT EXISTS partition int;
+
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_store_event()
+RETURNS TRIGGER AS $function$
+  DECLARE
+    new_row jsonb;
+    old_row jsonb;
+    data jsonb;
+  BEGIN
+    IF (TG_OP <> 'INSERT') THEN
+      old_row = to_jsonb(OLD);
+    END IF;
+    IF (TG_OP <> 'DELETE') THEN
+      new_row = to_jsonb(NEW);
+    END IF;
+    IF (coalesce(TG_ARGV[0], '') <> '') THEN
+      data = jsonb_build_object(
+        'new', public.flask_sqlalchemy_pgevents_capture(new_row, TG_ARGV[0]),
+        'old', public.flask_sqlalchemy_pgevents_capture(old_row, TG_ARGV[0])
+      );
+    END IF;
+    INSERT INTO public.flask_sqlalchemy_pgevents_event (event_type, schema_name, table_name, row_id, data, partition)
+    VALUES (
+      TG_OP, TG_TABLE_SCHEMA, TG_TABLE_NAME, coalesce(new_row, old_row) ->> 'id', data,
+      public.flask_sqlalchemy_pgevents_partition(coalesce(new_row, old_row), TG_ARGV[1], TG_ARGV[2])
+    );
+    RETURN NULL;
+  END;
+$function$
+LANGUAGE plpgsql;
+"""
+
+INSTALL_EVENT_TABLE_TRIGGER_STATEMENT = """
+DROP TRIGGER IF EXISTS psycopg2_pgevents_trigger ON "{schema}"."{table}";
+
+CREATE TRIGGER psycopg2_pgevents_trigger
+AFTER INSERT OR UPDATE OR DELETE ON "{schema}"."{table}"
+FOR EACH ROW
+EXECUTE PROCEDURE public.flask_sqlalchemy_pgevents_store_event('{capture}', '{partition_by}', '{partitions}');
+"""
+
+INSERT_EVENT_TABLE_EVENTS_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_event (event_id, event_type, schema_name, table_name, row_id, data)
+SELECT * FROM unnest(
+  CAST(:event_ids AS uuid[]),
+  CAST(:event_types AS text[]),
+  CAST(:schema_names AS text[]),
+  CAST(:table_names AS text[]),
+  CAST(:row_ids AS text[]),
+  CAST(:data AS jsonb[])
+);
+"""
+
+# Like the notify trigger, drops the captured data of payloads too large for NOTIFY
+NOTIFY_EVENTS_STATEMENT = """
+SELECT pg_notify(
+  'psycopg2_pgevents_channel',
+  CASE
+    WHEN octet_length(payload::text) < 8000 THEN payload
+    ELSE payload || CAST('{"data": {"new": null, "old": null, "truncated": true}}' AS jsonb)
+  END::text
+)
+FROM (
+  SELECT
+    CAST(payload AS jsonb)
+    || jsonb_build_object('txid', txid_current(), 'trace_id', nullif(current_setting('pgevents.trace_id', true), ''))
+    AS payload
+  FROM unnest(CAST(:payloads AS text[])) AS payload
+) AS payloads;
+"""
+
+SELECT_EVENT_TABLE_HIGH_WATER_MARK_STATEMENT = """
+SELECT coalesce(max(id), 0) FROM {event_table};
+"""
+
+# Last event ID allocated, whether its transaction committed yet or not
+SELECT_EVENT_TABLE_LAST_ID_STATEMENT = """
+SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {event_table}_id_seq;
+"""
+
+SELECT_SNAPSHOT_BOUNDS_STATEMENT = """
+SELECT txid_snapshot_xmin(txid_current_snapshot()), txid_snapshot_xmax(txid_current_snapshot());
+"""
+
+SELECT_EVENT_TABLE_EVENTS_STATEMENT = """
+SELECT id, event_id::text, event_type, schema_name, table_name, row_id, data, txid, trace_id, partition
+FROM public.flask_sqlalchemy_pgevents_event
+WHERE id > %s AND id <= %s AND (partition IS NULL OR concat(schema_name, '.', table_name, ':', partition) = ANY(%s))
+ORDER BY id
+LIMIT %s;
+"""
+
+# Stored events in a range of positions, optionally of a single table
+SELECT_EVENT_TABLE_RANGE_STATEMENT = """
+SELECT id, event_id::text, event_type, schema_name, table_name, row_id, data, txid, trace_id, partition
+FROM public.flask_sqlalchemy_pgevents_event
+WHERE id > %s AND id <= %s AND (%s IS NULL OR (schema_name = %s AND table_name = %s))
+ORDER BY id;
+"""
+
+SELECT_EVENT_TABLE_POSITION_STATEMENT = """
+SELECT coalesce(max(id), 0) FROM public.flask_sqlalchemy_pgevents_event WHERE created_at < %s;
+"""
+
+# Events of a partition up to a position, read when a consumer is assigned the
+# partition, so that it handles the events its previous owner did not.
+SELECT_EVENT_TABLE_PARTITION_EVENTS_STATEMENT = """
+SELECT id, event_id::text, event_type, schema_name, table_name, row_id, data, txid, trace_id, partition
+FROM public.flask_sqlalchemy_pgevents_event
+WHERE schema_name = %s AND table_name = %s AND partition = %s AND id > %s AND id <= %s
+ORDER BY id;
+"""
+
+# The compact event table identifies tables by OID and event types by their
+# initial, instead of repeating the schema, table and event type names.
+INSTALL_COMPACT_EVENT_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS public.flask_sqlalchemy_pgevents_compact_event (
+  id bigserial PRIMARY KEY,
+  event_id uuid NOT NULL DEFAULT uuid_generate_v4(),
+  event_type "char" NOT NULL,
+  table_oid oid NOT NULL,
+  row_id text,
+  data jsonb
+);
+
+ALTER TABLE public.flask_sqlalchemy_pgevents_compact_event ADD COLUMN IF NOT EXISTS txid bigint DEFAULT txid_current();
+ALTER TABLE public.flask_sqlalchemy_pgevents_compact_event
+  ADD COLUMN IF NOT EXISTS trace_id text DEFAULT nullif(current_setting('pgevents.trace_id', true), '');
+ALTER TABLE public.flask_sqlalchemy_pgevents_compact_event ADD COLUMN IF NOT EXISTS partition int;
+
+CREATE OR REPLACE FUNCTION public.flask_sqlalchemy_pgevents_store_compact_event()
+RETURNS TRIGGER AS $function$
+  DECLARE
+    new_row jsonb;
+    old_row jsonb;
+    data jsonb;
+  BEGIN
+    IF (TG_OP <> 'INSERT') THEN
+      old_row = to_jsonb(OLD);
+    END IF;
+    IF (TG_OP <> 'DELETE') THEN
+      new_row = to_jsonb(NEW);
+    END IF;
+    IF (coalesce(TG_ARGV[0], '') <> '') THEN
+      data = jsonb_build_object(
+        'new', public.flask_sqlalchemy_pgevents_capture(new_row, TG_ARGV[0]),
+        'old', public.flask_sqlalchemy_pgevents_capture(old_row, TG_ARGV[0])
+      );
+    END IF;
+    INSERT INTO public.flask_sqlalchemy_pgevents_compact_event (event_type, table_oid, row_id, data, partition)
+    VALUES (
+      left(TG_OP, 1)::"char", TG_RELID, coalesce(new_row, old_row) ->> 'id', data,
+      public.flask_sqlalchemy_pgevents_partition(coalesce(new_row, old_row), TG_ARGV[1], TG_ARGV[2])
+    );
+    RETURN NULL;
+  END;
+$function$
+LANGUAGE plpgsql;
+"""
+
+INSTALL_COMPACT_EVENT_TABLE_TRIGGER_STATEMENT = """
+DROP TRIGGER IF EXISTS psycopg2_pgevents_trigger ON "{schema}"."{table}";
+
+CREATE TRIGGER psycopg2_pgevents_trigger
+AFTER INSERT OR UPDATE OR DELETE ON "{schema}"."{table}"
+FOR EACH ROW
+EXECUTE PROCEDURE public.flask_sqlalchemy_pgevents_store_compact_event(
+  '{capture}', '{partition_by}', '{partitions}'
+);
+"""
+
+INSERT_COMPACT_EVENT_TABLE_EVENTS_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_compact_event (event_id, event_type, table_oid, row_id, data)
+SELECT e.event_id, e.event_type, CAST(quote_ident(e.schema_name) || '.' || quote_ident(e.table_name) AS regclass),
+  e.row_id, e.data
+FROM unnest(
+  CAST(:event_ids AS uuid[]),
+  CAST(:event_types AS "char"[]),
+  CAST(:schema_names AS text[]),
+  CAST(:table_names AS text[]),
+  CAST(:row_ids AS text[]),
+  CAST(:data AS jsonb[])
+) AS e(event_id, event_type, schema_name, table_name, row_id, data);
+"""
+
+SELECT_COMPACT_EVENT_TABLE_EVENTS_STATEMENT = """
+SELECT id, event_id::text, event_type, table_oid::bigint, row_id, data, txid, trace_id, partition
+FROM public.flask_sqlalchemy_pgevents_compact_event
+WHERE id > %s AND id <= %s AND (partition IS NULL OR concat(table_oid, ':', partition) = ANY(%s))
+ORDER BY id
+LIMIT %s;
+"""
+
+SELECT_COMPACT_EVENT_TABLE_RANGE_STATEMENT = """
+SELECT
+  e.id, e.event_id::text, CASE e.event_type WHEN 'I' THEN 'INSERT' WHEN 'U' THEN 'UPDATE' ELSE 'DELETE' END,
+  coalesce(n.nspname, ''), coalesce(c.relname, e.table_oid::text), e.row_id, e.data, e.txid, e.trace_id, e.partition
+FROM public.flask_sqlalchemy_pgevents_compact_event e
+LEFT JOIN pg_class c ON c.oid = e.table_oid
+LEFT JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE e.id > %s AND e.id <= %s AND (%s IS NULL OR (n.nspname = %s AND c.relname = %s))
+ORDER BY e.id;
+"""
+
+SELECT_COMPACT_EVENT_TABLE_PARTITION_EVENTS_STATEMENT = """
+SELECT id, event_id::text, event_type, table_oid::bigint, row_id, data, txid, trace_id, partition
+FROM public.flask_sqlalchemy_pgevents_compact_event
+WHERE table_oid = %s AND partition = %s AND id > %s AND id <= %s
+ORDER BY id;
+"""
+
+SELECT_TABLE_OID_STATEMENT = """
+SELECT c.oid::bigint, n.nspname, c.relname
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s AND c.relname = %s;
+"""
+
+SELECT_TABLE_NAME_STATEMENT = """
+SELECT c.oid::bigint, n.nspname, c.relname
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.oid = %s;
+"""
+
+# Position of the last event acknowledged by each named consumer of an event table
+INSTALL_CONSUMER_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS public.flask_sqlalchemy_pgevents_consumer (
+  name text NOT NULL,
+  event_table regclass NOT NULL,
+  position bigint NOT NULL,
+  PRIMARY KEY (name, event_table)
+);
+"""
+
+SELECT_CONSUMER_POSITION_STATEMENT = """
+SELECT position FROM public.flask_sqlalchemy_pgevents_consumer WHERE name = %s AND event_table = %s::regclass;
+"""
+
+ACK_CONSUMER_POSITION_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_consumer AS consumer (name, event_table, position)
+VALUES (%s, %s::regclass, %s)
+ON CONFLICT (name, event_table) DO UPDATE SET position = greatest(consumer.position, EXCLUDED.position);
+"""
+
+ACK_CONSUMER_POSITIONS_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_consumer AS consumer (name, event_table, position)
+SELECT name, %s::regclass, %s FROM unnest(CAST(%s AS text[])) AS name
+ON CONFLICT (name, event_table) DO UPDATE SET position = greatest(consumer.position, EXCLUDED.position);
+"""
+
+INSTALL_DEAD_LETTER_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS public.flask_sqlalchemy_pgevents_dead_letter (
+  id bigserial PRIMARY KEY,
+  event jsonb NOT NULL,
+  callback text NOT NULL,
+  attempts integer NOT NULL,
+  error text,
+  created_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+INSERT_DEAD_LETTER_STATEMENT = """
+INSERT INTO public.flask_sqlalchemy_pgevents_dead_letter (event, callback, attempts, error)
+VALUES (CAST(:event AS jsonb), :callback, :attempts, :error);
+"""
+
+SELECT_DEAD_LETTERS_STATEMENT = """
+SELECT id, event::text, callback FROM public.flask_sqlalchemy_pgevents_dead_letter ORDER BY id LIMIT :limit;
+"""
+
+DELETE_DEAD_LETTERS_STATEMENT = """
+DELETE FROM public.flask_sqlalchemy_pgevents_dead_letter WHERE id = ANY(CAST(:ids AS bigint[]));
+"""
+
+UPDATE_DEAD_LETTER_STATEMENT = """
+UPDATE public.flask_sqlalchemy_pgevents_dead_letter SET attempts = attempts + 1, error = :error WHERE id = :id;
+"""
+
+# Consumers of a partitioned table hold a shared advisory lock on the table for
+# as long as they listen to it, and an exclusive advisory lock on each of its
+# partitions that they are assigned. Session locks are released when a
+# consumer's connection closes, so its partitions are then reassigned.
+JOIN_PARTITION_GROUP_STATEMENT = """
+SELECT pg_advisory_lock_shared(hashtext(%s), -1);
+"""
+
+LEAVE_PARTITION_GROUP_STATEMENT = """
+SELECT pg_advisory_unlock_shared(hashtext(%s), -1);
+"""
+
+COUNT_PARTITION_GROUP_MEMBERS_STATEMENT = """
+SELECT count(DISTINCT pid) FROM pg_locks
+WHERE locktype = 'advisory'
+  AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+  AND classid = CAST(hashtext(%s) AS oid) AND objid = CAST(-1 AS oid) AND objsubid = 2;
+"""
+
+LOCK_PARTITION_STATEMENT = """
+SELECT pg_try_advisory_lock(hashtext(%s), %s);
+"""
+
+UNLOCK_PARTITION_STATEMENT = """
+SELECT pg_advisory_unlock(hashtext(%s), %s);
+"""
+
+SELECT_SNAPSHOT_STATEMENT = """
+SELECT txid_current_snapshot()::text;
+"""
+
+SELECT_TXID_HORIZON_STATEMENT = """
+SELECT txid_snapshot_xmax(txid_current_snapshot());
+"""
+
+# Recorded in the events of the transaction, by the trigger functions
+SET_TRACE_ID_STATEMENT = """
+SELECT set_config('pgevents.trace_id', :trace_id, true);
+"""
+
+CREATE_PUBLICATION_STATEMENT = """
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_publication WHERE pubname = '{publication}') THEN
+    CREATE PUBLICATION "{publication}";
+  END IF;
+END;
+$$;
+"""
+
+ADD_PUBLICATION_TABLE_STATEMENT = """
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_publication_tables
+    WHERE pubname = '{publication}' AND schemaname = '{schema}' AND tablename = '{table}'
+  ) THEN
+    ALTER PUBLICATION "{publication}" ADD TABLE "{schema}"."{table}";
+  END IF;
+END;
+$$;
+"""
+
+# Makes updates and deletes carry the whole old row, instead of only its key
+SET_REPLICA_IDENTITY_FULL_STATEMENT = """
+ALTER TABLE "{schema}"."{table}" REPLICA IDENTITY FULL;
+"""
+
+SELECT_TYPE_ELEMENTS_STATEMENT = """
+SELECT oid, typelem FROM pg_type WHERE oid = ANY(%s) AND typcategory = 'A';
+"""
+
+DROP_PUBLICATION_TABLE_STATEMENT = """
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM pg_publication_tables
+    WHERE pubname = '{publication}' AND schemaname = '{schema}' AND tablename = '{table}'
+  ) THEN
+    ALTER PUBLICATION "{publication}" DROP TABLE "{schema}"."{table}";
+  END IF;
+END;
+$$;
+"""
+
+SELECT_PUBLICATION_TABLES_STATEMENT = """
+SELECT schemaname, tablename FROM pg_publication_tables WHERE pubname = %s;
+"""
+
+SELECT_REPLICATION_SLOT_STATEMENT = """
+SELECT 1 FROM pg_replication_slots WHERE slot_name = '{slot}';
+"""
+
+CREATE_REPLICATION_SLOT_STATEMENT = """
+CREATE_REPLICATION_SLOT "{slot}" {temporary} LOGICAL pgoutput;
+"""
+
+
+def _fetchall(connection: Psycopg2Connection, statement: str, args: Optional[Tuple] = None) -> List[Tuple]:
+    """Execute a parameterized statement in its own transaction and fetch the rows.
+
+    Parameters
+    ----------
+    connection: psycopg2.extensions.connection
+        Active connection to a PostGreSQL database.
+    statement: str
+        PGSQL statement to run against the database.
+    args: tuple, optional
+        Statement parameters.
+
+    Returns
+    -------
+    list
+        Rows returned by the statement.
+
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(statement, args)
+            return cursor.fetchall()
+
+
+def _execute(connection: Psycopg2Connection, statement: str, args: Optional[Tuple] = None) -> None:
+    """Execute a parameterized statement in its own transaction.
+
+    Parameters
+    ----------
+    connection: psycopg2.extensions.connection
+        Active connection to a PostGreSQL database.
+    statement: str
+        PGSQL statement to run against the database.
+    args: tuple, optional
+        Statement parameters.
+
+    Returns
+    -------
+    None
+
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(statement, args)
+
+
+def _gevent_wait_callback(connection: Psycopg2Connection, timeout: Optional[float] = None) -> None:
+    """Wait for a psycopg2 connection cooperatively, yielding to other greenlets.
+
+    Parameters
+    ----------
+    connection: psycopg2.extensions.connection
+        Connection to wait for.
+    timeout: float, optional
+        Number of seconds to wait for each read or write.
+
+    Returns
+    -------
+    None
+
+    """
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = connection.poll()
+        if state == POLL_OK:
+            break
+        elif state == POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: {}".format(state))
+
+
+def _callback_name(callback: Callable) -> str:
+    """Get the qualified name by which a callback is recorded in the dead-letter table.
+
+    Parameters
+    ----------
+    callback: Callable
+        Trigger callback.
+
+    Returns
+    -------
+    str
+        Qualified name of the callback, in the form "<MODULE>.<QUALNAME>".
+
+    """
+    return "{}.{}".format(callback.__module__, getattr(callback, "__qualname__", callback.__name__))
+
+
+def _parse_snapshot(snapshot: str) -> Tuple[int, int, Set[int]]:
+    """Parse the text representation of a ``txid_current_snapshot()``.
+
+    Parameters
+    ----------
+    snapshot: str
+        Snapshot, in the form "<XMIN>:<XMAX>:<XIP>,...".
+
+    Returns
+    -------
+    tuple
+        The snapshot's xmin, xmax, and set of in-progress transaction IDs.
+
+    """
+    (xmin, xmax, xip) = snapshot.split(":")
+    return (int(xmin), int(xmax), {int(txid) for txid in xip.split(",") if txid})
+
+
+def _snapshot_visible(snapshot: Tuple[int, int, Set[int]], txid: int) -> bool:
+    """Check whether a transaction's changes are visible in a snapshot.
+
+    This mirrors PostgreSQL's ``txid_visible_in_snapshot()``.
+
+    Parameters
+    ----------
+    snapshot: tuple
+        Parsed snapshot, as returned by ``_parse_snapshot``.
+    txid: int
+        Transaction ID.
+
+    Returns
+    -------
+    bool
+        Whether or not the transaction had committed when the snapshot was
+        taken.
+
+    """
+    (xmin, xmax, xip) = snapshot
+    return txid < xmin or (txid < xmax and txid not in xip)
+
+
+def _normalize_capture(capture: Any) -> Any:
+    """Normalize the capture argument of `PGEvents.listen`.
+
+    Parameters
+    ----------
+    capture: bool or iterable, optional
+        True for the whole row, or an iterable of column names or columns.
+
+    Returns
+    -------
+    None, str, or tuple
+        None for no columns, "*" for the whole row, or a sorted tuple of
+        column names.
+
+    """
+    if capture is True:
+        return "*"
+    if not capture:
+        return None
+    return tuple(sorted(getattr(column, "name", column) for column in capture))
+
+
+def _capture_argument(capture: Any) -> str:
+    """Convert a capture specification into a trigger argument.
+
+    Parameters
+    ----------
+    capture: None, str, or tuple
+        None for no columns, "*" for the whole row, or a tuple of column names.
+
+    Returns
+    -------
+    str
+        Trigger argument understood by the trigger functions.
+
+    """
+    if capture is None:
+        return ""
+    if capture == "*":
+        return "*"
+    return ",".join(capture)
+
+
+def _like_pattern(pattern: str) -> str:
+    """Convert a shell-style pattern into a LIKE pattern.
+
+    Parameters
+    ----------
+    pattern: str
+        Pattern in which "*" matches any characters, and "?" any one.
+
+    Returns
+    -------
+    str
+        Equivalent LIKE pattern.
+
+    """
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def _partition_arguments(partition: Optional[Tuple[str, int]]) -> Dict[str, str]:
+    """Convert a partition specification into trigger arguments.
+
+    Parameters
+    ----------
+    partition: tuple, optional
+        Partition key column and number of partitions, or None.
+
+    Returns
+    -------
+    dict
+        Trigger arguments understood by the trigger functions, by name.
+
+    """
+    if partition is None:
+        return {"partition_by": "", "partitions": ""}
+    return {"partition_by": partition[0], "partitions": str(partition[1])}
+
+
+def _merge_capture(capture: Any, other: Any) -> Any:
+    """Combine two capture specifications into one that satisfies both.
+
+    Parameters
+    ----------
+    capture: None, str, or tuple
+        Capture specification.
+    other: None, str, or tuple
+        Capture specification.
+
+    Returns
+    -------
+    None, str, or tuple
+        Combined capture specification.
+
+    """
+    if capture is None or other is None:
+        return capture if other is None else other
+    if "*" in (capture, other):
+        return "*"
+    return tuple(sorted(set(capture) | set(other)))
+
+
+def _project(data: Optional[Dict], capture: Any) -> Optional[Dict]:
+    """Project captured row data onto the columns a trigger asked for.
+
+    Parameters
+    ----------
+    data: dict, optional
+        Captured data, with "new" and "old" rows.
+    capture: str or tuple
+        "*" for the whole row, or a tuple of column names.
+
+    Returns
+    -------
+    dict, optional
+        Projected data.
+
+    """
+    if data is None or capture == "*":
+        return data
+
+    projected = {}
+    for (key, row) in data.items():
+        # Only rows are projected; "truncated" marks data that was dropped
+        projected[key] = {column: row.get(column) for column in capture} if isinstance(row, dict) else row
+    return projected
+
+
+def _from_isoformat(python_type: Any, value: str) -> Any:
+    """Parse a date, time, or datetime formatted by ``to_jsonb``.
+
+    Parameters
+    ----------
+    python_type: type
+        ``date``, ``time``, or ``datetime``.
+    value: str
+        ISO 8601 value, e.g. "2024-01-01T12:00:00.5+00:00".
+
+    Returns
+    -------
+    date, time, or datetime
+        Parsed value.
+
+    """
+    if python_type is not date:
+        # fromisoformat only accepts 3 or 6 fractional digits, and offsets
+        # with minutes, before Python 3.11
+        value = re.sub(r"\.(\d+)", lambda match: "." + match.group(1).ljust(6, "0")[:6], value)
+        value = re.sub(r"([+-]\d\d)$", r"\1:00", value)
+    return python_type.fromisoformat(value)
+
+
+def _decode_number(value: str) -> Any:
+    # Like to_jsonb, keep NaN and infinities as strings
+    if value in ("NaN", "Infinity", "-Infinity"):
+        return value
+    return json.loads(value)
+
+
+def _decode_timestamp(value: str) -> str:
+    # ISO 8601, as formatted by to_jsonb, e.g. "2024-01-01T12:00:00+00:00"
+    return re.sub(r"([+-]\d\d)$", r"\1:00", value.replace(" ", "T", 1))
+
+
+# Decoders of the types whose text representation differs from their JSON
+# representation, by type OID; values of other types are JSON strings either way
+TEXT_DECODERS = {
+    16: lambda value: value == "t",
+    20: _decode_number,
+    21: _decode_number,
+    23: _decode_number,
+    700: _decode_number,
+    701: _decode_number,
+    1700: _decode_number,
+    114: json.loads,
+    3802: json.loads,
+    1114: _decode_timestamp,
+    1184: _decode_timestamp,
+}  # type: Dict[int, Callable[[str], Any]]
+
+# Dialect whose result processors convert captured values, e.g. into UUIDs
+POSTGRESQL_DIALECT = postgresql.dialect()
+
+
+def _text_decoder(type_oid: int, element_oid: Optional[int] = None) -> Callable[[str], Any]:
+    """Get the decoder of a type's text representation into its JSON value, as produced by ``to_jsonb``.
+
+    Parameters
+    ----------
+    type_oid: int
+        OID of the type.
+    element_oid: int, optional
+        OID of the type's elements, if it is an array type.
+
+    Returns
+    -------
+    callable
+        Function decoding a value of the type.
+
+    """
+    if element_oid is None:
+        return TEXT_DECODERS.get(type_oid, str)
+
+    decode = TEXT_DECODERS.get(element_oid, str)
+    return lambda value: _decode_array(value, decode)
+
+
+def _decode_array(value: str, decode: Callable[[str], Any]) -> List:
+    """Decode the text representation of an array, e.g. '{{1,2},{3,NULL}}'.
+
+    Parameters
+    ----------
+    value: str
+        Array in its text representation.
+    decode: callable
+        Decoder of the array's elements.
+
+    Returns
+    -------
+    list
+        Array as nested lists.
+
+    """
+    if value.startswith("["):
+        # Explicit bounds, e.g. '[0:1]={1,2}'
+        value = value.split("=", 1)[1]
+
+    (items, _) = _decode_array_items(value, 1, decode)
+    return items
+
+
+def _decode_array_items(value: str, offset: int, decode: Callable[[str], Any]) -> Tuple[List, int]:
+    items = []  # type: List[Any]
+    item = None  # type: Any
+    while value[offset] != "}":
+        if value[offset] == "{":
+            (item, offset) = _decode_array_items(value, offset + 1, decode)
+        elif value[offset] == '"':
+            (element, offset) = _decode_array_string(value, offset + 1)
+            item = decode(element)
+        else:
+            end = offset
+            while value[end] not in ",}":
+                end += 1
+            item = None if value[offset:end] == "NULL" else decode(value[offset:end])
+            offset = end
+        items.append(item)
+        if value[offset] == ",":
+            offset += 1
+
+    return (items, offset + 1)
+
+
+def _decode_array_string(value: str, offset: int) -> Tuple[str, int]:
+    chars = []
+    while value[offset] != '"':
+        if value[offset] == "\\":
+            offset += 1
+        chars.append(value[offset])
+        offset += 1
+
+    return ("".join(chars), offset + 1)
 
 
 @attr.s(auto_attribs=True)
 class Trigger:
     """Dataclass for PGEvent triggers.
 
-    Attributes
-    ----------
-    target: Callable
-        SQLAlchemy model class for which to listen.
-    callback: Callable
-        Method to call when an event matches this trigger.
-    events: set
-        Event or events that this trigger should listen for.
-    installed:
-        Whether or not the trigger is installed.
-    """
+    Attributes
+    ----------
+    target: Callable, optional
+        SQLAlchemy model class for which to listen, or None for a pattern
+        trigger.
+    callback: Callable
+        Method to call when an event matches this trigger.
+    events: set
+        Event or events that this trigger should listen for.
+    installed:
+        Whether or not the trigger is installed.
+    mode: str
+        How events are produced for the target: "trigger" for a database
+        trigger, or "orm" for events emitted by the ORM session at commit.
+    capture:
+        Row data passed to the callback: None for none, "*" for the whole
+        row, or a tuple of column names.
+    priority: int
+        Scheduling weight of the lane in which matching events are queued.
+    partition: tuple, optional
+        Partition key column and number of partitions of the target's table,
+        if its events are partitioned across consumers.
+    snapshot: tuple, optional
+        Snapshot whose transactions' events are not passed to the callback,
+        as returned by ``_parse_snapshot``, e.g. set by ``sync``.
+    bulkhead: Bulkhead, optional
+        Executor in which the callback runs, instead of the caller's thread.
+    pattern: tuple, optional
+        Schema and table patterns of the tables for which to listen, instead
+        of the target's table.
+    group: str, optional
+        How matching events are grouped for the callback: "transaction" to
+        pass it all events of a transaction at once.
+    internal: bool
+        Whether the callback maintains a cache or aggregate of the extension,
+        which ``sync`` leaves alone, instead of being a listener.
+    """
+
+    target: Optional[Callable]
+    callback: Callable
+    events: Set = set()
+    installed: bool = False
+    mode: str = "trigger"
+    capture: Any = None
+    priority: int = DEFAULT_PRIORITY
+    partition: Optional[Tuple[str, int]] = None
+    snapshot: Optional[Tuple[int, int, Set[int]]] = None
+    bulkhead: Optional["Bulkhead"] = None
+    pattern: Optional[Tuple[str, str]] = None
+    group: Optional[str] = None
+    internal: bool = False
+
+
+@attr.s(auto_attribs=True)
+class Event:
+    """Dataclass for events produced by an event source.
+
+    Attributes
+    ----------
+    id: UUID
+        Event UUID.
+    type: str
+        PostGreSQL event type, one of 'INSERT', 'UPDATE', or 'DELETE'.
+    schema_name: str
+        Schema in which the event occurred.
+    table_name: str
+        Table in which the event occurred.
+    row_id: str, optional
+        Row ID of the event, if the table has an "id" column. It is converted
+        to text, so that callbacks get the same type from every event source.
+    position: int, optional
+        Source-specific position of the event (e.g. a WAL LSN), if the source
+        provides ordered delivery.
+    data: dict, optional
+        Captured row data, as a dictionary with the "new" and "old" rows, if
+        any listener of the table asked for it. If the rows were too large
+        for the event source, both are None and "truncated" is True.
+    txid: int, optional
+        ID of the transaction in which the event occurred, as returned by
+        ``txid_current()``, if known.
+    trace_id: str, optional
+        Trace of the transaction in which the event occurred, as set by the
+        writer's ``Tracer``, if any.
+    partition: int, optional
+        Partition of the table to which the event was routed, if the table is
+        partitioned.
+    """
+
+    id: UUID
+    type: str
+    schema_name: str
+    table_name: str
+    row_id: Optional[str] = attr.ib(converter=attr.converters.optional(str))
+    position: Optional[int] = None
+    data: Optional[Dict] = None
+    txid: Optional[int] = None
+    trace_id: Optional[str] = None
+    partition: Optional[int] = None
+
+    @classmethod
+    def fromjson(cls, json_string: str) -> "Event":
+        """Create a new Event from JSON.
+
+        Parameters
+        ----------
+        json_string: str
+            JSON-serialized Event.
+
+        Returns
+        -------
+        Event
+            Event created from JSON deserialization.
+
+        """
+        obj = json.loads(json_string)
+        return cls(
+            UUID(obj["event_id"]),
+            obj["event_type"],
+            obj["schema_name"],
+            obj["table_name"],
+            obj["row_id"],
+            obj.get("position"),
+            obj.get("data"),
+            obj.get("txid"),
+            obj.get("trace_id"),
+            obj.get("partition"),
+        )
+
+    def tojson(self) -> str:
+        """Serialize an Event into JSON.
+
+        Returns
+        -------
+        str
+            JSON-serialized Event.
+
+        """
+        return json.dumps(
+            {
+                "event_id": str(self.id),
+                "event_type": self.type,
+                "schema_name": self.schema_name,
+                "table_name": self.table_name,
+                "row_id": self.row_id,
+                "position": self.position,
+                "data": self.data,
+                "txid": self.txid,
+                "trace_id": self.trace_id,
+                "partition": self.partition,
+            },
+            default=str,
+        )
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class EventRecord:
+    """Lightweight record of an event, as yielded by ``PGEvents.iter_events``.
+
+    Attributes
+    ----------
+    id: UUID
+        Event UUID.
+    type: str
+        PostGreSQL event type, one of 'INSERT', 'UPDATE', or 'DELETE'.
+    model: flask_sqlalchemy.model.Model, optional
+        Model of the table in which the event occurred, if known.
+    row_id: str, optional
+        Row ID of the event, if the table has an "id" column.
+    data: dict, optional
+        Captured row data, as a dictionary with the "new" and "old" rows, if
+        any listener of the table asked for it.
+    """
+
+    id: UUID
+    type: str
+    model: Optional[Model]
+    row_id: Optional[str]
+    data: Optional[Dict] = None
+
+
+class EventSource:
+    """Base class for the sources from which PGEvents receives events.
+
+    An event source is responsible for preparing the database, making a table
+    emit events, and polling for those events. Sources are selected with the
+    ``PGEVENTS_EVENT_SOURCE`` configuration variable.
+
+    Attributes
+    ----------
+    requires_connection: bool
+        Whether the extension should hold a database connection for this
+        source.
+    ordered_positions: bool
+        Whether the positions of a table partition's events increase in the
+        order they are delivered (i.e. in commit order).
+    """
+
+    requires_connection = True
+    ordered_positions = False
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        """Initialize the event source.
+
+        Parameters
+        ----------
+        pgevents: PGEvents
+            Extension that owns this event source.
+
+        """
+        self._pgevents = pgevents
+
+    @property
+    def _connection(self) -> Psycopg2Connection:
+        return self._pgevents._psycopg2_connection
+
+    def setup(self) -> None:
+        """Prepare the database for this event source.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        """Make a table emit events to this event source.
+
+        Installing a table again replaces its previous installation.
+
+        Parameters
+        ----------
+        table_name: str
+            Table for which events should be emitted.
+        schema_name: str
+            Schema to which the table belongs.
+        capture: None, str, or tuple
+            Row data to capture in events: None for none, "*" for the whole
+            row, or a tuple of column names.
+        partition: tuple, optional
+            Partition key column and number of partitions, if the table's
+            events should be routed to partitions. Only the partitions
+            assigned with ``assign`` are then received.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not support partitions.
+
+        Returns
+        -------
+        None
+
+        """
+        raise NotImplementedError
+
+    def assign(self, table_name: str, schema_name: str, partitions: Set[int]) -> None:
+        """Receive the events of a partitioned table's given partitions only.
+
+        Parameters
+        ----------
+        table_name: str
+            Partitioned table.
+        schema_name: str
+            Schema to which the table belongs.
+        partitions: set
+            Partitions whose events to receive, replacing the previous ones.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not support partitions.
+
+        Returns
+        -------
+        None
+
+        """
+        raise NotImplementedError("{} does not support partitions".format(type(self).__name__))
+
+    def uninstall(self, table_name: str, schema_name: str) -> None:
+        """Stop a table from emitting events to this event source.
+
+        By default, the table's event trigger is dropped.
+
+        Parameters
+        ----------
+        table_name: str
+            Table for which events should no longer be emitted.
+        schema_name: str
+            Schema to which the table belongs.
+
+        Returns
+        -------
+        None
+
+        """
+        pgevts.execute(self._connection, UNINSTALL_TRIGGER_STATEMENT.format(schema=schema_name, table=table_name))
+
+    def subscribe(self, table_name: str, schema_name: str) -> None:
+        """Receive the events that the application emits for a table in "orm" mode.
+
+        By default, emitted events are received without subscribing.
+
+        Parameters
+        ----------
+        table_name: str
+            Table whose events to receive.
+        schema_name: str
+            Schema to which the table belongs.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def unsubscribe(self, table_name: str, schema_name: str) -> None:
+        """Stop receiving the events that the application emits for a table in "orm" mode.
+
+        Parameters
+        ----------
+        table_name: str
+            Table whose events to no longer receive.
+        schema_name: str
+            Schema to which the table belongs.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def get_install_statement(self, capture: Any = None) -> str:
+        """Get the statement that makes a table emit events, for the database to install new tables.
+
+        Parameters
+        ----------
+        capture: None, str, or tuple
+            Row data to capture in events; see ``install``.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not support installation by the
+            database, and thus table patterns.
+
+        Returns
+        -------
+        str
+            Statement, with "{schema}" and "{table}" placeholders for the
+            table's names.
+
+        """
+        raise NotImplementedError("{} does not support table patterns".format(type(self).__name__))
+
+    def get_installed_tables(self) -> Set[str]:
+        """Get the tables that emit events to this event source, according to the catalog.
+
+        By default, these are the tables with an event trigger, including
+        triggers installed by previous deploys.
+
+        Returns
+        -------
+        set
+            Fully-resolved table names, in the form "<SCHEMA>.<TABLE>".
+
+        """
+        rows = _fetchall(self._connection, SELECT_TRIGGER_TABLES_STATEMENT)
+        return {"{}.{}".format(schema_name, table_name) for (schema_name, table_name) in rows}
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        """Emit events from the application, within the caller's transaction.
+
+        Used by listeners in "orm" mode, instead of a database trigger.
+
+        Parameters
+        ----------
+        connection: sqlalchemy.engine.base.Connection
+            Connection of the transaction in which the events occurred.
+        events: list
+            Events to emit.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not support emitting events.
+
+        Returns
+        -------
+        None
+
+        """
+        raise NotImplementedError("{} does not support ORM mode".format(type(self).__name__))
+
+    def start(self) -> None:
+        """Start receiving events, once all known tables are installed.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        """Poll for events.
+
+        Parameters
+        ----------
+        timeout: float
+            Number of seconds to block when polling for events.
+
+        Returns
+        -------
+        Iterable[Event]
+            Events that were received.
+
+        """
+        raise NotImplementedError
+
+    def ack(self, events: List[Event]) -> None:
+        """Acknowledge that events have been handled.
+
+        Events are acknowledged in the order they were received, and only up
+        to the first event whose callbacks failed, so that a source that
+        tracks a position may resume from the first unhandled event.
+
+        Parameters
+        ----------
+        events: list
+            Handled events.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def tune(self, fetch_size: int, interval: float) -> None:
+        """Apply the settings chosen by the adaptive controller.
+
+        Sources that read events in batches, or at intervals, use them
+        instead of their configuration; others ignore them.
+
+        Parameters
+        ----------
+        fetch_size: int
+            Maximum number of events read at once.
+        interval: float
+            Maximum number of seconds between reads.
+
+        Returns
+        -------
+        None
+
+        """
+
+    def get_position(self, timestamp: Optional[datetime] = None) -> int:
+        """Get the position of the last stored event, or of the last one stored before a time.
+
+        Parameters
+        ----------
+        timestamp: datetime, optional
+            Time before which the event was stored.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not store events, or their times.
+
+        Returns
+        -------
+        int
+            Position of the event, or 0 if there is none.
+
+        """
+        raise NotImplementedError("{} does not store events".format(type(self).__name__))
+
+    def read(
+        self,
+        connection: Psycopg2Connection,
+        start: int,
+        end: int,
+        table: Optional[str] = None,
+        chunk_size: int = DEFAULT_REPLAY_CHUNK_SIZE,
+    ) -> Iterator[Event]:
+        """Read stored events through a server-side cursor.
+
+        Parameters
+        ----------
+        connection: psycopg2.extensions.connection
+            Connection from which to read, other than the source's own, so
+            that events may be read in other processes.
+        start: int
+            Position after which to read.
+        end: int
+            Position up to which to read.
+        table: str, optional
+            Fully-resolved name of the only table whose events to read, in the
+            form "<SCHEMA>.<TABLE>".
+        chunk_size: int
+            Number of events fetched at once.
+
+        Raises
+        ------
+        NotImplementedError
+            Raises if the source does not store events.
+
+        Returns
+        -------
+        Iterator[Event]
+            Events, in order of position.
+
+        """
+        raise NotImplementedError("{} does not store events".format(type(self).__name__))
+
+    def teardown(self) -> None:
+        """Stop receiving events.
+
+        Returns
+        -------
+        None
+
+        """
+
+
+class NotifyEventSource(EventSource):
+    """Event source that receives events from psycopg2-pgevents triggers via LISTEN/NOTIFY."""
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        self._channels = defaultdict(set)  # type: Dict[str, Set[str]]
+
+    def setup(self) -> None:
+        pgevts.install_trigger_function(self._connection)
+        pgevts.execute(self._connection, INSTALL_CAPTURE_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_PARTITION_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_NOTIFY_FUNCTION_STATEMENT)
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        # Unlike psycopg2-pgevents' trigger function, this extension's adds
+        # the transaction ID and captured row data to the payload, and
+        # notifies a channel per partition of partitioned tables. NOTIFY
+        # payloads are limited to 8000 bytes, so the captured data of larger
+        # events is dropped and marked as truncated.
+        statement = INSTALL_NOTIFY_TRIGGER_STATEMENT.format(
+            schema=schema_name, table=table_name, capture=_capture_argument(capture), **_partition_arguments(partition)
+        )
+        pgevts.execute(self._connection, statement)
+
+    def get_install_statement(self, capture: Any = None) -> str:
+        return INSTALL_NOTIFY_TRIGGER_STATEMENT.format(
+            schema="{schema}", table="{table}", capture=_capture_argument(capture), **_partition_arguments(None)
+        )
+
+    def assign(self, table_name: str, schema_name: str, partitions: Set[int]) -> None:
+        table = "{}.{}".format(schema_name, table_name)
+        ((oid, _, _),) = _fetchall(self._connection, SELECT_TABLE_OID_STATEMENT, (schema_name, table_name))
+
+        channels = {"psycopg2_pgevents_channel_{}_{}".format(oid, partition) for partition in partitions}
+        for channel in sorted(channels - self._channels[table]):
+            pgevts.execute(self._connection, 'LISTEN "{}";'.format(channel))
+        for channel in sorted(self._channels[table] - channels):
+            pgevts.execute(self._connection, 'UNLISTEN "{}";'.format(channel))
+        self._channels[table] = channels
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        payloads = [
+            json.dumps(
+                {
+                    "event_id": str(evt.id),
+                    "event_type": evt.type,
+                    "schema_name": evt.schema_name,
+                    "table_name": evt.table_name,
+                    "row_id": evt.row_id,
+                    "data": evt.data,
+                },
+                default=str,
+            )
+            for evt in events
+        ]
+        connection.execute(text(NOTIFY_EVENTS_STATEMENT), payloads=payloads)
+
+    def start(self) -> None:
+        pgevts.register_event_channel(self._connection)
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        # Notifications left over from an interrupted poll need no waiting
+        if not self._connection.notifies and not self._pgevents._wait_read(self._connection, timeout):
+            return
+
+        self._connection.poll()
+        while self._connection.notifies:
+            notify = self._connection.notifies.pop(0)
+            yield Event.fromjson(notify.payload)
+
+    def teardown(self) -> None:
+        pgevts.unregister_event_channel(self._connection)
+        if any(self._channels.values()):
+            pgevts.execute(self._connection, "UNLISTEN *;")
+        self._channels.clear()
+
+
+class LogicalReplicationEventSource(EventSource):
+    """Event source that decodes changes from a logical replication slot.
+
+    Changes are streamed with the built-in ``pgoutput`` plugin, so no trigger
+    is installed on watched tables; instead, tables are added to a
+    publication. Delivery is ordered by LSN and resumes from the slot's
+    confirmed position after a restart. The database must be configured with
+    ``wal_level = logical``.
+
+    Configuration
+    -------------
+    PGEVENTS_REPLICATION_SLOT: str
+        Name of the replication slot (default: "flask_sqlalchemy_pgevents").
+    PGEVENTS_REPLICATION_SLOT_TEMPORARY: bool
+        Whether the slot should be dropped when the extension is torn down
+        (default: False).
+    PGEVENTS_PUBLICATION: str
+        Name of the publication (default: "flask_sqlalchemy_pgevents").
+    """
+
+    EVENT_TYPES = {b"I": "INSERT", b"U": "UPDATE", b"D": "DELETE"}
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        config = pgevents._app.config  # type: ignore
+        self._slot_name = config.get("PGEVENTS_REPLICATION_SLOT", DEFAULT_REPLICATION_SLOT)
+        self._temporary = config.get("PGEVENTS_REPLICATION_SLOT_TEMPORARY", False)
+        self._publication = config.get("PGEVENTS_PUBLICATION", DEFAULT_PUBLICATION)
+
+        self._replication_connection = None  # type: Optional[Psycopg2Connection]
+        self._cursor = None  # type: Optional[psycopg2.extras.ReplicationCursor]
+        self._relations = {}  # type: Dict[int, Tuple[str, str, List[str], List[Callable[[str], Any]]]]
+        self._flush_lsn = 0  # type: int
+        self._received_lsn = 0  # type: int
+        self._txid = None  # type: Optional[int]
+        self._txid_horizon = 0  # type: int
+
+    def setup(self) -> None:
+        pgevts.execute(self._connection, CREATE_PUBLICATION_STATEMENT.format(publication=self._publication))
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        if partition is not None:
+            # The slot streams every change to its only consumer
+            raise NotImplementedError("{} does not support partitions".format(type(self).__name__))
+
+        # pgoutput always sends the new row, but only sends the whole old row
+        # of tables with REPLICA IDENTITY FULL
+        statement = ADD_PUBLICATION_TABLE_STATEMENT.format(
+            publication=self._publication, schema=schema_name, table=table_name
+        )
+        if capture is not None:
+            statement += SET_REPLICA_IDENTITY_FULL_STATEMENT.format(schema=schema_name, table=table_name)
+        pgevts.execute(self._connection, statement)
+
+    def get_install_statement(self, capture: Any = None) -> str:
+        statement = ADD_PUBLICATION_TABLE_STATEMENT.format(
+            publication=self._publication, schema="{schema}", table="{table}"
+        )
+        if capture is not None:
+            statement += SET_REPLICA_IDENTITY_FULL_STATEMENT
+        return statement
+
+    def uninstall(self, table_name: str, schema_name: str) -> None:
+        statement = DROP_PUBLICATION_TABLE_STATEMENT.format(
+            publication=self._publication, schema=schema_name, table=table_name
+        )
+        pgevts.execute(self._connection, statement)
+
+    def get_installed_tables(self) -> Set[str]:
+        rows = _fetchall(self._connection, SELECT_PUBLICATION_TABLES_STATEMENT, (self._publication,))
+        return {"{}.{}".format(schema_name, table_name) for (schema_name, table_name) in rows}
+
+    def start(self) -> None:
+        engine = self._pgevents._connection.engine  # type: ignore
+        connect_args = engine.url.translate_connect_args(username="user", database="dbname")
+        connect_args.update(engine.url.query)
+
+        self._replication_connection = psycopg2.connect(connection_factory=LogicalReplicationConnection, **connect_args)
+        self._cursor = self._replication_connection.cursor()
+
+        self._create_slot()
+
+        ((self._txid_horizon,),) = _fetchall(self._connection, SELECT_TXID_HORIZON_STATEMENT)
+
+        self._cursor.start_replication(
+            slot_name=self._slot_name,
+            decode=False,
+            options={"proto_version": "1", "publication_names": self._publication},
+        )
+
+    def _create_slot(self) -> None:
+        """Create the replication slot, unless a permanent one already exists.
+
+        Returns
+        -------
+        None
+
+        """
+        if not self._temporary:
+            statement = SELECT_REPLICATION_SLOT_STATEMENT.format(slot=self._slot_name)
+            if pgevts.execute(self._connection, statement):
+                return
+
+        statement = CREATE_REPLICATION_SLOT_STATEMENT.format(
+            slot=self._slot_name, temporary="TEMPORARY" if self._temporary else ""
+        )
+        self._cursor.execute(statement)  # type: ignore
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        # Confirm everything acknowledged so far to the server; this is the
+        # position a restart resumes from.
+        self._cursor.send_feedback(flush_lsn=self._flush_lsn)  # type: ignore
+
+        msg = self._cursor.read_message()  # type: ignore
+        if msg is None:
+            if not self._pgevents._wait_read(self._replication_connection, timeout):
+                return
+            msg = self._cursor.read_message()  # type: ignore
+
+        while msg is not None:
+            evt = self._decode(msg.payload, msg.data_start)
+            if evt is not None:
+                self._received_lsn = msg.data_start
+                yield evt
+            elif self._received_lsn <= self._flush_lsn:
+                # No event awaits acknowledgement, so messages without events
+                # (e.g. transaction boundaries) are confirmed as they arrive
+                self._flush_lsn = msg.data_start
+            msg = self._cursor.read_message()  # type: ignore
+
+    def ack(self, events: List[Event]) -> None:
+        self._flush_lsn = max([self._flush_lsn] + [evt.position for evt in events if evt.position is not None])
+        self._cursor.send_feedback(flush_lsn=self._flush_lsn)  # type: ignore
+
+    def _decode(self, payload: bytes, lsn: int) -> Optional[Event]:
+        """Decode a pgoutput message.
+
+        Parameters
+        ----------
+        payload: bytes
+            Raw pgoutput message.
+        lsn: int
+            WAL position of the message.
+
+        Returns
+        -------
+        Event or None
+            An event if the message represents a row change, otherwise None.
+
+        """
+        kind = payload[:1]
+
+        if kind == b"R":
+            self._decode_relation(payload)
+            return None
+
+        if kind == b"B":
+            (xid,) = struct.unpack_from("!I", payload, 17)
+            self._txid = self._widen_xid(xid)
+            return None
+
+        event_type = self.EVENT_TYPES.get(kind)
+        if event_type is None:
+            return None
+
+        (relation_id,) = struct.unpack_from("!I", payload, 1)
+        (schema_name, table_name, columns, decoders) = self._relations[relation_id]
+
+        # Deletes and updates may carry an old key or row ('K' or 'O') ahead
+        # of the new row ('N'). Old rows are only complete for tables with
+        # REPLICA IDENTITY FULL. Values are sent in their text representation,
+        # and decoded into the JSON values the other event sources capture.
+        data = {"new": None, "old": None}  # type: Dict[str, Optional[Dict]]
+        row_id = None  # type: Optional[str]
+        offset = 5
+        while offset < len(payload):
+            key = "new" if payload[offset] == ord("N") else "old"
+            (values, offset) = self._decode_tuple(payload, offset)
+            row = dict(zip(columns, values))
+            if row_id is None or key == "new":
+                row_id = row.get("id")
+            data[key] = {
+                column: None if value is None else decode(value)
+                for (column, value, decode) in zip(columns, values, decoders)
+            }
+
+        return Event(UUID(int=lsn), event_type, schema_name, table_name, row_id, lsn, data, self._txid)
+
+    def _widen_xid(self, xid: int) -> int:
+        """Convert a 32-bit transaction ID into a 64-bit ``txid_current()`` value.
+
+        The epoch is that of the closest transaction ID to the last one seen.
+
+        Parameters
+        ----------
+        xid: int
+            32-bit transaction ID, as sent in BEGIN messages.
+
+        Returns
+        -------
+        int
+            Epoch-extended transaction ID.
+
+        """
+        txid = (self._txid_horizon & ~0xFFFFFFFF) | xid
+        if txid > self._txid_horizon + 2 ** 31:
+            txid -= 2 ** 32
+        elif txid < self._txid_horizon - 2 ** 31:
+            txid += 2 ** 32
+
+        self._txid_horizon = txid
+        return txid
+
+    def _decode_relation(self, payload: bytes) -> None:
+        (relation_id,) = struct.unpack_from("!I", payload, 1)
+        (schema_name, offset) = self._decode_string(payload, 5)
+        (table_name, offset) = self._decode_string(payload, offset)
+        (column_count,) = struct.unpack_from("!H", payload, offset + 1)
+        offset += 3
+
+        columns = []
+        type_oids = []
+        for _ in range(column_count):
+            (column_name, offset) = self._decode_string(payload, offset + 1)
+            (type_oid,) = struct.unpack_from("!I", payload, offset)
+            columns.append(column_name)
+            type_oids.append(type_oid)
+            offset += 8
+
+        elements = dict(_fetchall(self._connection, SELECT_TYPE_ELEMENTS_STATEMENT, (type_oids,)))
+        decoders = [_text_decoder(type_oid, elements.get(type_oid)) for type_oid in type_oids]
+
+        self._relations[relation_id] = (schema_name or "pg_catalog", table_name, columns, decoders)
+
+    @staticmethod
+    def _decode_string(payload: bytes, offset: int) -> Tuple[str, int]:
+        end = payload.index(b"\0", offset)
+        return (payload[offset:end].decode("utf-8"), end + 1)
+
+    @staticmethod
+    def _decode_tuple(payload: bytes, offset: int) -> Tuple[List[Optional[str]], int]:
+        (column_count,) = struct.unpack_from("!H", payload, offset + 1)
+        offset += 3
+
+        values = []  # type: List[Optional[str]]
+        for _ in range(column_count):
+            kind = payload[offset]
+            offset += 1
+            if kind == ord("t"):
+                (length,) = struct.unpack_from("!I", payload, offset)
+                start = offset + 4
+                offset = start + length
+                values.append(payload[start:offset].decode("utf-8"))
+            else:
+                # NULL ('n') or unchanged TOASTed ('u') value
+                values.append(None)
+
+        return (values, offset)
+
+    def teardown(self) -> None:
+        if self._replication_connection is not None:
+            self._replication_connection.close()
+            self._replication_connection = None
+            self._cursor = None
+
+
+class PollingEventSource(EventSource):
+    """Event source that polls an event table written to by triggers.
+
+    Unlike LISTEN/NOTIFY, polling works through connection poolers in
+    transaction mode (e.g. PgBouncer). Each poll reads new rows by an indexed
+    high-water mark. Polling is tight while events keep arriving, and the
+    interval between reads backs off towards the maximum while idle.
+
+    Event IDs are allocated when rows are inserted, not when their
+    transactions commit, so rows are only read up to a horizon below which
+    all writing transactions have finished; a row committed late is then
+    never skipped, but a long-running writer delays the events after it.
+
+    Event rows are not deleted by this source. Instead, the position of the
+    last acknowledged event is stored per consumer, and a restarted consumer
+    resumes from there.
+
+    Events of partitioned tables are only read for the assigned partitions.
+    The position of each partition is stored too, so that a consumer that is
+    assigned a partition first reads the events its previous owner did not
+    acknowledge.
+
+    Configuration
+    -------------
+    PGEVENTS_POLL_CONSUMER: str
+        Name under which the position of acknowledged events is stored
+        (default: "default"). Processes that should each receive all events
+        need distinct names.
+    PGEVENTS_POLL_BATCH_SIZE: int
+        Maximum number of rows read at once (default: 100).
+    PGEVENTS_POLL_MIN_INTERVAL: float
+        Seconds between reads under load (default: 0.01).
+    PGEVENTS_POLL_MAX_INTERVAL: float
+        Seconds between reads while idle (default: 1.0).
+    """
+
+    # Rows are only read up to the committed horizon, in ID order
+    ordered_positions = True
+    event_table = "public.flask_sqlalchemy_pgevents_event"
+    read_statement = SELECT_EVENT_TABLE_RANGE_STATEMENT
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        config = pgevents._app.config  # type: ignore
+        self._consumer = config.get("PGEVENTS_POLL_CONSUMER", DEFAULT_POLL_CONSUMER)
+        self._batch_size = config.get("PGEVENTS_POLL_BATCH_SIZE", DEFAULT_POLL_BATCH_SIZE)
+        self._min_interval = config.get("PGEVENTS_POLL_MIN_INTERVAL", DEFAULT_POLL_MIN_INTERVAL)
+        self._max_interval = config.get("PGEVENTS_POLL_MAX_INTERVAL", DEFAULT_POLL_MAX_INTERVAL)
+
+        self._interval = self._min_interval  # type: float
+        self._high_water_mark = 0  # type: int
+        self._horizon = 0  # type: int
+        self._checkpoints = deque()  # type: deque
+        self._start_position = 0  # type: int
+        self._partitions = {}  # type: Dict[str, Set[int]]
+        self._backlog = []  # type: List[Tuple]
+        self._catching_up = {}  # type: Dict[Tuple[str, int], int]
+
+    def setup(self) -> None:
+        pgevts.execute(self._connection, INSTALL_CAPTURE_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_PARTITION_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_EVENT_TABLE_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_CONSUMER_TABLE_STATEMENT)
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        statement = INSTALL_EVENT_TABLE_TRIGGER_STATEMENT.format(
+            schema=schema_name, table=table_name, capture=_capture_argument(capture), **_partition_arguments(partition)
+        )
+        pgevts.execute(self._connection, statement)
+
+    def get_install_statement(self, capture: Any = None) -> str:
+        return INSTALL_EVENT_TABLE_TRIGGER_STATEMENT.format(
+            schema="{schema}", table="{table}", capture=_capture_argument(capture), **_partition_arguments(None)
+        )
+
+    def assign(self, table_name: str, schema_name: str, partitions: Set[int]) -> None:
+        table = "{}.{}".format(schema_name, table_name)
+        previous = self._partitions.get(table, set())
+        (acquired, released) = (partitions - previous, previous - partitions)
+        self._partitions[table] = set(partitions)
+
+        # The new owners of released partitions catch up on them instead
+        for partition in released:
+            self._catching_up.pop((table, partition), None)
+        self._backlog = [
+            row for row in self._backlog if "{}.{}".format(row[3], row[4]) != table or row[-1] not in released
+        ]
+
+        for partition in sorted(acquired):
+            rows = _fetchall(
+                self._connection,
+                SELECT_CONSUMER_POSITION_STATEMENT,
+                (self._get_partition_consumer(table, partition), self.event_table),
+            )
+            position = rows[0][0] if rows else self._start_position
+            if position < self._high_water_mark:
+                backlog = self._fetch_partition(schema_name, table_name, partition, position)
+                if backlog:
+                    self._backlog.extend(backlog)
+                    self._catching_up[(table, partition)] = backlog[-1][0]
+        self._backlog.sort(key=lambda row: row[0])
+
+    def _get_partition_consumer(self, table: str, partition: int) -> str:
+        """Get the name under which the position of a partition is stored.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+        partition: int
+            Partition of the table.
+
+        Returns
+        -------
+        str
+            Consumer name of the partition.
+
+        """
+        return "{}:{}:{}".format(self._consumer, table, partition)
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        connection.execute(
+            text(INSERT_EVENT_TABLE_EVENTS_STATEMENT),
+            event_ids=[str(evt.id) for evt in events],
+            event_types=[evt.type for evt in events],
+            schema_names=[evt.schema_name for evt in events],
+            table_names=[evt.table_name for evt in events],
+            row_ids=[evt.row_id for evt in events],
+            data=[None if evt.data is None else json.dumps(evt.data, default=str) for evt in events],
+        )
+
+    def start(self) -> None:
+        rows = _fetchall(self._connection, SELECT_CONSUMER_POSITION_STATEMENT, (self._consumer, self.event_table))
+        if rows:
+            ((self._high_water_mark,),) = rows
+        else:
+            # A new consumer starts with the events that follow it
+            statement = SELECT_EVENT_TABLE_HIGH_WATER_MARK_STATEMENT.format(event_table=self.event_table)
+            ((self._high_water_mark,),) = _fetchall(self._connection, statement)
+            args = (self._consumer, self.event_table, self._high_water_mark)
+            _execute(self._connection, ACK_CONSUMER_POSITION_STATEMENT, args)
+        self._start_position = self._high_water_mark
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        deadline = time.monotonic() + timeout
+
+        # Events of newly assigned partitions come first, below the high-water mark
+        (backlog, self._backlog) = (self._backlog, [])
+        for row in backlog:
+            yield self._get_event(row)
+
+        while True:
+            rows = self._fetch()
+            for row in rows:
+                self._high_water_mark = row[0]
+                yield self._get_event(row)
+
+            if len(rows) == self._batch_size:
+                # Under load; keep draining without waiting
+                self._interval = self._min_interval
+                continue
+
+            if rows:
+                self._interval = self._min_interval
+            else:
+                backoff = max(self._interval * 2, self._min_interval) or DEFAULT_POLL_MIN_INTERVAL
+                self._interval = min(backoff, self._max_interval)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._pgevents._sleep(min(self._interval, remaining))
+
+    def tune(self, fetch_size: int, interval: float) -> None:
+        self._batch_size = fetch_size
+        self._max_interval = max(interval, self._min_interval)
+
+    @staticmethod
+    def _get_event(row: Tuple) -> Event:
+        """Create an event from an event row.
+
+        Parameters
+        ----------
+        row: tuple
+            Row of position, event ID, event type, schema name, table name,
+            row ID, data, transaction ID, trace ID and partition.
+
+        Returns
+        -------
+        Event
+            Event of the row.
+
+        """
+        (position, event_id, event_type, schema_name, table_name, row_id, data, txid, trace_id, partition) = row
+        return Event(
+            UUID(event_id), event_type, schema_name, table_name, row_id, position, data, txid, trace_id, partition
+        )
+
+    def _get_partition_keys(self) -> List[str]:
+        """Get the keys by which the event rows of the assigned partitions are read.
+
+        Returns
+        -------
+        list
+            Keys, in the form "<SCHEMA>.<TABLE>:<PARTITION>".
+
+        """
+        return [
+            "{}:{}".format(table, partition)
+            for (table, partitions) in self._partitions.items()
+            for partition in sorted(partitions)
+        ]
+
+    def _fetch(self) -> List[Tuple]:
+        """Read the next batch of event rows past the high-water mark, up to the horizon.
+
+        Rows of partitioned tables are only read for the assigned partitions.
+
+        Returns
+        -------
+        list of tuple
+            Rows of position, event ID, event type, schema name, table name,
+            row ID, data, transaction ID, trace ID and partition.
+
+        """
+        self._advance_horizon()
+        args = (self._high_water_mark, self._horizon, self._get_partition_keys(), self._batch_size)
+        return _fetchall(self._connection, SELECT_EVENT_TABLE_EVENTS_STATEMENT, args)
+
+    def _advance_horizon(self) -> None:
+        """Advance the horizon up to which all event rows are committed or rolled back.
+
+        The last allocated event ID is recorded with the xmax of a snapshot
+        taken after it: all transactions that allocated IDs up to it are
+        below that xmax, since triggers write the changed row first. Once the
+        xmin of a later snapshot reaches it, they have all finished, and no
+        row up to that ID can appear anymore.
+
+        Returns
+        -------
+        None
+
+        """
+        statement = SELECT_EVENT_TABLE_LAST_ID_STATEMENT.format(event_table=self.event_table)
+        ((last_id,),) = _fetchall(self._connection, statement)
+        ((xmin, xmax),) = _fetchall(self._connection, SELECT_SNAPSHOT_BOUNDS_STATEMENT)
+
+        if not self._checkpoints or last_id > self._checkpoints[-1][1]:
+            if len(self._checkpoints) >= POLL_MAX_CHECKPOINTS:
+                # Merging into a later checkpoint only delays its rows
+                self._checkpoints.pop()
+            self._checkpoints.append((xmax, last_id))
+
+        while self._checkpoints and self._checkpoints[0][0] <= xmin:
+            (_, self._horizon) = self._checkpoints.popleft()
+
+    def _fetch_partition(self, schema_name: str, table_name: str, partition: int, position: int) -> List[Tuple]:
+        """Read the event rows of a partition between a position and the high-water mark.
+
+        Parameters
+        ----------
+        schema_name: str
+            Schema to which the partitioned table belongs.
+        table_name: str
+            Partitioned table.
+        partition: int
+            Partition to read.
+        position: int
+            Position of the partition's last acknowledged event.
+
+        Returns
+        -------
+        list of tuple
+            Rows, as returned by ``_fetch``.
+
+        """
+        args = (schema_name, table_name, partition, position, self._high_water_mark)
+        return _fetchall(self._connection, SELECT_EVENT_TABLE_PARTITION_EVENTS_STATEMENT, args)
+
+    def ack(self, events: List[Event]) -> None:
+        position = max(evt.position for evt in events if evt.position is not None)
+
+        # Events are acknowledged in order, so the position covers all
+        # assigned partitions, except those whose catch-up is still pending
+        for evt in events:
+            key = ("{}.{}".format(evt.schema_name, evt.table_name), evt.partition)
+            if key in self._catching_up and evt.position >= self._catching_up[key]:  # type: ignore
+                del self._catching_up[key]  # type: ignore
+
+        consumers = [self._consumer] + [
+            self._get_partition_consumer(table, partition)
+            for (table, partitions) in self._partitions.items()
+            for partition in sorted(partitions)
+            if (table, partition) not in self._catching_up
+        ]
+        _execute(self._connection, ACK_CONSUMER_POSITIONS_STATEMENT, (self.event_table, position, consumers))
+
+    def get_position(self, timestamp: Optional[datetime] = None) -> int:
+        if timestamp is None:
+            statement = SELECT_EVENT_TABLE_HIGH_WATER_MARK_STATEMENT.format(event_table=self.event_table)
+            return _fetchall(self._connection, statement)[0][0]
+        return _fetchall(self._connection, SELECT_EVENT_TABLE_POSITION_STATEMENT, (timestamp,))[0][0]
+
+    def read(
+        self,
+        connection: Psycopg2Connection,
+        start: int,
+        end: int,
+        table: Optional[str] = None,
+        chunk_size: int = DEFAULT_REPLAY_CHUNK_SIZE,
+    ) -> Iterator[Event]:
+        (schema_name, table_name) = table.split(".") if table is not None else (None, None)
+        args = (start, end, schema_name, schema_name, table_name)
+
+        with connection:
+            with connection.cursor(name="flask_sqlalchemy_pgevents_read") as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(self.read_statement, args)
+                for row in cursor:
+                    yield self._get_event(row)
+
+
+class CompactPollingEventSource(PollingEventSource):
+    """Polling event source with a compact event table.
+
+    Rows of ``public.flask_sqlalchemy_pgevents_compact_event`` identify the
+    changed table by its OID and the event type by a single ``"char"``,
+    rather than by repeated names, which keeps trigger inserts, polling scans
+    and WAL small. OIDs are resolved back to table names in memory.
+
+    Configuration is the same as for ``PollingEventSource``.
+    """
+
+    EVENT_TYPES = {"INSERT": "I", "UPDATE": "U", "DELETE": "D"}
+
+    event_table = "public.flask_sqlalchemy_pgevents_compact_event"
+    read_statement = SELECT_COMPACT_EVENT_TABLE_RANGE_STATEMENT
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        self._table_names = {}  # type: Dict[int, Tuple[str, str]]
+        self._table_oids = {}  # type: Dict[Tuple[str, str], int]
+
+    def setup(self) -> None:
+        pgevts.execute(self._connection, INSTALL_CAPTURE_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_PARTITION_FUNCTION_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_COMPACT_EVENT_TABLE_STATEMENT)
+        pgevts.execute(self._connection, INSTALL_CONSUMER_TABLE_STATEMENT)
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        statement = INSTALL_COMPACT_EVENT_TABLE_TRIGGER_STATEMENT.format(
+            schema=schema_name, table=table_name, capture=_capture_argument(capture), **_partition_arguments(partition)
+        )
+        pgevts.execute(self._connection, statement)
+        self._resolve(SELECT_TABLE_OID_STATEMENT, (schema_name, table_name))
+
+    def get_install_statement(self, capture: Any = None) -> str:
+        # Tables installed by the database are resolved once their events arrive
+        return INSTALL_COMPACT_EVENT_TABLE_TRIGGER_STATEMENT.format(
+            schema="{schema}", table="{table}", capture=_capture_argument(capture), **_partition_arguments(None)
+        )
+
+    def _resolve(self, statement: str, args: Tuple) -> None:
+        """Cache the OID and names of the table matched by a catalog query.
+
+        Parameters
+        ----------
+        statement: str
+            Catalog query returning the table's OID, schema and name.
+        args: tuple
+            Arguments for the query.
+
+        Returns
+        -------
+        None
+
+        """
+        for (oid, schema_name, table_name) in _fetchall(self._connection, statement, args):
+            self._table_names[oid] = (schema_name, table_name)
+            self._table_oids[(schema_name, table_name)] = oid
+
+    def _get_table_oid(self, schema_name: str, table_name: str) -> int:
+        if (schema_name, table_name) not in self._table_oids:
+            self._resolve(SELECT_TABLE_OID_STATEMENT, (schema_name, table_name))
+        return self._table_oids[(schema_name, table_name)]
+
+    def _get_table_name(self, oid: int) -> Tuple[str, str]:
+        if oid not in self._table_names:
+            self._resolve(SELECT_TABLE_NAME_STATEMENT, (oid,))
+        # Tables dropped since the event was written can no longer be resolved
+        return self._table_names.get(oid, ("", str(oid)))
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        # Table OIDs are resolved by the statement, as the listener's connection
+        # may not exist (e.g. for multiplexer workers)
+        connection.execute(
+            text(INSERT_COMPACT_EVENT_TABLE_EVENTS_STATEMENT),
+            event_ids=[str(evt.id) for evt in events],
+            event_types=[self.EVENT_TYPES[evt.type] for evt in events],
+            schema_names=[evt.schema_name for evt in events],
+            table_names=[evt.table_name for evt in events],
+            row_ids=[evt.row_id for evt in events],
+            data=[None if evt.data is None else json.dumps(evt.data, default=str) for evt in events],
+        )
+
+    def _get_partition_keys(self) -> List[str]:
+        return [
+            "{}:{}".format(self._get_table_oid(*table.split(".")), partition)
+            for (table, partitions) in self._partitions.items()
+            for partition in sorted(partitions)
+        ]
+
+    def _fetch(self) -> List[Tuple]:
+        self._advance_horizon()
+        args = (self._high_water_mark, self._horizon, self._get_partition_keys(), self._batch_size)
+        return self._get_rows(SELECT_COMPACT_EVENT_TABLE_EVENTS_STATEMENT, args)
+
+    def get_position(self, timestamp: Optional[datetime] = None) -> int:
+        if timestamp is not None:
+            raise NotImplementedError("{} does not store event times".format(type(self).__name__))
+        return super().get_position()
+
+    def _fetch_partition(self, schema_name: str, table_name: str, partition: int, position: int) -> List[Tuple]:
+        args = (self._get_table_oid(schema_name, table_name), partition, position, self._high_water_mark)
+        return self._get_rows(SELECT_COMPACT_EVENT_TABLE_PARTITION_EVENTS_STATEMENT, args)
+
+    def _get_rows(self, statement: str, args: Tuple) -> List[Tuple]:
+        """Read compact event rows, with their event type and table names resolved.
+
+        Parameters
+        ----------
+        statement: str
+            Query of compact event rows.
+        args: tuple
+            Arguments for the query.
+
+        Returns
+        -------
+        list of tuple
+            Rows, as returned by ``PollingEventSource._fetch``.
+
+        """
+        event_types = {initial: event_type for (event_type, initial) in self.EVENT_TYPES.items()}
+
+        rows = []
+        for (position, event_id, event_type, oid, *fields) in _fetchall(self._connection, statement, args):
+            (schema_name, table_name) = self._get_table_name(oid)
+            rows.append((position, event_id, event_types[event_type], schema_name, table_name, *fields))
+
+        return rows
+
+
+class MultiplexerEventSource(EventSource):
+    """Event source that receives events from a per-host EventMultiplexer.
+
+    The multiplexer holds the only database connection on the host and
+    forwards matching events to each worker over a Unix domain socket, so
+    workers using this source hold no database connection at all. Tables are
+    registered with the multiplexer, which installs their triggers. The
+    connection is (re-)established lazily, so workers may start before the
+    multiplexer does.
+
+    Configuration
+    -------------
+    PGEVENTS_MULTIPLEXER_SOCKET: str
+        Path of the multiplexer's socket
+        (default: "/tmp/flask_sqlalchemy_pgevents.sock").
+    PGEVENTS_MULTIPLEXER_EVENT_SOURCE: str
+        Event source of the multiplexer, in whose format "orm" mode listeners
+        emit events (default: "notify").
+    """
+
+    requires_connection = False
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        config = pgevents._app.config  # type: ignore
+        self._path = config.get("PGEVENTS_MULTIPLEXER_SOCKET", DEFAULT_MULTIPLEXER_SOCKET)
+
+        # Events are consumed by the multiplexer, so they are emitted in the
+        # format of its own event source
+        upstream = config.get(EventMultiplexer.event_source_config, DEFAULT_EVENT_SOURCE)
+        if upstream not in EVENT_SOURCES or upstream == "multiplexer":
+            raise ValueError("Invalid multiplexer event source: {}".format(upstream))
+        self._upstream = EVENT_SOURCES[upstream](pgevents)
+
+        self._socket = None  # type: Optional[socket.socket]
+        self._buffer = b""  # type: bytes
+        # Schema, table, capture and whether the multiplexer installs the table
+        self._tables = []  # type: List[Tuple[str, str, Any, bool]]
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        if partition is not None:
+            raise NotImplementedError("{} does not support partitions".format(type(self).__name__))
+
+        self._tables.append((schema_name, table_name, capture, True))
+        self._register(schema_name, table_name, capture, True)
+
+    def subscribe(self, table_name: str, schema_name: str) -> None:
+        if any(table[:2] == (schema_name, table_name) for table in self._tables):
+            return
+
+        self._tables.append((schema_name, table_name, None, False))
+        self._register(schema_name, table_name, None, False)
+
+    def unsubscribe(self, table_name: str, schema_name: str) -> None:
+        self.uninstall(table_name, schema_name)
+
+    def uninstall(self, table_name: str, schema_name: str) -> None:
+        self._tables = [table for table in self._tables if table[:2] != (schema_name, table_name)]
+        self._send({"schema_name": schema_name, "table_name": table_name, "unregister": True})
+
+    def get_installed_tables(self) -> Set[str]:
+        # The multiplexer owns the triggers, and drops them once unregistered
+        return set()
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        self._upstream.emit(connection, events)
+
+    def _register(self, schema_name: str, table_name: str, capture: Any, install: bool) -> None:
+        self._send({"schema_name": schema_name, "table_name": table_name, "capture": capture, "install": install})
+
+    def _send(self, message: Dict) -> None:
+        """Send a message to the multiplexer, if connected.
+
+        Parameters
+        ----------
+        message: dict
+            Message to send.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._socket is None:
+            return
+
+        try:
+            self._socket.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        except OSError:
+            # Multiplexer went away; tables are registered again on reconnect
+            self.teardown()
+
+    def _connect(self) -> bool:
+        """Connect to the multiplexer and register all known tables.
+
+        Returns
+        -------
+        bool
+            Whether or not a connection is available.
+
+        """
+        if self._socket is not None:
+            return True
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            return False
+
+        self._socket = sock
+        self._buffer = b""
+        for (schema_name, table_name, capture, install) in self._tables:
+            self._register(schema_name, table_name, capture, install)
+
+        return self._socket is not None
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        if not self._connect():
+            self._pgevents._sleep(timeout)
+            return
+
+        if not self._pgevents._wait_read(self._socket, timeout):
+            return
+
+        try:
+            data = self._socket.recv(65536)  # type: ignore
+        except OSError:
+            data = b""
+        if not data:
+            # Multiplexer went away; reconnect on the next poll
+            self.teardown()
+            return
+
+        (*lines, self._buffer) = (self._buffer + data).split(b"\n")
+        for line in lines:
+            yield Event.fromjson(line.decode("utf-8"))
+
+    def teardown(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class MemoryEventSource(EventSource):
+    """Event source that keeps events in memory, so that listeners can be tested without PostgreSQL.
+
+    No trigger is installed: the changes that the application's session makes
+    to the rows of installed tables produce events, as in "orm" mode, on any
+    database supported by SQLAlchemy (e.g. SQLite). Events are received once
+    their transaction commits, and discarded if it rolls back. Tests may also
+    publish synthetic events with ``publish``. Partitions are not supported.
+    """
+
+    requires_connection = False
+    ordered_positions = True
+
+    def __init__(self, pgevents: "PGEvents") -> None:
+        super().__init__(pgevents)
+
+        self._tables = set()  # type: Set[str]
+        self._events = deque()  # type: deque
+        self._position = 0  # type: int
+        self._txid = 0  # type: int
+        self._engine = None  # type: Optional[Any]
+
+    def setup(self) -> None:
+        self._engine = self._pgevents._get_engine()
+        sqlalchemy_event.listen(self._engine, "commit", self._commit)
+        sqlalchemy_event.listen(self._engine, "rollback", self._rollback)
+
+    def install(
+        self, table_name: str, schema_name: str, capture: Any = None, partition: Optional[Tuple[str, int]] = None
+    ) -> None:
+        if partition is not None:
+            raise NotImplementedError("{} does not support partitions".format(type(self).__name__))
+
+        table = "{}.{}".format(schema_name, table_name)
+        self._tables.add(table)
+
+        # Produce the table's events from the session, instead of a trigger;
+        # tables without a model only receive published events
+        model = self._pgevents._get_table_model(table)
+        if model is not None:
+            self._pgevents._orm_events[model].update(IDENTIFIERS)
+            self._pgevents._hook_orm_session()
+
+    def uninstall(self, table_name: str, schema_name: str) -> None:
+        table = "{}.{}".format(schema_name, table_name)
+        self._tables.discard(table)
+        model = self._pgevents._get_table_model(table)
+        if model is not None:
+            self._pgevents._orm_events.pop(model, None)
+
+    def get_installed_tables(self) -> Set[str]:
+        return set(self._tables)
+
+    def emit(self, connection: SQLAlchemyConnection, events: List[Event]) -> None:
+        connection.info.setdefault("pgevents", []).extend(events)
+
+    def publish(
+        self, event_type: str, target: Any, row_id: Any = None, data: Optional[Dict] = None, txid: Optional[int] = None
+    ) -> Event:
+        """Publish a synthetic event, as if a row of a table changed.
+
+        Parameters
+        ----------
+        event_type: str
+            PostGreSQL event type, one of 'INSERT', 'UPDATE', or 'DELETE'.
+        target: flask_sqlalchemy.model.Model or str
+            Model, or fully-resolved table name in the form "<SCHEMA>.<TABLE>",
+            whose row changed.
+        row_id: Any, optional
+            ID of the row that changed.
+        data: dict, optional
+            Captured row data, with the "new" and "old" rows.
+        txid: int, optional
+            ID of the transaction in which the row changed, e.g. to publish
+            several events of one transaction. By default, each published
+            event has a transaction of its own.
+
+        Raises
+        ------
+        ValueError
+            Raises if the event type is invalid.
+
+        Returns
+        -------
+        Event
+            Published event. It is only received if the table is installed.
+
+        """
+        if event_type.lower() not in IDENTIFIERS:
+            raise ValueError("Invalid event type: {}".format(event_type))
+
+        table = target if isinstance(target, str) else self._pgevents._get_full_table_name(target)
+        (schema_name, table_name) = table.split(".")
+
+        evt = Event(uuid4(), event_type.upper(), schema_name, table_name, row_id, data=data, txid=txid)
+        self._receive([evt])
+        return evt
+
+    def _receive(self, events: List[Event]) -> None:
+        """Queue the events of installed tables, in the form they would have if received from the database.
+
+        Parameters
+        ----------
+        events: list
+            Events that occurred, in a transaction of their own unless they
+            have a transaction ID.
+
+        Returns
+        -------
+        None
+
+        """
+        self._txid += 1
+        for evt in events:
+            if "{}.{}".format(evt.schema_name, evt.table_name) not in self._tables:
+                continue
+            self._position += 1
+            evt.position = self._position
+            evt.txid = self._txid if evt.txid is None else evt.txid
+            evt.data = None if evt.data is None else json.loads(json.dumps(evt.data, default=str))
+            self._events.append(evt)
+
+    def _commit(self, connection: SQLAlchemyConnection) -> None:
+        self._receive(connection.info.pop("pgevents", []))
+
+    @staticmethod
+    def _rollback(connection: SQLAlchemyConnection) -> None:
+        connection.info.pop("pgevents", None)
+
+    def poll(self, timeout: float) -> Iterable[Event]:
+        # Events are queued synchronously, so waiting would receive no more
+        while self._events:
+            yield self._events.popleft()
+
+    def teardown(self) -> None:
+        if self._engine is not None:
+            sqlalchemy_event.remove(self._engine, "commit", self._commit)
+            sqlalchemy_event.remove(self._engine, "rollback", self._rollback)
+            self._engine = None
+        self._events.clear()
+
+
+EVENT_SOURCES = {
+    "notify": NotifyEventSource,
+    "logical": LogicalReplicationEventSource,
+    "polling": PollingEventSource,
+    "compact": CompactPollingEventSource,
+    "multiplexer": MultiplexerEventSource,
+    "memory": MemoryEventSource,
+}  # type: Dict[str, Type[EventSource]]
+
+
+class Tracer:
+    """Hook through which events are traced, from the writer to the callbacks.
+
+    Set ``PGEVENTS_TRACER`` to an instance to enable tracing. The base class
+    traces nothing; subclasses provide the trace ID of the current request,
+    which the extension records in the events of the request's transactions,
+    and a span in which each callback runs.
+    """
+
+    def current_trace_id(self) -> Optional[str]:
+        """Get the trace ID to record in the events of the current request.
+
+        Returns
+        -------
+        str, optional
+            Trace ID, or None if the request is not traced.
+
+        """
+        return None
+
+    def span(self, evt: Event, callback: Callable) -> ContextManager:
+        """Get the span in which a callback runs for an event.
+
+        Parameters
+        ----------
+        evt: Event
+            Event passed to the callback, with the writer's trace ID, if any.
+        callback: Callable
+            Callback to run.
+
+        Returns
+        -------
+        ContextManager
+            Span, entered while the callback runs.
+
+        """
+        return contextlib.nullcontext()
+
+
+class OpenTelemetryTracer(Tracer):
+    """Tracer for OpenTelemetry.
+
+    The trace ID is the W3C ``traceparent`` of the current span, and each
+    callback runs in a consumer span that is a child of the writer's span, so
+    the time between the write and the callback shows in the trace.
+    """
+
+    def __init__(self, tracer_provider: Any = None) -> None:
+        """Initialize the tracer.
+
+        Parameters
+        ----------
+        tracer_provider: opentelemetry.trace.TracerProvider, optional
+            Provider of the tracer. By default, the global provider is used.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if opentelemetry-api is not installed.
+
+        """
+        try:
+            from opentelemetry import trace
+            from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+        except ImportError:
+            raise RuntimeError("opentelemetry-api must be installed to use OpenTelemetryTracer")
+
+        self._tracer = trace.get_tracer(__name__, tracer_provider=tracer_provider)
+        self._propagator = TraceContextTextMapPropagator()
+        self._span_kind = trace.SpanKind.CONSUMER
+
+    def current_trace_id(self) -> Optional[str]:
+        carrier = {}  # type: Dict[str, str]
+        self._propagator.inject(carrier)
+        return carrier.get("traceparent")
+
+    def span(self, evt: Event, callback: Callable) -> ContextManager:
+        context = None
+        if evt.trace_id is not None:
+            context = self._propagator.extract({"traceparent": evt.trace_id})
+
+        attributes = {
+            "pgevents.event_id": str(evt.id),
+            "pgevents.event_type": evt.type,
+            "pgevents.table": "{}.{}".format(evt.schema_name, evt.table_name),
+            "pgevents.row_id": str(evt.row_id),
+        }
+        return self._tracer.start_as_current_span(
+            _callback_name(callback), context=context, kind=self._span_kind, attributes=attributes
+        )
+
+
+class Bulkhead:
+    """Bounded executor that isolates listeners' callbacks from the others.
+
+    Pass a bulkhead to ``listen`` to run the listener's callbacks in its own
+    threads, with an application context each, instead of one after the
+    other in the thread calling ``handle_events``; listeners sharing a
+    bulkhead share its limits. ``handle_events`` does not wait for the
+    callbacks: their events are acknowledged by a later call, once the
+    callbacks return, or after ``timeout`` seconds per callback. Callbacks
+    that overrun the timeout, or that find the bulkhead's queue full, are
+    treated as failed: they are retried if retries are enabled,
+    and raise otherwise. An overrunning callback keeps its thread until it
+    returns, as threads cannot be interrupted.
+
+    Attributes
+    ----------
+    max_concurrency: int
+        Number of callbacks running at once.
+    max_queue: int
+        Number of callbacks waiting for a thread, beyond which more are
+        rejected.
+    timeout: float
+        Number of seconds after which a running callback is abandoned.
+    timeouts: int
+        Number of callbacks that overran the timeout.
+    rejections: int
+        Number of callbacks rejected because the queue was full.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        max_queue: int = DEFAULT_BULKHEAD_QUEUE_SIZE,
+        timeout: float = DEFAULT_BULKHEAD_TIMEOUT,
+    ) -> None:
+        """Initialize the bulkhead.
+
+        Parameters
+        ----------
+        max_concurrency: int
+            Number of callbacks running at once.
+        max_queue: int
+            Number of callbacks waiting for a thread.
+        timeout: float
+            Number of seconds after which a running callback is abandoned.
+
+        Raises
+        ------
+        ValueError
+            Raises if a limit is invalid.
+
+        """
+        if max_concurrency < 1 or max_queue < 0 or timeout is None or timeout <= 0:
+            raise ValueError("Invalid bulkhead limits")
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.timeouts = 0  # type: int
+        self.rejections = 0  # type: int
+
+        self._executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        self._lock = threading.Lock()
+        self._pending = 0  # type: int
+        self._started = {}  # type: Dict[concurrent.futures.Future, List[float]]
+        self._overrunning = set()  # type: Set[concurrent.futures.Future]
+
+    def submit(self, fn: Callable, *args: Any) -> Optional[concurrent.futures.Future]:
+        """Run a function in the bulkhead, unless its queue is full.
+
+        Parameters
+        ----------
+        fn: Callable
+            Function to run.
+        *args: Any
+            Arguments of the function.
+
+        Returns
+        -------
+        concurrent.futures.Future, optional
+            Future of the function's result, or None if it was rejected.
+
+        """
+        with self._lock:
+            if self._pending >= self.max_concurrency + self.max_queue:
+                self.rejections += 1
+                return None
+            self._pending += 1
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.max_concurrency, "pgevents-bulkhead")
+
+        started = []  # type: List[float]
+
+        def run() -> None:
+            started.append(time.monotonic())
+            fn(*args)
+
+        future = self._executor.submit(run)
+        with self._lock:
+            self._started[future] = started
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future: concurrent.futures.Future) -> None:
+        """Free a finished or cancelled function's place in the bulkhead."""
+        with self._lock:
+            self._pending -= 1
+            self._started.pop(future, None)
+            self._overrunning.discard(future)
+
+    def get_deadline(self, future: concurrent.futures.Future) -> Optional[float]:
+        """Get the time at which a running function overruns the timeout.
+
+        Parameters
+        ----------
+        future: concurrent.futures.Future
+            Future of the function.
+
+        Returns
+        -------
+        float, optional
+            Deadline, as returned by ``time.monotonic``, or None if the
+            function has not started.
+
+        """
+        with self._lock:
+            started = self._started.get(future)
+        if not started:
+            return None
+        return started[0] + self.timeout
+
+    def overrun(self, future: concurrent.futures.Future) -> None:
+        """Abandon a function that overran the timeout.
+
+        Parameters
+        ----------
+        future: concurrent.futures.Future
+            Future of the function.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self.timeouts += 1
+            if not future.done():
+                self._overrunning.add(future)
+
+    @property
+    def wedged(self) -> bool:
+        """Whether all threads are taken by abandoned functions, so that queued ones cannot start."""
+        with self._lock:
+            return len(self._overrunning) >= self.max_concurrency
+
+    def shutdown(self) -> None:
+        """Stop the threads once their functions return; they are started again when needed.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            (executor, self._executor) = (self._executor, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+class Aggregate:
+    """Counts and sums of a model's rows, grouped by columns, maintained from events.
+
+    Created by ``PGEvents.aggregate``. The initial results are computed with
+    one ``GROUP BY`` query, and then updated from the row data captured by
+    insert, update and delete events.
+    """
+
+    def __init__(self, group_by: List[Any], count: bool, sums: List[Any]) -> None:
+        """Initialize the aggregate.
+
+        Parameters
+        ----------
+        group_by: list
+            Columns by which rows are grouped.
+        count: bool
+            Whether or not to count the rows of each group.
+        sums: list
+            Columns to sum for each group.
+
+        """
+        self._group_by = group_by
+        self._count = count
+        self._sums = sums
+
+        self._groups = {}  # type: Dict[Any, Dict]
+        self._lock = threading.Lock()
+
+    @property
+    def columns(self) -> List[Any]:
+        """Columns whose values events must capture.
+
+        Returns
+        -------
+        list
+            Group and sum columns.
+
+        """
+        return self._group_by + self._sums
+
+    @property
+    def query(self) -> Any:
+        """Query computing the results from scratch.
+
+        Returns
+        -------
+        sqlalchemy.sql.Select
+            ``GROUP BY`` query selecting the group columns, count, and sums.
+
+        """
+        columns = self._group_by + [func.count()] + [func.sum(column) for column in self._sums]
+        return sqlalchemy_select(columns).group_by(*self._group_by)
+
+    @property
+    def results(self) -> Dict[Any, Dict]:
+        """Current results, by group.
+
+        Returns
+        -------
+        dict
+            Results by group key: the value of the group column, a tuple of the
+            values of several group columns, or None without group columns.
+            Each result has the group's row "count" (if counted) and a "sum"
+            dictionary of totals by column name.
+
+        """
+        results = {}
+        with self._lock:
+            for (key, group) in self._groups.items():
+                results[key] = {"sum": dict(group["sum"])}
+                if self._count:
+                    results[key]["count"] = group["count"]
+        return results
+
+    def load(self, rows: Iterable[Tuple]) -> None:
+        """Set the results from the rows of a ``GROUP BY`` query.
+
+        Parameters
+        ----------
+        rows: iterable
+            Rows of group column values, count, and sums, in that order.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self._groups = {}
+            for row in rows:
+                row = tuple(row)
+                (group_end, sums_start) = (len(self._group_by), len(self._group_by) + 1)
+                sums = dict(zip((column.name for column in self._sums), row[sums_start:]))
+                self._groups[self._key(row[:group_end])] = {"count": row[group_end], "sum": sums}
+
+    def apply(self, event_id: UUID, row_id: Any, identifier: str, data: Optional[Dict]) -> None:
+        """Update the results for a row change; called for the model's events.
+
+        Parameters
+        ----------
+        event_id: UUID
+            Event UUID.
+        row_id: Any
+            Row ID of the event.
+        identifier: str
+            PostGreSQL event type.
+        data: dict, optional
+            Captured row data, with the "new" and "old" rows.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the event's row data was too large to be captured.
+
+        Returns
+        -------
+        None
+
+        """
+        data = data or {}
+        if data.get("truncated"):
+            raise RuntimeError("Row data of event {} was too large to capture".format(event_id))
+
+        with self._lock:
+            if data.get("old") is not None:
+                self._add(data["old"], -1)
+            if data.get("new") is not None:
+                self._add(data["new"], 1)
+
+    def _add(self, row: Dict, sign: int) -> None:
+        key = self._key(self._coerce(column, row.get(column.name)) for column in self._group_by)
+        group = self._groups.setdefault(key, {"count": 0, "sum": {column.name: None for column in self._sums}})
+
+        group["count"] += sign
+        for column in self._sums:
+            value = self._coerce(column, row.get(column.name))
+            if value is not None:
+                group["sum"][column.name] = (group["sum"][column.name] or 0) + sign * value
+
+        if group["count"] <= 0:
+            del self._groups[key]
+
+    def _key(self, values: Iterable[Any]) -> Any:
+        values = tuple(values)
+        if not values:
+            return None
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    @staticmethod
+    def _coerce(column: Any, value: Any) -> Any:
+        """Convert a captured JSON value to the column's Python type, as the initial query returns it.
+
+        Parameters
+        ----------
+        column: sqlalchemy.Column
+            Column of the value.
+        value: Any
+            Captured value.
+
+        Returns
+        -------
+        Any
+            Value as the column's Python type.
+
+        """
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = None
+
+        if value is None or (python_type is not None and isinstance(value, python_type)):
+            return value
+        if python_type in (int, float, Decimal):
+            return python_type(str(value))
+        if python_type in (date, datetime, datetime_time):
+            return _from_isoformat(python_type, value)
+
+        # e.g. UUIDs and enums
+        processor = column.type.result_processor(POSTGRESQL_DIALECT, None)
+        return value if processor is None else processor(value)
+
+
+class Deduplicator:
+    """Bounded-memory record of received events, to suppress redelivered ones.
+
+    The IDs of the last ``size`` events are kept in a set. Events of sources
+    whose positions increase in delivery order within a table partition are
+    also compared with a watermark per partition: the highest position
+    evicted from the set. An event at or below the watermark was then already
+    received, however long ago. Other sources (e.g. logical replication,
+    whose LSNs interleave between transactions) rely on the set alone.
+    """
+
+    def __init__(self, size: int, ordered_positions: bool = False) -> None:
+        """Initialize the record.
+
+        Parameters
+        ----------
+        size: int
+            Number of event IDs to keep.
+        ordered_positions: bool
+            Whether positions increase in delivery order within a table
+            partition, so that the watermark applies (default: False).
+
+        """
+        self._size = size
+        self._ordered_positions = ordered_positions
+        self._events = OrderedDict()  # type: OrderedDict
+        self._watermarks = {}  # type: Dict[Tuple[str, str, Optional[int]], int]
+        self.suppressed = 0  # type: int
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def seen(self, evt: Event) -> bool:
+        """Record an event, and tell whether it was already received.
+
+        Parameters
+        ----------
+        evt: Event
+            Received event.
+
+        Returns
+        -------
+        bool
+            Whether the event is a duplicate.
+
+        """
+        stream = (evt.schema_name, evt.table_name, evt.partition)
+        watermark = self._watermarks.get(stream)
+        if evt.id in self._events or (evt.position is not None and watermark is not None and evt.position <= watermark):
+            self.suppressed += 1
+            return True
+
+        self._events[evt.id] = (stream, evt.position)
+        if len(self._events) > self._size:
+            (_, (stream, position)) = self._events.popitem(last=False)
+            if position is not None and self._ordered_positions:
+                self._watermarks[stream] = max(position, self._watermarks.get(stream, position))
+
+        return False
+
+
+class AdaptiveController:
+    """Tuner of the poll timeout, fetch size and dispatch budget of ``handle_events``.
+
+    Each ``handle_events`` call is observed: the number of events received,
+    the time their callbacks took, and the number of events left queued in
+    the lanes. The arrival rate and the latency per event are smoothed by
+    exponentially weighted moving averages, from which the settings are
+    chosen within the target lag:
+
+    - the poll timeout is 0 while events are queued, so that a backlog is not
+      waited on, and the caller's timeout otherwise;
+    - the fetch size fits the events expected to arrive within the target
+      lag, so that a backlog is read in few round trips and idle reads stay
+      small;
+    - the dispatch budget fits the callbacks that run within half the target
+      lag, so that each call returns to poll and acknowledge in time.
+
+    Attributes
+    ----------
+    target_lag: float
+        Number of seconds within which events should be handled.
+    arrival_rate: float
+        Smoothed number of events received per second.
+    latency: float, optional
+        Smoothed number of seconds taken to handle an event, once observed.
+    queue_depth: int
+        Number of events left queued by the last call.
+    poll_timeout: float
+        Number of seconds the last call blocked at most when polling.
+    fetch_size: int
+        Maximum number of events read at once.
+    dispatch_budget: int, optional
+        Maximum number of events dispatched per call, once the latency is
+        observed.
+    """
+
+    def __init__(self, target_lag: float, max_size: int) -> None:
+        """Initialize the controller.
+
+        Parameters
+        ----------
+        target_lag: float
+            Number of seconds within which events should be handled.
+        max_size: int
+            Upper bound of the fetch size and dispatch budget, e.g. the lane
+            capacity.
+
+        Raises
+        ------
+        ValueError
+            Raises if a bound is invalid.
+
+        """
+        if target_lag <= 0 or max_size < 1:
+            raise ValueError("Invalid adaptive controller bounds")
+
+        self.target_lag = target_lag
+        self.arrival_rate = 0.0  # type: float
+        self.latency = None  # type: Optional[float]
+        self.queue_depth = 0  # type: int
+        self.poll_timeout = 0.0  # type: float
+        self.fetch_size = min(ADAPTIVE_MIN_FETCH_SIZE, max_size)  # type: int
+        self.dispatch_budget = None  # type: Optional[int]
+
+        self._max_size = max_size
+        self._arrivals = 0  # type: int
+        self._polled_at = None  # type: Optional[float]
+        self._observed_at = time.monotonic()  # type: float
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Current settings and observations, e.g. to graph them.
+
+        Returns
+        -------
+        dict
+            Poll timeout in seconds, fetch size, dispatch budget, arrival rate
+            in events per second, latency per event, queue depth, estimated
+            lag of the queued events and target lag, in milliseconds.
+
+        """
+        latency = self.latency or 0.0
+        return {
+            "poll_timeout": self.poll_timeout,
+            "fetch_size": self.fetch_size,
+            "dispatch_budget": self.dispatch_budget,
+            "arrival_rate": self.arrival_rate,
+            "latency_ms": latency * 1000,
+            "queue_depth": self.queue_depth,
+            "lag_ms": self.queue_depth * latency * 1000,
+            "target_lag_ms": self.target_lag * 1000,
+        }
+
+    def get_timeout(self, timeout: float, queued: bool) -> float:
+        """Choose how long a call blocks when polling.
+
+        Parameters
+        ----------
+        timeout: float
+            Number of seconds the caller allows the call to block.
+        queued: bool
+            Whether events are queued in the lanes.
+
+        Returns
+        -------
+        float
+            Number of seconds to block.
+
+        """
+        self.poll_timeout = 0.0 if queued else timeout
+        return self.poll_timeout
+
+    def arrived(self, count: int) -> None:
+        """Record the events received by a poll; the callbacks are timed from now.
+
+        Parameters
+        ----------
+        count: int
+            Number of events received.
+
+        Returns
+        -------
+        None
+
+        """
+        self._arrivals += count
+        self._polled_at = time.monotonic()
+
+    def observe(self, dispatched: int, depth: int) -> None:
+        """Record the outcome of a call, and choose the next settings.
+
+        Parameters
+        ----------
+        dispatched: int
+            Number of events dispatched since the last poll.
+        depth: int
+            Number of events left queued in the lanes.
+
+        Returns
+        -------
+        None
+
+        """
+        now = time.monotonic()
+        if now > self._observed_at:
+            self.arrival_rate = self._smooth(self.arrival_rate, self._arrivals / (now - self._observed_at))
+        if dispatched and self._polled_at is not None:
+            latency = (now - self._polled_at) / dispatched
+            self.latency = latency if self.latency is None else self._smooth(self.latency, latency)
+        (self._arrivals, self._observed_at, self.queue_depth) = (0, now, depth)
+
+        self.fetch_size = self._clamp(math.ceil(self.arrival_rate * self.target_lag), ADAPTIVE_MIN_FETCH_SIZE)
+        if self.latency:
+            self.dispatch_budget = self._clamp(int(self.target_lag / 2 / self.latency), 1)
+
+    @staticmethod
+    def _smooth(average: float, value: float) -> float:
+        return average + ADAPTIVE_SMOOTHING * (value - average)
+
+    def _clamp(self, value: int, lower: int) -> int:
+        return max(min(value, self._max_size), min(lower, self._max_size))
+
+
+class ModelCache:
+    """Least-recently-used cache of model instances, keyed by primary key.
+
+    Created by ``PGEvents.cached``. Misses are fetched from the database in
+    bulk, and cached rows are invalidated when update or delete events for
+    them are handled, so the cache is as fresh as the application's event
+    handling. Cached instances are detached from the session; only their
+    column attributes are available.
+    """
+
+    def __init__(self, pgevents: "PGEvents", model: Model, maxsize: int, ttl: Optional[float]) -> None:
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        pgevents: PGEvents
+            Extension whose engine is used to fetch rows.
+        model: flask_sqlalchemy.model.Model
+            Model whose instances to cache.
+        maxsize: int
+            Maximum number of cached instances.
+        ttl: float, optional
+            Number of seconds after which a cached instance expires, in case
+            an event is missed. By default, instances only leave the cache
+            when invalidated or evicted.
+
+        """
+        self._pgevents = pgevents
+        self._model = model
+        self._maxsize = maxsize
+        self._ttl = ttl
+
+        (self._primary_key,) = sqlalchemy_inspect(model).primary_key
+
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._generation = 0  # type: int
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Optional[Model]:
+        """Get an instance by primary key.
+
+        Parameters
+        ----------
+        key: Any
+            Primary key of the instance.
+
+        Returns
+        -------
+        flask_sqlalchemy.model.Model, optional
+            Instance with the given primary key, or None if there is none.
+
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[Any]) -> Dict[Any, Model]:
+        """Get instances by primary key, fetching all misses with one query.
+
+        Parameters
+        ----------
+        keys: iterable
+            Primary keys of the instances.
+
+        Returns
+        -------
+        dict
+            Instances by primary key. Keys without a row are left out.
+
+        """
+        now = time.monotonic()
+        found = {}
+        missing = []
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(str(key))
+                if entry is None or (entry[1] is not None and entry[1] <= now):
+                    missing.append(key)
+                else:
+                    self._entries.move_to_end(str(key))
+                    found[key] = entry[0]
+            generation = self._generation
+
+        if missing:
+            # A private session, so that fetched instances are not shared with
+            # the application's session once detached
+            session = Session(bind=self._pgevents._get_engine())
+            try:
+                instances = session.query(self._model).filter(self._primary_key.in_(missing)).all()
+            finally:
+                session.close()
+            fetched = {str(getattr(instance, self._primary_key.key)): instance for instance in instances}
+
+            expires_at = None if self._ttl is None else now + self._ttl
+            with self._lock:
+                # Don't cache rows that may have changed while being fetched
+                cache = generation == self._generation
+                for key in missing:
+                    instance = fetched.get(str(key))
+                    if instance is None:
+                        continue
+                    found[key] = instance
+                    if cache:
+                        self._entries[str(key)] = (instance, expires_at)
+                        self._entries.move_to_end(str(key))
+                while len(self._entries) > self._maxsize:
+                    self._entries.popitem(last=False)
+
+        return found
+
+    def invalidate(self, event_id: UUID, row_id: Any, identifier: str) -> None:
+        """Remove a changed row from the cache; called for update and delete events.
+
+        Parameters
+        ----------
+        event_id: UUID
+            Event UUID.
+        row_id: Any
+            Primary key of the changed row.
+        identifier: str
+            PostGreSQL event type.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(str(row_id), None)
+
+    def clear(self) -> None:
+        """Remove all instances from the cache.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+# Extension of a replay worker process, inherited from the parent process
+_replay_pgevents = None  # type: Optional[PGEvents]
+
+
+def _init_replay_worker(pgevents: "PGEvents") -> None:
+    """Initialize a replay worker process.
+
+    Parameters
+    ----------
+    pgevents: PGEvents
+        Extension whose listeners the worker calls.
+
+    Returns
+    -------
+    None
+
+    """
+    global _replay_pgevents
+    _replay_pgevents = pgevents
+
+
+def _replay_range(task: Tuple[int, int, Optional[str], Optional[str], int]) -> int:
+    """Replay a range of events in a replay worker process.
+
+    Parameters
+    ----------
+    task: tuple
+        Arguments of ``PGEvents._replay_range``.
+
+    Returns
+    -------
+    int
+        Number of replayed events.
+
+    """
+    return _replay_pgevents._replay_range(*task)  # type: ignore
+
+
+class PGEvents:
+    """PGEvents extension.
+
+    Attributes
+    ----------
+    extension_name: str
+        Key under which the extension is registered in ``app.extensions``.
+    event_source_config: str
+        Configuration variable that selects the event source.
+    drop_orphaned_triggers_config: str, optional
+        Configuration variable that enables dropping orphaned triggers on
+        initialization, if supported.
+    """
+
+    extension_name = "pgevents"
+    event_source_config = "PGEVENTS_EVENT_SOURCE"
+    drop_orphaned_triggers_config = "PGEVENTS_DROP_ORPHANED_TRIGGERS"  # type: Optional[str]
+
+    def __init__(self, app: Optional[Flask] = None) -> None:
+        """Initialize the extension.
+
+        Parameters
+        ----------
+        app: Flask, optional
+            The application to which this extension will be registered.
+
+        """
+        self._app = None  # type: Optional[Flask]
+        self._connection = None  # type: Optional[SQLAlchemyConnection]
+        self._psycopg2_connection = None  # type: Optional[Psycopg2Connection]
+        self._event_source = None  # type: Optional[EventSource]
+        self._triggers = defaultdict(list)  # type: dict
+        self._pattern_triggers = defaultdict(list)  # type: Dict[Tuple[str, str], List[Trigger]]
+        self._pattern_regexes = {}  # type: Dict[Tuple[str, str], Tuple[Any, Any]]
+        self._pattern_matches = {}  # type: Dict[str, List[Trigger]]
+        self._batch_session = False  # type: bool
+        self._cycle_session = None  # type: Optional[Session]
+        self._orm_hooked = False  # type: bool
+        self._orm_events = defaultdict(set)  # type: Dict[Callable, Set[str]]
+        self._gevent_pool = None  # type: Optional[Any]
+        self._previous_wait_callback = None  # type: Optional[Callable]
+        self._greenlets = []  # type: List[Tuple[Event, Trigger, int, Any]]
+        self._bulkhead_calls = []  # type: List[Tuple[Event, Trigger, int, Optional[concurrent.futures.Future]]]
+        self._bulkhead_events = []  # type: List[Event]
+        self._ack_batch_size = DEFAULT_ACK_BATCH_SIZE  # type: int
+        self._ack_interval = DEFAULT_ACK_INTERVAL  # type: float
+        self._acks = []  # type: List[Event]
+        self._acked_at = 0.0  # type: float
+        self._retry_attempts = 0  # type: int
+        self._retry_backoff = DEFAULT_RETRY_BACKOFF  # type: float
+        self._retry_max_backoff = DEFAULT_RETRY_MAX_BACKOFF  # type: float
+        self._retries = []  # type: List[Tuple[float, int, Any, Trigger, int]]
+        self._retry_counter = itertools.count()
+        self._streamed_tables = {}  # type: Dict[str, Model]
+        self._tracer = None  # type: Optional[Tracer]
+        self._partitions = {}  # type: Dict[str, Set[int]]
+        self._rebalance_interval = DEFAULT_REBALANCE_INTERVAL  # type: float
+        self._rebalanced_at = 0.0  # type: float
+        self._lane_capacity = DEFAULT_LANE_CAPACITY  # type: int
+        self._lane_budget = None  # type: Optional[int]
+        self._lanes = defaultdict(deque)  # type: Dict[int, deque]
+        self._lane_credits = defaultdict(int)  # type: Dict[int, int]
+        self._received = deque()  # type: deque
+        self._entries = {}  # type: Dict[int, List]
+        self._ack_halted = False  # type: bool
+        self._deduplicator = None  # type: Optional[Deduplicator]
+        self._groups = {}  # type: Dict[Tuple[int, Any], Tuple[Trigger, List[Event]]]
+        self._open_txid = None  # type: Optional[int]
+        self._controller = None  # type: Optional[AdaptiveController]
+        self._initialized = False  # type: bool
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Initialize the extension against an application.
+
+        Parameters
+        ----------
+        app: Flask
+            The application to which this extension will be registered.
+
+        Returns
+        -------
+        None
+
+        """
+        self._app = app
+
+        if "sqlalchemy" not in app.extensions:
+            raise RuntimeError("This extension must be initialized after Flask-SQLAlchemy")
+
+        event_source = app.config.get(self.event_source_config, DEFAULT_EVENT_SOURCE)
+        if event_source not in EVENT_SOURCES:
+            raise ValueError("Invalid event source: {}".format(event_source))
+
+        if EVENT_SOURCES[event_source].requires_connection:
+            self._setup_conection()
+
+        self._batch_session = app.config.get("PGEVENTS_BATCH_SESSION", False)
+        self._ack_batch_size = app.config.get("PGEVENTS_ACK_BATCH_SIZE", DEFAULT_ACK_BATCH_SIZE)
+        self._ack_interval = app.config.get("PGEVENTS_ACK_INTERVAL", DEFAULT_ACK_INTERVAL)
+        self._lane_capacity = app.config.get("PGEVENTS_LANE_CAPACITY", DEFAULT_LANE_CAPACITY)
+        self._lane_budget = app.config.get("PGEVENTS_LANE_BUDGET")
+        self._rebalance_interval = app.config.get("PGEVENTS_REBALANCE_INTERVAL", DEFAULT_REBALANCE_INTERVAL)
+
+        if app.config.get("PGEVENTS_DEDUP_SIZE", 0):
+            ordered_positions = EVENT_SOURCES[event_source].ordered_positions
+            self._deduplicator = Deduplicator(app.config["PGEVENTS_DEDUP_SIZE"], ordered_positions)
+
+        if app.config.get("PGEVENTS_ADAPTIVE", False):
+            target_lag = app.config.get("PGEVENTS_TARGET_LAG_MS", DEFAULT_TARGET_LAG_MS) / 1000
+            self._controller = AdaptiveController(target_lag, self._lane_capacity)
+
+        if app.config.get("PGEVENTS_GEVENT", False):
+            self._setup_gevent(app)
+        self._validate_bulkheads(itertools.chain.from_iterable(self._triggers.values()))
+        self._validate_bulkheads(itertools.chain.from_iterable(self._pattern_triggers.values()))
+
+        if app.config.get("PGEVENTS_RETRY_ATTEMPTS", 0):
+            self._setup_retries(app)
+
+        self._tracer = app.config.get("PGEVENTS_TRACER")
+        if self._tracer is not None:
+            sqlalchemy_event.listen(self.session, "after_begin", self._set_trace_id)
+
+        # Initialize psycopg2-pgevents
+        pgevents_debug = app.config.get("PSYCOPG2_PGEVENTS_DEBUG", False)
+        pgevts.set_debug(pgevents_debug)
+
+        self._event_source = EVENT_SOURCES[event_source](self)
+        self._event_source.setup()
+
+        self._install_deferred_triggers()
+        if app.config.get(self.drop_orphaned_triggers_config or "", False):
+            self.drop_orphaned_triggers()
+
+        self._event_source.start()
+        self._acked_at = time.monotonic()
+        self._rebalance()
+
+        app.extensions[self.extension_name] = self
+        app.cli.add_command(cli)
+
+        self._initialized = True
+
+        atexit.register(self.teardown)
+
+    def _install_deferred_triggers(self) -> None:
+        """Install the triggers registered before initialization, once per table.
+
+        Returns
+        -------
+        None
+
+        """
+        for table_triggers in self._triggers.values():
+            deferred = [trigger_ for trigger_ in table_triggers if not trigger_.installed]
+            if deferred:
+                self._install_trigger(deferred[0])
+                for trigger_ in deferred:
+                    trigger_.installed = True
+
+        for (pattern, pattern_triggers) in self._pattern_triggers.items():
+            if not all(trigger_.installed for trigger_ in pattern_triggers):
+                self._install_pattern(pattern)
+                for trigger_ in pattern_triggers:
+                    trigger_.installed = True
+
+    def teardown(self) -> None:
+        """Teardown the extension.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._initialized:
+            # The events of pending retries were acknowledged with their first
+            # attempt, so they are dead-lettered rather than lost
+            while self._retries:
+                (_, _, evt, trig, attempt) = heapq.heappop(self._retries)
+                self._dead_letter(evt, trig, attempt - 1, "Retry pending at teardown")
+
+            self._flush_acks()
+            # The events of callbacks still running in bulkheads are not
+            # acknowledged, so they are delivered again
+            (self._bulkhead_calls, self._bulkhead_events) = ([], [])
+            self._ack_halted = False
+            # The connection may outlive the extension in the engine's pool
+            for table in list(self._partitions):
+                self._leave_partitions(table)
+            self._event_source.teardown()  # type: ignore
+            self._event_source = None
+
+            self._teardown_connection()
+
+            if self._gevent_pool is not None:
+                # Another library (e.g. psycogreen) may have set its own
+                psycopg2.extensions.set_wait_callback(self._previous_wait_callback)
+                self._previous_wait_callback = None
+                self._gevent_pool = None
+
+            triggers = itertools.chain(*self._triggers.values(), *self._pattern_triggers.values())
+            for trig in triggers:
+                if trig.bulkhead is not None:
+                    trig.bulkhead.shutdown()
+        self._initialized = False
+
+    def _setup_gevent(self, app: Flask) -> None:
+        """Set up cooperative waiting and dispatching for gevent.
+
+        In gevent mode, psycopg2 waits on sockets cooperatively (through a
+        process-wide wait callback), ``handle_events`` waits for events with
+        gevent's ``wait_read`` instead of blocking the worker, and callbacks
+        are dispatched concurrently in a bounded greenlet pool. This allows a
+        gevent worker to serve requests while consuming events.
+
+        Configuration
+        -------------
+        PGEVENTS_GEVENT: bool
+            Whether or not to enable gevent mode (default: False).
+        PGEVENTS_GEVENT_POOL_SIZE: int
+            Maximum number of concurrently running callbacks (default: 10).
+
+        Parameters
+        ----------
+        app: Flask
+            The application to which this extension will be registered.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if gevent is not installed.
+        ValueError
+            Raises if batch sessions are enabled, since a session cannot be
+            shared between greenlets.
+
+        Returns
+        -------
+        None
+
+        """
+        try:
+            from gevent.pool import Pool
+        except ImportError:
+            raise RuntimeError("gevent must be installed to use PGEVENTS_GEVENT")
+
+        if self._batch_session:
+            raise ValueError("PGEVENTS_GEVENT cannot be used with PGEVENTS_BATCH_SESSION")
+
+        self._previous_wait_callback = psycopg2.extensions.get_wait_callback()
+        psycopg2.extensions.set_wait_callback(_gevent_wait_callback)
+        self._gevent_pool = Pool(app.config.get("PGEVENTS_GEVENT_POOL_SIZE", DEFAULT_GEVENT_POOL_SIZE))
+
+    def _setup_retries(self, app: Flask) -> None:
+        """Set up retries of failed callbacks.
+
+        With retries enabled, an exception raised by a callback no longer
+        escapes ``handle_events``. Instead, the callback is called again for
+        the same event after an exponentially increasing delay, from an
+        in-process timer heap that is serviced by ``handle_events``. Once all
+        attempts have failed, the event is recorded in the
+        ``public.flask_sqlalchemy_pgevents_dead_letter`` table, from which it
+        may be replayed with ``replay_dead_letters``.
+
+        Configuration
+        -------------
+        PGEVENTS_RETRY_ATTEMPTS: int
+            Number of times a callback is called for an event before the event
+            is dead-lettered (default: 0, which disables retries).
+        PGEVENTS_RETRY_BACKOFF: float
+            Seconds before the first retry; each later retry waits twice as
+            long (default: 0.1).
+        PGEVENTS_RETRY_MAX_BACKOFF: float
+            Maximum number of seconds between retries (default: 60.0).
+
+        Parameters
+        ----------
+        app: Flask
+            The application to which this extension will be registered.
+
+        Returns
+        -------
+        None
+
+        """
+        self._retry_attempts = app.config["PGEVENTS_RETRY_ATTEMPTS"]
+        self._retry_backoff = app.config.get("PGEVENTS_RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)
+        self._retry_max_backoff = app.config.get("PGEVENTS_RETRY_MAX_BACKOFF", DEFAULT_RETRY_MAX_BACKOFF)
+
+        self._execute(INSTALL_DEAD_LETTER_TABLE_STATEMENT)
+
+    def _get_engine(self) -> Any:
+        """Get the application's SQLAlchemy engine.
+
+        Returns
+        -------
+        sqlalchemy.engine.Engine
+            Engine of the application's Flask-SQLAlchemy extension.
+
+        """
+        return self._app.extensions["sqlalchemy"].db.get_engine(self._app)  # type: ignore
+
+    def _execute(self, statement: str, **params: Any) -> List[Tuple]:
+        """Execute a statement in its own transaction, on the application's engine.
+
+        Unlike the event source's connection, the engine is available with
+        every event source.
+
+        Parameters
+        ----------
+        statement: str
+            SQL statement to run against the database.
+        params: Any
+            Statement parameters.
+
+        Returns
+        -------
+        list
+            Rows returned by the statement, if any.
+
+        """
+        with self._get_engine().begin() as connection:
+            result = connection.execute(text(statement), **params)
+            return result.fetchall() if result.returns_rows else []
+
+    def _wait_read(self, fileobj: Any, timeout: float) -> bool:
+        """Wait for a file-like object to become readable.
+
+        Parameters
+        ----------
+        fileobj: Any
+            Object with a ``fileno()`` method.
+        timeout: float
+            Number of seconds to wait.
+
+        Returns
+        -------
+        bool
+            Whether or not the object is readable.
+
+        """
+        if self._gevent_pool is None:
+            return select.select([fileobj], [], [], timeout) != ([], [], [])
+
+        from gevent.socket import wait_read
+
+        try:
+            wait_read(fileobj.fileno(), timeout=timeout)
+        except socket.timeout:
+            return False
+        return True
+
+    def _sleep(self, seconds: float) -> None:
+        """Sleep, yielding to other greenlets in gevent mode.
+
+        Parameters
+        ----------
+        seconds: float
+            Number of seconds to sleep.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._gevent_pool is None:
+            time.sleep(seconds)
+        else:
+            import gevent
+
+            gevent.sleep(seconds)
+
+    def _setup_conection(self) -> None:
+        """Set up the database connection.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._app.app_context():  # type: ignore
+            flask_sqlalchemy = self._app.extensions["sqlalchemy"]  # type: ignore
+            self._connection = flask_sqlalchemy.db.engine.connect()
+            connection_proxy = self._connection.connection
+            self._psycopg2_connection = connection_proxy.connection
+
+    @property
+    def event_source(self) -> Optional[EventSource]:
+        """Event source from which events are received, once initialized.
+
+        Returns
+        -------
+        EventSource, optional
+            Event source selected by ``PGEVENTS_EVENT_SOURCE``.
+
+        """
+        return self._event_source
+
+    @property
+    def session(self) -> Session:
+        """Flask-SQLAlchemy session shared by callbacks.
+
+        When ``PGEVENTS_BATCH_SESSION`` is enabled, ``handle_events`` creates a
+        dedicated session per poll cycle, so every callback in the cycle
+        shares this session, and commits it once at the end of the cycle.
+        Each callback runs inside its own savepoint, so a failing callback's
+        changes are rolled back without affecting the others. Callbacks should
+        therefore flush, but not commit, the session.
+
+        Returns
+        -------
+        sqlalchemy.orm.Session
+            Session of the current poll cycle, or otherwise the scoped session
+            of the application's Flask-SQLAlchemy extension.
+
+        """
+        if self._cycle_session is not None:
+            return self._cycle_session
+
+        return self._app.extensions["sqlalchemy"].db.session  # type: ignore
+
+    def _teardown_connection(self) -> None:
+        """Teardown the database connection.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._connection is not None:
+            with self._app.app_context():  # type: ignore
+                self._psycopg2_connection = None
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _get_full_table_name(model: Model) -> str:
+        """Parse the SQLAlchemy model for the fully-resolved table name.
+
+        Parameters
+        ----------
+        model: flask_sqlalchemy.model.Model
+            Model whose name should be resolved.
+
+        Returns
+        -------
+        str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        """
+        table_args = getattr(model, "__table_args__", {})
+        schema_name = table_args.get("schema", "public")
+        table_name = model.__tablename__
+
+        return "{schema}.{table}".format(schema=schema_name, table=table_name)
+
+    def _install_trigger_for_model(self, model: Model) -> None:
+        """Install a trigger for the given model.
+
+        Parameters
+        ----------
+        model: flask_sqlalchemy.model.Model
+            Model to which a trigger should be installed.
+
+        Returns
+        -------
+        None
+
+        """
+        table = self._get_full_table_name(model)
+        (schema_name, table_name) = table.split(".")
+
+        capture = self._get_table_capture(table)
+        self._event_source.install(table_name, schema_name, capture, self._get_table_partition(table))  # type: ignore
+
+    def _get_table_partition(self, table: str) -> Optional[Tuple[str, int]]:
+        """Get the partition key column and number of partitions of a table.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        tuple, optional
+            Partition specification shared by all triggers of the table, or
+            None if the table is not partitioned.
+
+        """
+        table_triggers = self._triggers.get(table)
+        return table_triggers[0].partition if table_triggers else None
+
+    def _get_table_capture(self, table: str) -> Any:
+        """Combine the row data captured by all triggers of a table.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        None, str, or tuple
+            Capture specification that satisfies every trigger of the table.
+
+        """
+        capture = None
+        for trigger_ in self._get_triggers(table):
+            capture = _merge_capture(capture, trigger_.capture)
+        return capture
+
+    def _get_triggers(self, table: str) -> List[Trigger]:
+        """Get the triggers of a table, including those of the patterns it matches.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        list
+            Triggers of the table.
+
+        """
+        if not self._pattern_triggers:
+            return self._triggers.get(table, [])
+        return self._triggers.get(table, []) + self._get_pattern_triggers(table)
+
+    def _get_pattern_triggers(self, table: str) -> List[Trigger]:
+        """Get the triggers of the patterns a table matches.
+
+        Patterns are compiled once, and the triggers matching each table are
+        remembered until patterns change, so that dispatching an event does
+        not scan the patterns.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        list
+            Triggers of the matching patterns.
+
+        """
+        matches = self._pattern_matches.get(table)
+        if matches is None:
+            (schema_name, table_name) = table.split(".")
+            matches = [
+                trigger_
+                for (pattern, (schema_regex, table_regex)) in self._pattern_regexes.items()
+                if schema_regex.match(schema_name) and table_regex.match(table_name)
+                for trigger_ in self._pattern_triggers[pattern]
+            ]
+            self._pattern_matches[table] = matches
+        return matches
+
+    def _install_trigger(self, trigger_: Trigger) -> None:
+        """Make a trigger's target produce events, according to its mode.
+
+        Parameters
+        ----------
+        trigger_: Trigger
+            Trigger to install.
+
+        Returns
+        -------
+        None
+
+        """
+        if trigger_.mode == "orm":
+            self._hook_orm_session()
+            (schema_name, table_name) = self._get_full_table_name(trigger_.target).split(".")
+            source = self._event_source
+            assert source is not None
+            source.subscribe(table_name, schema_name)
+        else:
+            self._install_trigger_for_model(trigger_.target)
+
+    def _hook_orm_session(self) -> None:
+        """Hook the application's session so that it emits events for "orm" mode triggers.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._orm_hooked:
+            return
+
+        self._listen_orm_events(self.session)
+        self._orm_hooked = True
+
+    def _listen_orm_events(self, session: Session) -> None:
+        """Collect a session's changes, and emit them as events when it commits.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Session to hook.
+
+        Returns
+        -------
+        None
+
+        """
+        sqlalchemy_event.listen(session, "after_flush", self._collect_orm_events)
+        sqlalchemy_event.listen(session, "before_commit", self._emit_orm_events)
+        sqlalchemy_event.listen(session, "after_transaction_create", self._mark_orm_events)
+        sqlalchemy_event.listen(session, "after_soft_rollback", self._discard_orm_events)
+
+    def _create_cycle_session(self) -> Session:
+        """Create the session shared by the callbacks of a poll cycle in batch mode.
+
+        The session is dedicated to the cycle, so that committing it never
+        commits work the application left pending in its own scoped session.
+
+        Returns
+        -------
+        sqlalchemy.orm.Session
+            New session, hooked like the application's session.
+
+        """
+        session = Session(bind=self._get_engine())
+        if self._tracer is not None:
+            sqlalchemy_event.listen(session, "after_begin", self._set_trace_id)
+        if self._orm_hooked:
+            self._listen_orm_events(session)
+
+        return session
+
+    def _set_trace_id(self, session: Session, transaction: Any, connection: SQLAlchemyConnection) -> None:
+        """Record the current request's trace ID in the events of a new transaction.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Application session that began a transaction.
+        transaction: sqlalchemy.orm.SessionTransaction
+            Transaction that began.
+        connection: sqlalchemy.engine.base.Connection
+            Connection of the transaction.
+
+        Returns
+        -------
+        None
+
+        """
+        # Only PostgreSQL has the setting; other databases are used for tests
+        if not has_request_context() or connection.dialect.name != "postgresql":
+            return
+
+        trace_id = self._tracer.current_trace_id()  # type: ignore
+        if trace_id is not None:
+            connection.execute(text(SET_TRACE_ID_STATEMENT), trace_id=trace_id)
+
+    def _collect_orm_events(self, session: Session, flush_context: Any) -> None:
+        """Collect events for the instances changed by a flush.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Session that was flushed.
+        flush_context: sqlalchemy.orm.unitofwork.UOWTransaction
+            Flush context (unused).
+
+        Returns
+        -------
+        None
+
+        """
+        changes = (
+            ("INSERT", session.new),
+            ("UPDATE", (instance for instance in session.dirty if session.is_modified(instance))),
+            ("DELETE", session.deleted),
+        )
+
+        pending = session.info.setdefault("pgevents", [])
+        for (event_type, instances) in changes:
+            for instance in instances:
+                if event_type.lower() not in self._orm_events.get(type(instance), ()):
+                    continue
+
+                table = self._get_full_table_name(type(instance))
+                (schema_name, table_name) = table.split(".")
+
+                evt = Event(uuid4(), event_type, schema_name, table_name, getattr(instance, "id", None))
+
+                capture = self._get_table_capture(table)
+                if capture is not None:
+                    evt.data = _project(self._get_orm_row_data(instance, event_type), capture)
+
+                pending.append(evt)
+
+    @staticmethod
+    def _get_orm_row_data(instance: Model, event_type: str) -> Dict:
+        """Capture an instance's row data, as a database trigger would.
+
+        Parameters
+        ----------
+        instance: flask_sqlalchemy.model.Model
+            Instance that was flushed.
+        event_type: str
+            PostGreSQL event type, one of 'INSERT', 'UPDATE', or 'DELETE'.
+
+        Returns
+        -------
+        dict
+            Captured data, with "new" and "old" rows keyed by column name.
+
+        """
+        state = sqlalchemy_inspect(instance)
+
+        new_row = {}
+        old_row = {}
+        for prop in state.mapper.column_attrs:
+            column = prop.columns[0].name
+            value = state.dict.get(prop.key)
+            history = state.attrs[prop.key].history
+
+            new_row[column] = value
+            old_row[column] = history.deleted[0] if history.deleted else value
+
+        return {
+            "new": None if event_type == "DELETE" else new_row,
+            "old": None if event_type == "INSERT" else old_row,
+        }
+
+    def _emit_orm_events(self, session: Session) -> None:
+        """Emit the events collected across a transaction's flushes with a single statement.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Session that is about to commit.
+
+        Returns
+        -------
+        None
+
+        """
+        # Flush now, since commit's own flush happens after this hook
+        session.flush()
+
+        session.info.pop("pgevents_savepoints", None)
+        pending = session.info.pop("pgevents", None)
+        if pending and self._initialized:
+            self._event_source.emit(session.connection(), pending)  # type: ignore
+
+    @staticmethod
+    def _mark_orm_events(session: Session, transaction: Any) -> None:
+        """Remember how many events were collected when a savepoint began.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Session in which the transaction began.
+        transaction: sqlalchemy.orm.SessionTransaction
+            Transaction that began.
+
+        Returns
+        -------
+        None
+
+        """
+        if transaction.nested:
+            marks = session.info.setdefault("pgevents_savepoints", {})
+            marks[transaction] = len(session.info.get("pgevents", []))
+
+    @staticmethod
+    def _discard_orm_events(session: Session, previous_transaction: Any) -> None:
+        """Discard the events collected by a transaction or savepoint that was rolled back.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            Session that was rolled back.
+        previous_transaction: sqlalchemy.orm.SessionTransaction
+            Transaction that was rolled back.
+
+        Returns
+        -------
+        None
+
+        """
+        if previous_transaction.parent is None:
+            session.info.pop("pgevents", None)
+            session.info.pop("pgevents_savepoints", None)
+            return
+
+        mark = session.info.get("pgevents_savepoints", {}).pop(previous_transaction, None)
+        if mark is not None:
+            del session.info.get("pgevents", [])[mark:]
+
+    def listen(
+        self,
+        target: Model,
+        identifiers: Set,
+        fn: Callable,
+        mode: str = "trigger",
+        capture: Any = None,
+        priority: int = DEFAULT_PRIORITY,
+        partition_by: Any = None,
+        partitions: Optional[int] = None,
+        bulkhead: Optional[Bulkhead] = None,
+        group: Optional[str] = None,
+    ) -> None:
+        """Listen to PGEvents events for a given model.
+
+        This method's signature mirrors the `sqlalchemy.event.listen` method for
+        consistency.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class for which to listen.
+        identifiers: set
+            Event or events that this trigger should listen for. Should be one
+            of "insert", "update", or "delete".
+        fn: Callable
+            Method to call when an event matches this trigger.
+        mode: str
+            How events are produced. In "trigger" mode (the default), a
+            database trigger produces an event for every changed row, no
+            matter who changed it. In "orm" mode, no trigger is installed;
+            instead, the application's session collects the instances changed
+            by each flush and emits all of a transaction's events with a single
+            statement right before it commits. Only changes made through the
+            application's session produce events in "orm" mode.
+        capture: bool or iterable, optional
+            Row data to capture when the event occurs, and pass to the callback
+            as its ``data`` keyword argument: True for the whole row, or an
+            iterable of column names or columns. The data is a dictionary with
+            the "new" row (None for deletes) and the "old" row (None for
+            inserts), so callbacks need not query the table, and can handle
+            deletes. With the notify event source, captured data must fit in
+            a NOTIFY payload (8000 bytes).
+        priority: int
+            Positive scheduling weight of the target's events. Received events
+            are queued in one lane per priority, and ``handle_events`` takes
+            them out by weighted round-robin, so that a lane of priority 10
+            gets ten events dispatched for every event of a lane of priority 1.
+            An event's priority is the highest of its listeners' priorities.
+        partition_by: str or column, optional
+            Column by whose hash the target's events are routed to one of
+            ``partitions`` partitions. Consumers listening to the target then
+            share its partitions, and each only receives the events of its
+            own, so that a hot table's events are spread across consumers.
+            Partitions are rebalanced as consumers join or leave. Requires
+            "trigger" mode, and the notify, polling or compact event source.
+        partitions: int, optional
+            Number of partitions; required with ``partition_by``.
+        bulkhead: Bulkhead, optional
+            Executor in which to run the callback, so that a slow or stuck
+            callback does not hold up the other listeners; see ``Bulkhead``.
+            Cannot be used with ``PGEVENTS_BATCH_SESSION`` or
+            ``PGEVENTS_GEVENT``.
+        group: str, optional
+            With "transaction", the callback is called once per committed
+            transaction, as ``fn(txid, events)``, with the transaction's ID
+            and its matching events as a list of ``EventRecord``, in order.
+            Grouped callbacks run in the caller's thread, after the other
+            callbacks of the events. Cannot be used with ``bulkhead``.
+
+        Raises
+        ------
+        ValueError
+            Raises if the identifiers, mode, priority, partitioning, bulkhead
+            or group are invalid.
+
+        Returns
+        -------
+        None
+
+        """
+        installed = False
+
+        self._validate_identifiers(identifiers)
+
+        if mode not in MODES:
+            raise ValueError("Invalid mode: {}".format(mode))
+
+        if not isinstance(priority, int) or priority < 1:
+            raise ValueError("Invalid priority: {}".format(priority))
+
+        self._validate_group(group, bulkhead)
+
+        partition = self._get_partition(partition_by, partitions, mode)
+
+        trigger_name = self._get_full_table_name(target)
+
+        if any(trig.mode != mode for trig in self._triggers.get(trigger_name, [])):
+            raise ValueError("All listeners for {} must use the same mode".format(trigger_name))
+
+        if any(trig.partition != partition for trig in self._triggers.get(trigger_name, [])):
+            raise ValueError("All listeners for {} must use the same partitioning".format(trigger_name))
+
+        trigger_ = Trigger(target, fn, identifiers, installed, mode, _normalize_capture(capture), priority, partition)
+        trigger_.bulkhead = bulkhead
+        trigger_.group = group
+        self._validate_bulkheads([trigger_])
+
+        if mode == "orm":
+            self._orm_events[target].update(identifiers)
+
+        # Register first, so that the table is installed with this trigger's
+        # capture included.
+        self._triggers[trigger_name].append(trigger_)
+
+        if self._initialized:
+            try:
+                self._install_trigger(trigger_)
+            except Exception:
+                self._triggers[trigger_name].remove(trigger_)
+                raise
+            trigger_.installed = True
+
+            if partition is not None and trigger_name not in self._partitions:
+                self._rebalance_table(trigger_name, partition[1])
+
+    def _validate_bulkheads(self, triggers: Iterable[Trigger]) -> None:
+        """Check that triggers with bulkheads can run their callbacks in other threads.
+
+        Parameters
+        ----------
+        triggers: iterable
+            Triggers to check.
+
+        Raises
+        ------
+        ValueError
+            Raises if a trigger has a bulkhead, and callbacks share a batch
+            session or a gevent pool.
+
+        Returns
+        -------
+        None
+
+        """
+        if (self._batch_session or self._gevent_pool is not None) and any(trig.bulkhead for trig in triggers):
+            raise ValueError("Bulkheads cannot be used with PGEVENTS_BATCH_SESSION or PGEVENTS_GEVENT")
+
+    @staticmethod
+    def _validate_group(group: Optional[str], bulkhead: Optional[Bulkhead]) -> None:
+        """Check how a listener's events are grouped.
+
+        Parameters
+        ----------
+        group: str, optional
+            How the listener's events are grouped.
+        bulkhead: Bulkhead, optional
+            Bulkhead of the listener.
+
+        Raises
+        ------
+        ValueError
+            Raises if the group is invalid, or combined with a bulkhead.
+
+        Returns
+        -------
+        None
+
+        """
+        if group is not None and group not in GROUPS:
+            raise ValueError("Invalid group: {}".format(group))
+
+        if group is not None and bulkhead is not None:
+            raise ValueError("Bulkheads cannot be used with grouped listeners")
+
+    @staticmethod
+    def _get_partition(partition_by: Any, partitions: Optional[int], mode: str) -> Optional[Tuple[str, int]]:
+        """Validate and normalize the partitioning arguments of listen.
+
+        Parameters
+        ----------
+        partition_by: str or column, optional
+            Partition key column.
+        partitions: int, optional
+            Number of partitions.
+        mode: str
+            Mode of the listener.
+
+        Raises
+        ------
+        ValueError
+            Raises if the partitioning is invalid.
+
+        Returns
+        -------
+        tuple, optional
+            Partition key column name and number of partitions, or None if
+            the listener is not partitioned.
+
+        """
+        if partition_by is None and partitions is None:
+            return None
+
+        if partition_by is None or not isinstance(partitions, int) or partitions < 1:
+            raise ValueError("Invalid partitioning: {} partitions by {}".format(partitions, partition_by))
+
+        if mode != "trigger":
+            raise ValueError("Partitioning requires trigger mode")
+
+        return (getattr(partition_by, "name", partition_by), partitions)
+
+    def unlisten(self, target: Model, identifiers: Set, fn: Callable) -> None:
+        """Stop listening to PGEvents events for a given model.
+
+        This method's signature mirrors the `sqlalchemy.event.remove` method
+        for consistency. Once the target's table has no listeners left, it no
+        longer emits events (e.g. its database trigger is dropped), so writes
+        to it no longer pay for them.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class for which the callback listens.
+        identifiers: set
+            Event or events that the callback should no longer be called for.
+        fn: Callable
+            Method that was registered with ``listen`` or ``listens_for``.
+
+        Raises
+        ------
+        ValueError
+            Raises if the identifiers are invalid, or the callback does not
+            listen for them.
+
+        Returns
+        -------
+        None
+
+        """
+        self._validate_identifiers(identifiers)
+
+        trigger_name = self._get_full_table_name(target)
+        table_triggers = self._triggers.get(trigger_name, [])
+
+        matching = [trig for trig in table_triggers if trig.callback == fn and trig.events & identifiers]
+        if not matching:
+            raise ValueError("No listener for {} on {}".format(list(identifiers), trigger_name))
+
+        capture = self._get_table_capture(trigger_name)
+        for trig in matching:
+            trig.events = trig.events - identifiers
+            if not trig.events:
+                table_triggers.remove(trig)
+
+        mode = matching[0].mode
+        if mode == "orm":
+            self._orm_events[target] = {identifier for trig in table_triggers for identifier in trig.events}
+            if not self._orm_events[target]:
+                del self._orm_events[target]
+
+        if not table_triggers:
+            del self._triggers[trigger_name]
+
+        if self._initialized and mode == "trigger":
+            self._update_table(target, capture)
+        elif self._initialized and trigger_name not in self._triggers:
+            (schema_name, table_name) = trigger_name.split(".")
+            source = self._event_source
+            assert source is not None
+            source.unsubscribe(table_name, schema_name)
+
+    @staticmethod
+    def _validate_identifiers(identifiers: Set) -> None:
+        """Validate the identifiers passed to listen or unlisten.
+
+        Parameters
+        ----------
+        identifiers: set
+            Event or events to validate.
+
+        Raises
+        ------
+        ValueError
+            Raises if no identifiers are provided, or any is invalid.
+
+        Returns
+        -------
+        None
+
+        """
+        if not identifiers:
+            raise ValueError("At least one identifier must be provided")
+
+        invalid_identifiers = identifiers.difference(IDENTIFIERS)
+        if invalid_identifiers:
+            raise ValueError("Invalid identifiers: {}".format(list(invalid_identifiers)))
+
+    def _update_table(self, model: Model, capture: Any) -> None:
+        """Update a model's table installation after listeners were removed.
+
+        Parameters
+        ----------
+        model: flask_sqlalchemy.model.Model
+            Model whose listeners were removed.
+        capture: None, str, or tuple
+            Capture specification with which the table was installed.
+
+        Returns
+        -------
+        None
+
+        """
+        table = self._get_full_table_name(model)
+
+        if not self._triggers.get(table):
+            self._leave_partitions(table)
+
+        if not self._get_triggers(table):
+            if table not in self._streamed_tables:
+                (schema_name, table_name) = table.split(".")
+                self._event_source.uninstall(table_name, schema_name)  # type: ignore
+        elif not self._triggers.get(table) or self._get_table_capture(table) != capture:
+            # Stop capturing the columns, or partitioning by the key, that
+            # only the removed listeners used; pattern listeners remain
+            self._install_trigger_for_model(model)
+
+    def listen_pattern(
+        self,
+        schema: str,
+        table: str,
+        identifiers: Set,
+        fn: Callable,
+        capture: Any = None,
+        priority: int = DEFAULT_PRIORITY,
+        bulkhead: Optional[Bulkhead] = None,
+    ) -> None:
+        """Listen to PGEvents events for all tables matching a pattern, including tables created later.
+
+        Matching tables are installed right away, and new matching tables are
+        installed by the database itself, as they are created, through an
+        event trigger; creating event triggers requires superuser privileges.
+        The callback is passed the fully-resolved name of the event's table,
+        as its ``table`` keyword argument. Requires "trigger" mode, and the
+        notify, logical, polling or compact event source.
+
+        Parameters
+        ----------
+        schema: str
+            Pattern of the schemas of the tables, in which "*" matches any
+            characters, and "?" any one.
+        table: str
+            Pattern of the names of the tables.
+        identifiers: set
+            Event or events that this trigger should listen for; see `listen`.
+        fn: Callable
+            Method to call when an event matches this trigger.
+        capture: bool or iterable, optional
+            Row data to pass to the callback; see `listen`.
+        priority: int
+            Scheduling weight of the tables' events; see `listen`.
+        bulkhead: Bulkhead, optional
+            Executor in which to run the callback; see `listen`.
+
+        Raises
+        ------
+        ValueError
+            Raises if the identifiers, priority or bulkhead are invalid.
+        NotImplementedError
+            Raises if the event source does not support table patterns.
+
+        Returns
+        -------
+        None
+
+        """
+        self._validate_identifiers(identifiers)
+
+        if not isinstance(priority, int) or priority < 1:
+            raise ValueError("Invalid priority: {}".format(priority))
+
+        pattern = (schema, table)
+        trigger_ = Trigger(None, fn, identifiers, False, "trigger", _normalize_capture(capture), priority)
+        (trigger_.bulkhead, trigger_.pattern) = (bulkhead, pattern)
+        self._validate_bulkheads([trigger_])
+
+        self._pattern_triggers[pattern].append(trigger_)
+        if pattern not in self._pattern_regexes:
+            regexes = (re.compile(fnmatch.translate(schema)), re.compile(fnmatch.translate(table)))
+            self._pattern_regexes[pattern] = regexes
+        self._pattern_matches.clear()
+
+        if self._initialized:
+            try:
+                self._install_pattern(pattern)
+            except Exception:
+                self._remove_pattern_trigger(trigger_)
+                raise
+            trigger_.installed = True
+
+    def listens_for_pattern(
+        self,
+        schema: str,
+        table: str,
+        identifiers: Set,
+        capture: Any = None,
+        priority: int = DEFAULT_PRIORITY,
+        bulkhead: Optional[Bulkhead] = None,
+    ) -> Callable:
+        """Decorate a function as a callback for the events of all tables matching a pattern.
+
+        Parameters
+        ----------
+        schema: str
+            Pattern of the schemas of the tables; see `listen_pattern`.
+        table: str
+            Pattern of the names of the tables; see `listen_pattern`.
+        identifiers: set
+            Event or events that this trigger should listen for; see `listen`.
+        capture: bool or iterable, optional
+            Row data to pass to the callback; see `listen`.
+        priority: int
+            Scheduling weight of the tables' events; see `listen`.
+        bulkhead: Bulkhead, optional
+            Executor in which to run the callback; see `listen`.
+
+        Returns
+        -------
+        None
+
+        """
+
+        def decorate(fn):
+            self.listen_pattern(schema, table, identifiers, fn, capture=capture, priority=priority, bulkhead=bulkhead)
+            return fn
+
+        return decorate
+
+    def unlisten_pattern(self, schema: str, table: str, identifiers: Set, fn: Callable) -> None:
+        """Stop calling a callback for events of the tables matching a pattern.
+
+        Once a pattern has no listeners, new matching tables are no longer
+        installed. Installed tables keep emitting events, until
+        ``drop_orphaned_triggers`` drops those that have no listeners.
+
+        Parameters
+        ----------
+        schema: str
+            Pattern of the schemas, as passed to ``listen_pattern``.
+        table: str
+            Pattern of the table names, as passed to ``listen_pattern``.
+        identifiers: set
+            Event or events that the callback should no longer be called for.
+        fn: Callable
+            Method that was registered with ``listen_pattern``.
+
+        Raises
+        ------
+        ValueError
+            Raises if the identifiers are invalid, or the callback does not
+            listen for them.
+
+        Returns
+        -------
+        None
+
+        """
+        self._validate_identifiers(identifiers)
+
+        pattern = (schema, table)
+        pattern_triggers = self._pattern_triggers.get(pattern, [])
+        matching = [trig for trig in pattern_triggers if trig.callback == fn and trig.events & identifiers]
+        if not matching:
+            raise ValueError("No listener for {} on {}.{}".format(list(identifiers), schema, table))
+
+        for trig in matching:
+            trig.events = trig.events - identifiers
+            if not trig.events:
+                self._remove_pattern_trigger(trig)
+
+        if self._initialized and pattern not in self._pattern_triggers:
+            args = (_like_pattern(schema), _like_pattern(table), type(self._event_source).__name__)
+            _execute(self._psycopg2_connection, DELETE_PATTERN_STATEMENT, args)
+
+    def _remove_pattern_trigger(self, trigger_: Trigger) -> None:
+        """Remove a pattern's trigger, and the pattern once it has none.
+
+        Parameters
+        ----------
+        trigger_: Trigger
+            Trigger to remove.
+
+        Returns
+        -------
+        None
+
+        """
+        pattern = trigger_.pattern
+        self._pattern_triggers[pattern].remove(trigger_)  # type: ignore
+        if not self._pattern_triggers[pattern]:  # type: ignore
+            del self._pattern_triggers[pattern]  # type: ignore
+            del self._pattern_regexes[pattern]  # type: ignore
+        self._pattern_matches.clear()
+
+    def _install_pattern(self, pattern: Tuple[str, str]) -> None:
+        """Install the existing tables that match a pattern, and have the database install new ones.
+
+        Parameters
+        ----------
+        pattern: tuple
+            Schema and table patterns.
+
+        Returns
+        -------
+        None
+
+        """
+        capture = None
+        for trigger_ in self._pattern_triggers[pattern]:
+            capture = _merge_capture(capture, trigger_.capture)
+
+        connection = self._psycopg2_connection
+        (schema_pattern, table_pattern) = (_like_pattern(pattern[0]), _like_pattern(pattern[1]))
+        statement = self._event_source.get_install_statement(capture)  # type: ignore
+        pgevts.execute(connection, INSTALL_PATTERNS_STATEMENT)
+        args = (schema_pattern, table_pattern, type(self._event_source).__name__, statement)
+        _execute(connection, UPSERT_PATTERN_STATEMENT, args)
+
+        for (schema_name, table_name) in _fetchall(connection, SELECT_PATTERN_TABLES_STATEMENT, args[:2]):
+            table = "{}.{}".format(schema_name, table_name)
+            (capture, partition) = (self._get_table_capture(table), self._get_table_partition(table))
+            self._event_source.install(table_name, schema_name, capture, partition)  # type: ignore
+
+    def drop_orphaned_triggers(self) -> List[str]:
+        """Stop tables that have no listeners from emitting events.
+
+        Tables are found in the database's catalog, so that triggers left
+        behind by previous deploys, or by listeners that were removed from the
+        code, are dropped too. Set ``PGEVENTS_DROP_ORPHANED_TRIGGERS`` to call
+        this method on initialization, once all listeners are registered.
+
+        Note that all applications sharing the database are expected to
+        listen to the same tables, as tables that only other applications
+        listen to are considered orphaned.
+
+        Returns
+        -------
+        list
+            Fully-resolved names of the tables that were uninstalled, in the
+            form "<SCHEMA>.<TABLE>".
+
+        """
+        installed = self._event_source.get_installed_tables()  # type: ignore
+        watched = self._get_watched_tables() | {table for table in installed if self._get_pattern_triggers(table)}
+        orphaned = sorted(installed - watched)
+        for table in orphaned:
+            (schema_name, table_name) = table.split(".")
+            self._event_source.uninstall(table_name, schema_name)  # type: ignore
+
+        return orphaned
+
+    def _get_watched_tables(self) -> Set[str]:
+        """Get the tables that must emit events to the event source.
+
+        Returns
+        -------
+        set
+            Fully-resolved table names, in the form "<SCHEMA>.<TABLE>".
+
+        """
+        watched = set(self._streamed_tables)
+        for (table, table_triggers) in self._triggers.items():
+            if any(trig.mode == "trigger" for trig in table_triggers):
+                watched.add(table)
+        return watched
+
+    def cached(self, target: Model, maxsize: int = DEFAULT_CACHE_MAXSIZE, ttl: Optional[float] = None) -> ModelCache:
+        """Create a cache of a model's instances that is invalidated by events.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class whose instances to cache. The model must have
+            an "id" primary key, by which events identify rows.
+        maxsize: int
+            Maximum number of cached instances (default: 128).
+        ttl: float, optional
+            Number of seconds after which a cached instance expires.
+
+        Raises
+        ------
+        ValueError
+            Raises if the model's primary key is not "id".
+
+        Returns
+        -------
+        ModelCache
+            Cache of the model's instances.
+
+        """
+        primary_key = sqlalchemy_inspect(target).primary_key
+        if [column.name for column in primary_key] != ["id"]:
+            raise ValueError("{} must have an 'id' primary key to be cached".format(target.__name__))
+
+        cache = ModelCache(self, target, maxsize, ttl)
+        self.listen(target, {"update", "delete"}, cache.invalidate)
+        self._triggers[self._get_full_table_name(target)][-1].internal = True
+
+        return cache
+
+    def sync(self, target: Model, chunk_size: int = DEFAULT_SYNC_CHUNK_SIZE) -> Iterator[Model]:
+        """Stream all current rows of a model's table, then continue with events.
+
+        The table's rows are read from a consistent snapshot, through a
+        server-side cursor. Events of transactions that are visible in the
+        snapshot are not passed to the model's listeners afterwards, while
+        events of all other transactions are, so that the listeners continue
+        exactly where the snapshot ends: no change is missed or applied twice.
+        This relies on events carrying their transaction ID.
+
+        The snapshot applies to the listeners of the model registered when
+        ``sync`` is called, not to pattern listeners, caches, or aggregates,
+        which keep receiving every event.
+
+        The table is installed before the snapshot is taken, so that events
+        are produced for all transactions that the snapshot does not see.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class whose rows to stream.
+        chunk_size: int
+            Number of rows fetched from the cursor at once (default: 1000).
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
+
+        Returns
+        -------
+        Iterator[flask_sqlalchemy.model.Model]
+            Instances of the model, in primary key order. They are detached
+            from their session once the iterator is exhausted.
+
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
+
+        table = self._get_full_table_name(target)
+        self._watch_table(table, target)
+
+        connection = self._get_engine().connect().execution_options(isolation_level="REPEATABLE READ")
+        try:
+            with connection.begin():
+                snapshot = _parse_snapshot(connection.execute(text(SELECT_SNAPSHOT_STATEMENT)).scalar())
+                for trig in self._triggers[table]:
+                    if not trig.internal:
+                        trig.snapshot = snapshot
+
+                session = Session(bind=connection)
+                try:
+                    query = session.query(target).order_by(*sqlalchemy_inspect(target).primary_key)
+                    for instance in query.yield_per(chunk_size):
+                        yield instance
+                finally:
+                    session.close()
+        finally:
+            connection.close()
+
+    def aggregate(self, target: Model, group_by: Any = None, count: bool = True, sum: Any = None) -> Aggregate:
+        """Maintain counts and sums of a model's rows in memory, from events.
+
+        The initial results are computed with one ``GROUP BY`` query, in a
+        snapshot; events of transactions visible in the snapshot are then
+        ignored, and all others update the results from their captured row
+        data. With the logical event source, the model's table is set to
+        ``REPLICA IDENTITY FULL``, so that updates and deletes carry the old
+        row.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class whose rows to aggregate.
+        group_by: column or iterable, optional
+            Column or columns (or column names) by which rows are grouped. By
+            default, all rows form a single group, with the key None.
+        count: bool
+            Whether or not to count the rows of each group (default: True).
+        sum: column or iterable, optional
+            Column or columns (or column names) to sum for each group.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
+        ValueError
+            Raises if a group column is not scalar (e.g. an array or JSON).
+
+        Returns
+        -------
+        Aggregate
+            Aggregate, whose ``results`` are kept up to date by
+            ``handle_events``.
+
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
+
+        def resolve(columns):
+            if columns is None:
+                return []
+            if isinstance(columns, str) or not isinstance(columns, Iterable):
+                columns = [columns]
+            return [target.__table__.columns[getattr(column, "name", column)] for column in columns]
+
+        group_columns = resolve(group_by)
+        for column in group_columns:
+            # Groups are keyed by their values, which must be hashable
+            if isinstance(column.type, (ARRAY, JSON)):
+                raise ValueError("Cannot group by non-scalar column {}".format(column.name))
+
+        aggregate = Aggregate(group_columns, count, resolve(sum))
+
+        # Rows are counted from their captured data, even without columns
+        capture = aggregate.columns or list(sqlalchemy_inspect(target).primary_key)
+        table = self._get_full_table_name(target)
+        self.listen(target, {"insert", "update", "delete"}, aggregate.apply, capture=capture)
+        trigger_ = self._triggers[table][-1]
+        trigger_.internal = True
+
+        connection = self._get_engine().connect().execution_options(isolation_level="REPEATABLE READ")
+        try:
+            with connection.begin():
+                snapshot = connection.execute(text(SELECT_SNAPSHOT_STATEMENT)).scalar()
+                aggregate.load(connection.execute(aggregate.query))
+        finally:
+            connection.close()
+
+        trigger_.snapshot = _parse_snapshot(snapshot)
+
+        return aggregate
+
+    def listens_for(
+        self,
+        target: Model,
+        identifiers: Set,
+        mode: str = "trigger",
+        capture: Any = None,
+        priority: int = DEFAULT_PRIORITY,
+        partition_by: Any = None,
+        partitions: Optional[int] = None,
+        bulkhead: Optional[Bulkhead] = None,
+        group: Optional[str] = None,
+    ) -> Callable:
+        """Decorate a function as a callback for one or several PGEvents events.
+
+        This method's signature mirrors the `sqlalchemy.event.listen` method for
+        consistency.
+
+        Parameters
+        ----------
+        target: flask_sqlalchemy.model.Model
+            SQLAlchemy model class for which to listen.
+        identifiers: set
+            Event or events that this trigger should listen for. Should be one
+            of "insert", "update", or "delete".
+        fn: Callable
+            Method to call when an event matches this trigger.
+        mode: str
+            How events are produced; see `listen`.
+        capture: bool or iterable, optional
+            Row data to pass to the callback; see `listen`.
+        priority: int
+            Scheduling weight of the target's events; see `listen`.
+        partition_by: str or column, optional
+            Column by which the target's events are partitioned; see `listen`.
+        partitions: int, optional
+            Number of partitions; see `listen`.
+        bulkhead: Bulkhead, optional
+            Executor in which to run the callback; see `listen`.
+        group: str, optional
+            How events are grouped for the callback; see `listen`.
+
+        Returns
+        -------
+        None
+
+        """
+
+        def decorate(fn):
+            self.listen(
+                target,
+                identifiers,
+                fn,
+                mode=mode,
+                capture=capture,
+                priority=priority,
+                partition_by=partition_by,
+                partitions=partitions,
+                bulkhead=bulkhead,
+                group=group,
+            )
+            return fn
+
+        return decorate
+
+    def handle_events(self, timeout: float = 0.0) -> None:
+        """Handle PGEvents events, according to registered triggers.
+
+        Parameters
+        ----------
+        timeout: float
+            Number of seconds to block when polling for events. A value of 0.0
+            sets the method as non-blocking.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
+
+        Returns
+        -------
+        None
+
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
+
+        handled = []  # type: List[Event]
+
+        if self._retries:
+            # Don't block past the next due retry
+            timeout = max(min(timeout, self._retries[0][0] - time.monotonic()), 0.0)
+
+        if self._bulkhead_calls:
+            # Don't block past the next check of the callbacks running in bulkheads
+            timeout = min(timeout, BULKHEAD_WATCHDOG_INTERVAL)
+
+        if self._controller is not None:
+            timeout = self._controller.get_timeout(timeout, any(self._lanes.values()))
+
+        dispatched = []  # type: List[Event]
+
+        if not self._batch_session:
+            try:
+                # Events held by callbacks that were still running in bulkheads
+                (handled, dispatched, self._bulkhead_events) = (self._bulkhead_events, list(self._bulkhead_events), [])
+                self._run_retries()
+                for evt in self._receive(timeout):
+                    dispatched.append(evt)
+                    self._dispatch(evt)
+                    handled.append(evt)
+                self._flush_groups(handled, dispatched)
+                self._join_callbacks(handled, wait=False)
+            finally:
+                self._hold_groups(handled, dispatched)
+                self._hold_bulkhead_calls(handled, dispatched)
+                self._ack(handled, dispatched)
+                self._adapt(len(dispatched))
+            return
+
+        with self._app.app_context():  # type: ignore
+            session = self._cycle_session = self._create_cycle_session()
+            try:
+                self._run_retries(session)
+                for evt in self._receive(timeout):
+                    dispatched.append(evt)
+                    self._dispatch(evt, session)
+                    handled.append(evt)
+                self._flush_groups(handled, dispatched, session)
+            finally:
+                try:
+                    # Keep the work of the callbacks that succeeded, even if a
+                    # later one raised; its own savepoint was already rolled back.
+                    session.commit()
+                finally:
+                    self._cycle_session = None
+                    session.close()
+                self._hold_groups(handled, dispatched)
+                self._ack(handled, dispatched)
+                self._adapt(len(dispatched))
+
+    @property
+    def lane_depths(self) -> Dict[int, int]:
+        """Number of received events waiting to be dispatched, per priority.
+
+        A lane whose depth keeps growing is falling behind.
+
+        Returns
+        -------
+        dict
+            Queue depth of each lane, by priority.
+
+        """
+        return {priority: len(lane) for (priority, lane) in sorted(self._lanes.items())}
+
+    @property
+    def adaptive_settings(self) -> Optional[Dict[str, Any]]:
+        """Current settings of the adaptive controller, e.g. to graph them.
+
+        Returns
+        -------
+        dict, optional
+            Settings and observations, as returned by
+            ``AdaptiveController.settings``; None unless
+            ``PGEVENTS_ADAPTIVE`` is set.
+
+        """
+        return None if self._controller is None else self._controller.settings
+
+    def _adapt(self, dispatched: int) -> None:
+        """Have the adaptive controller observe a call, and apply its settings.
+
+        Configuration
+        -------------
+        PGEVENTS_ADAPTIVE: bool
+            Whether the poll timeout, fetch size and dispatch budget are tuned
+            automatically, instead of ``PGEVENTS_LANE_BUDGET``,
+            ``PGEVENTS_POLL_BATCH_SIZE`` and ``PGEVENTS_POLL_MAX_INTERVAL``
+            (default: False).
+        PGEVENTS_TARGET_LAG_MS: int
+            Milliseconds within which events should be handled; reads are at
+            most half of it apart (default: 1000).
+
+        Parameters
+        ----------
+        dispatched: int
+            Number of events dispatched by the call.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._controller is None:
+            return
+
+        self._controller.observe(dispatched, sum(len(lane) for lane in self._lanes.values()))
+        if self._controller.dispatch_budget is not None:
+            self._lane_budget = self._controller.dispatch_budget
+        self._event_source.tune(self._controller.fetch_size, self._controller.target_lag / 2)  # type: ignore
+
+    @property
+    def suppressed_duplicates(self) -> int:
+        """Number of redelivered events that were not dispatched again.
+
+        Returns
+        -------
+        int
+            Number of suppressed events; always 0 unless
+            ``PGEVENTS_DEDUP_SIZE`` is set.
+
+        """
+        return 0 if self._deduplicator is None else self._deduplicator.suppressed
+
+    @property
+    def assigned_partitions(self) -> Dict[str, Set[int]]:
+        """Partitions of partitioned tables whose events this consumer receives.
+
+        Returns
+        -------
+        dict
+            Assigned partitions, by fully-resolved table name.
+
+        """
+        return {table: set(partitions) for (table, partitions) in sorted(self._partitions.items())}
+
+    def _rebalance(self) -> None:
+        """Rebalance the partitions of all partitioned tables, if due.
+
+        Configuration
+        -------------
+        PGEVENTS_REBALANCE_INTERVAL: float
+            Seconds between rebalances (default: 5.0).
+
+        Returns
+        -------
+        None
+
+        """
+        now = time.monotonic()
+        if self._rebalanced_at and now - self._rebalanced_at < self._rebalance_interval:
+            return
+        self._rebalanced_at = now
+
+        for table in list(self._triggers):
+            partition = self._get_table_partition(table)
+            if partition is not None:
+                self._rebalance_table(table, partition[1])
+
+    def _rebalance_table(self, table: str, partitions: int) -> None:
+        """Take this consumer's fair share of a partitioned table's partitions.
+
+        Consumers of the table hold a shared advisory lock on it, so their
+        number is known, and an exclusive advisory lock on each partition they
+        are assigned. A consumer with more than its share releases partitions,
+        and one with less takes free ones, so that all partitions are assigned
+        within a few rebalances after a consumer joins or leaves.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+        partitions: int
+            Number of partitions of the table.
+
+        Returns
+        -------
+        None
+
+        """
+        connection = self._psycopg2_connection
+        if table not in self._partitions:
+            _fetchall(connection, JOIN_PARTITION_GROUP_STATEMENT, (table,))
+            self._partitions[table] = set()
+
+        owned = self._partitions[table]
+        ((members,),) = _fetchall(connection, COUNT_PARTITION_GROUP_MEMBERS_STATEMENT, (table,))
+        share = -(-partitions // max(members, 1))
+
+        assigned = set(owned)
+        for partition in sorted(owned, reverse=True)[: max(len(owned) - share, 0)]:
+            _fetchall(connection, UNLOCK_PARTITION_STATEMENT, (table, partition))
+            assigned.discard(partition)
+
+        for partition in range(partitions):
+            if len(assigned) >= share:
+                break
+            if partition not in assigned and _fetchall(connection, LOCK_PARTITION_STATEMENT, (table, partition))[0][0]:
+                assigned.add(partition)
+
+        if assigned != owned:
+            self._assign_partitions(table, assigned)
+
+    def _leave_partitions(self, table: str) -> None:
+        """Release all partitions of a table, for the other consumers to take.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        None
+
+        """
+        if table not in self._partitions:
+            return
+
+        for partition in self._partitions[table]:
+            _fetchall(self._psycopg2_connection, UNLOCK_PARTITION_STATEMENT, (table, partition))
+        _fetchall(self._psycopg2_connection, LEAVE_PARTITION_GROUP_STATEMENT, (table,))
+
+        self._assign_partitions(table, set())
+        del self._partitions[table]
+
+    def _assign_partitions(self, table: str, partitions: Set[int]) -> None:
+        """Receive the events of a table's given partitions from the event source.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+        partitions: set
+            Partitions assigned to this consumer.
+
+        Returns
+        -------
+        None
+
+        """
+        # Record the progress on released partitions for their next owner
+        if self._partitions[table] - partitions:
+            self._flush_acks()
+
+        (schema_name, table_name) = table.split(".")
+        self._event_source.assign(table_name, schema_name, partitions)  # type: ignore
+        self._partitions[table] = partitions
+
+    def _receive(self, timeout: float) -> Iterator[Event]:
+        """Receive events into the priority lanes, and take them out by weight.
+
+        Configuration
+        -------------
+        PGEVENTS_LANE_CAPACITY: int
+            Number of received events that may wait in the lanes; the event
+            source is not polled while they are full (default: 1000).
+        PGEVENTS_LANE_BUDGET: int, optional
+            Maximum number of events dispatched per ``handle_events`` call, so
+            that events of a higher priority received by the next call are
+            dispatched before the remaining ones (default: no limit).
+        PGEVENTS_DEDUP_SIZE: int
+            Number of received event IDs remembered to suppress redelivered
+            events; 0 disables suppression (default: 0).
+
+        Parameters
+        ----------
+        timeout: float
+            Number of seconds to block when polling for events.
+
+        Returns
+        -------
+        Iterator[Event]
+            Events to dispatch.
+
+        """
+        self._rebalance()
+
+        arrivals = len(self._received)
+        if len(self._received) < self._lane_capacity:
+            self._open_txid = None
+            for evt in self._event_source.poll(timeout):  # type: ignore
+                self._enqueue(evt)
+                if len(self._received) >= self._lane_capacity:
+                    # The rest of this event's transaction may not be received yet
+                    self._open_txid = evt.txid
+                    break
+        elif not any(self._lanes.values()):
+            # Full of events held for their transaction, which is passed on in parts
+            self._open_txid = None
+
+        if self._controller is not None:
+            self._controller.arrived(len(self._received) - arrivals)
+
+        budget = self._lane_budget
+        while any(self._lanes.values()) and (budget is None or budget > 0):
+            yield self._dequeue()
+            if budget is not None:
+                budget -= 1
+
+    def _enqueue(self, evt: Event) -> None:
+        """Queue a received event in the lane of its priority.
+
+        Parameters
+        ----------
+        evt: Event
+            Received event.
+
+        Returns
+        -------
+        None
+
+        """
+        table = "{}.{}".format(evt.schema_name, evt.table_name)
+        priorities = [trig.priority for trig in self._get_triggers(table) if evt.type.lower() in trig.events]
+
+        # Entries track whether an event was handled (True), failed (False),
+        # or neither yet (None), in the order events were received
+        if self._deduplicator is not None and self._deduplicator.seen(evt):
+            # Acknowledged in order, without being dispatched
+            self._received.append([evt, True])
+            return
+
+        entry = [evt, None]
+        self._received.append(entry)
+        self._entries[id(evt)] = entry
+        self._lanes[max(priorities, default=DEFAULT_PRIORITY)].append(evt)
+
+    def _dequeue(self) -> Event:
+        """Take the next event out of the lanes, by smooth weighted round-robin.
+
+        Returns
+        -------
+        Event
+            Event to dispatch.
+
+        """
+        total = 0
+        selected = None
+        for (priority, lane) in self._lanes.items():
+            if not lane:
+                continue
+            self._lane_credits[priority] += priority
+            total += priority
+            if selected is None or self._lane_credits[priority] > self._lane_credits[selected]:
+                selected = priority
+
+        self._lane_credits[selected] -= total  # type: ignore
+        return self._lanes[selected].popleft()  # type: ignore
+
+    def iter_events(
+        self,
+        timeout: Optional[float] = None,
+        max_events: Optional[int] = None,
+        tables: Optional[Iterable[Model]] = None,
+    ) -> Iterator[EventRecord]:
+        """Iterate over events as they are received, instead of handling them with callbacks.
+
+        Events are pulled from the event source lazily, as the iterator is
+        consumed, and acknowledged once the consumer asks for the next one.
+        Events yielded by this method are not passed to callbacks.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Number of seconds after which to stop waiting for events. By
+            default, the iterator waits indefinitely.
+        max_events: int, optional
+            Number of events after which to stop.
+        tables: iterable of flask_sqlalchemy.model.Model, optional
+            Models whose events to yield. Their tables are watched even if
+            they have no listeners. Events of other tables are acknowledged and
+            skipped. By default, the events of all listened-to tables are
+            yielded.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
+
+        Returns
+        -------
+        Iterator[EventRecord]
+            Received events.
+
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
+
+        models = None
+        if tables is not None:
+            models = {self._get_full_table_name(model): model for model in tables}
+            for (table, model) in models.items():
+                self._watch_table(table, model)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        count = 0
+
+        while True:
+            wait = ITER_EVENTS_POLL_TIMEOUT if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+            for evt in self._event_source.poll(wait):  # type: ignore
+                table = "{}.{}".format(evt.schema_name, evt.table_name)
+                if models is None or table in models:
+                    yield EventRecord(evt.id, evt.type, self._get_table_model(table), evt.row_id, evt.data)
+                    count += 1
+                self._ack([evt])
+
+                if max_events is not None and count >= max_events:
+                    return
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+
+    def _watch_table(self, table: str, model: Model) -> None:
+        """Install a table that has no listeners, so that its events are received.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+        model: flask_sqlalchemy.model.Model
+            Model of the table.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._get_triggers(table) or table in self._streamed_tables:
+            return
+
+        (schema_name, table_name) = table.split(".")
+        self._event_source.install(table_name, schema_name)  # type: ignore
+        self._streamed_tables[table] = model
+
+    def _get_table_model(self, table: str) -> Optional[Model]:
+        """Get the model of a table that has listeners, or is watched by iter_events.
+
+        Parameters
+        ----------
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+
+        Returns
+        -------
+        flask_sqlalchemy.model.Model, optional
+            Model of the table, if known.
+
+        """
+        if self._triggers.get(table):
+            return self._triggers[table][0].target
+        return self._streamed_tables.get(table)
+
+    def _ack(self, events: List[Event], dispatched: Iterable[Event] = ()) -> None:
+        """Queue handled events for acknowledgement.
+
+        Events from the priority lanes are acknowledged in the order they were
+        received, once all events received before them were handled, and only
+        up to the first event whose callbacks failed, so that a source that
+        tracks a position resumes from it after a restart. Acknowledgements are sent to the event source in batches of
+        ``PGEVENTS_ACK_BATCH_SIZE`` events, or once ``PGEVENTS_ACK_INTERVAL``
+        seconds have passed since the last batch, whichever comes first.
+
+        Parameters
+        ----------
+        events: list
+            Handled events.
+        dispatched: iterable
+            Events taken out of the lanes. Those that were not handled failed:
+            neither they nor the events received after them are acknowledged
+            from then on.
+
+        Returns
+        -------
+        None
+
+        """
+        for evt in events:
+            entry = self._entries.pop(id(evt), None)
+            if entry is None:
+                # Not received through the lanes (e.g. by iter_events)
+                if not self._ack_halted:
+                    self._acks.append(evt)
+            else:
+                entry[1] = True
+
+        for evt in dispatched:
+            entry = self._entries.pop(id(evt), None)
+            if entry is not None:
+                entry[1] = False
+
+        while self._received and self._received[0][1] is not None:
+            (evt, handled) = self._received.popleft()
+            if not handled:
+                # Keep the position before the failed event, so that it is
+                # received again after a restart
+                self._ack_halted = True
+            elif not self._ack_halted:
+                self._acks.append(evt)
+
+        if len(self._acks) >= self._ack_batch_size or time.monotonic() - self._acked_at >= self._ack_interval:
+            self._flush_acks()
+
+    def _flush_acks(self) -> None:
+        """Send queued acknowledgements to the event source.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._acks:
+            (acks, self._acks) = (self._acks, [])
+            self._event_source.ack(acks)  # type: ignore
+        self._acked_at = time.monotonic()
+
+    def _join_callbacks(self, events: List[Event], wait: bool = True) -> None:
+        """Wait for the callbacks running in the gevent pool or in bulkheads to finish.
+
+        Failed callbacks are retried, if retries are enabled.
+
+        Parameters
+        ----------
+        events: list
+            Events whose callbacks were spawned, in order. If a callback
+            failed and is not retried, its event and all later events are
+            removed, so that they are not acknowledged.
+        wait: bool
+            Whether to wait for the callbacks running in bulkheads; if not,
+            those still running are kept for a later call.
+
+        Raises
+        ------
+        Exception
+            Re-raises the exception of the first event's failed callback, if
+            retries are disabled.
+
+        Returns
+        -------
+        None
+
+        """
+        failures = []  # type: List[Tuple[Event, Trigger, int, BaseException]]
+
+        if self._greenlets:
+            import gevent
+
+            (greenlets, self._greenlets) = (self._greenlets, [])
+            gevent.joinall([greenlet for (_, _, _, greenlet) in greenlets])
+            failures.extend(
+                (evt, trig, attempt, greenlet.exception)
+                for (evt, trig, attempt, greenlet) in greenlets
+                if not greenlet.successful()
+            )
+
+        if self._bulkhead_calls:
+            (bulkhead_failures, self._bulkhead_calls) = self._join_bulkhead_calls(self._bulkhead_calls, wait)
+            failures.extend(bulkhead_failures)
+
+        # Report failures in the order the events were received
+        order = {id(evt): index for (index, evt) in enumerate(events)}
+        for (evt, trig, attempt, exc) in sorted(failures, key=lambda failure: order.get(id(failure[0]), len(order))):
+            if self._retry_attempts:
+                self._retry(evt, trig, attempt, exc)
+                continue
+            if evt in events:
+                first_failed = events.index(evt)
+                del events[first_failed:]
+            raise exc
+
+    @classmethod
+    def _join_bulkhead_calls(
+        cls, calls: List[Tuple], wait: bool = True
+    ) -> Tuple[List[Tuple[Event, Trigger, int, BaseException]], List[Tuple]]:
+        """Wait for callbacks running in bulkheads, and abandon those that overrun their timeout.
+
+        Parameters
+        ----------
+        calls: list
+            Event, trigger, attempt and future of each callback, whose future
+            is None if the bulkhead rejected the callback.
+        wait: bool
+            Whether to wait until no callback is running; if not, the
+            callbacks are only checked once.
+
+        Returns
+        -------
+        tuple
+            Event, trigger, attempt and exception of each failed callback, and
+            the calls of the callbacks still running.
+
+        """
+        failures = []  # type: List[Tuple[Event, Trigger, int, BaseException]]
+        pending = []  # type: List[Tuple]
+        for (evt, trig, attempt, future) in calls:
+            if future is None:
+                rejected = RuntimeError("Bulkhead of {} is full".format(_callback_name(trig.callback)))
+                failures.append((evt, trig, attempt, rejected))
+            else:
+                pending.append((evt, trig, attempt, future))
+
+        while pending:
+            now = time.monotonic()
+            waiting = []
+            for call in pending:
+                (done, exc) = cls._check_bulkhead_call(call, now)
+                if not done:
+                    waiting.append(call)
+                elif exc is not None:
+                    (evt, trig, attempt, _) = call
+                    failures.append((evt, trig, attempt, exc))
+
+            pending = waiting
+            if pending and not wait:
+                break
+            if pending:
+                # Wake up at the first deadline, or soon for callbacks that have not yet started
+                deadlines = [trig.bulkhead.get_deadline(future) for (_, trig, _, future) in pending]
+                timeout = min((deadline - now for deadline in deadlines if deadline is not None), default=None)
+                if timeout is None or None in deadlines:
+                    timeout = min(timeout or BULKHEAD_WATCHDOG_INTERVAL, BULKHEAD_WATCHDOG_INTERVAL)
+                futures = [future for (_, _, _, future) in pending]
+                concurrent.futures.wait(futures, max(timeout, 0.0), concurrent.futures.FIRST_COMPLETED)
+
+        return (failures, pending)
+
+    @staticmethod
+    def _check_bulkhead_call(call: Tuple, now: float) -> Tuple[bool, Optional[BaseException]]:
+        """Check whether a callback running in a bulkhead finished, or must be abandoned.
+
+        Parameters
+        ----------
+        call: tuple
+            Event, trigger, attempt and future of the callback.
+        now: float
+            Current time, as returned by ``time.monotonic``.
+
+        Returns
+        -------
+        tuple
+            Whether the callback is no longer waited for, and its exception,
+            if it failed or was abandoned.
+
+        """
+        (_, trig, _, future) = call
+        (bulkhead, name) = (trig.bulkhead, _callback_name(trig.callback))
+        if future.done():
+            return (True, future.exception())
+
+        deadline = bulkhead.get_deadline(future)
+        if deadline is not None and now >= deadline:
+            bulkhead.overrun(future)
+            return (True, TimeoutError("Callback {} timed out after {}s".format(name, bulkhead.timeout)))
+
+        # Queued behind abandoned callbacks, which hold all threads
+        if deadline is None and bulkhead.wedged and future.cancel():
+            return (True, RuntimeError("Bulkhead of {} is wedged".format(name)))
+
+        return (False, None)
+
+    def _dispatch(self, evt: Event, session: Optional[Session] = None, callback: Optional[str] = None) -> None:
+        """Call the callbacks of all triggers that match an event.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to dispatch.
+        session: sqlalchemy.orm.Session, optional
+            Batch session; if given, each callback runs in its own savepoint.
+        callback: str, optional
+            Name, or fully-qualified name, of the only callback to call.
+
+        Returns
+        -------
+        None
+
+        """
+        table = "{}.{}".format(evt.schema_name, evt.table_name)
+
+        for trig in self._get_triggers(table):
+            if evt.type.lower() not in trig.events:
+                continue
+            if callback is not None and callback not in (trig.callback.__name__, _callback_name(trig.callback)):
+                continue
+            if trig.snapshot is not None and evt.txid is not None and _snapshot_visible(trig.snapshot, evt.txid):
+                continue
+            if trig.group is not None:
+                # Events without a transaction ID are groups of their own
+                key = (id(trig), evt.id if evt.txid is None else evt.txid)
+                self._groups.setdefault(key, (trig, []))[1].append(evt)
+                continue
+            self._call(evt, trig, session)
+
+    def _call(self, evt: Event, trig: Trigger, session: Optional[Session] = None, attempt: int = 1) -> None:
+        """Call a trigger's callback for an event.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to pass to the callback.
+        trig: Trigger
+            Trigger whose callback to call.
+        session: sqlalchemy.orm.Session, optional
+            Batch session; if given, the callback runs in its own savepoint.
+        attempt: int
+            Number of this attempt at calling the callback for the event.
+
+        Returns
+        -------
+        None
+
+        """
+        kwargs = self._get_callback_kwargs(evt, trig)
+
+        if trig.bulkhead is not None:
+            future = trig.bulkhead.submit(self._invoke_in_context, evt, trig, kwargs)
+            self._bulkhead_calls.append((evt, trig, attempt, future))
+            return
+
+        if self._gevent_pool is not None:
+            greenlet = self._gevent_pool.spawn(self._invoke, evt, trig, kwargs)
+            self._greenlets.append((evt, trig, attempt, greenlet))
+            return
+
+        try:
+            if session is None:
+                self._invoke(evt, trig, kwargs)
+            else:
+                with session.begin_nested():
+                    self._invoke(evt, trig, kwargs)
+        except Exception as exc:
+            if not self._retry_attempts:
+                raise
+            self._retry(evt, trig, attempt, exc)
+
+    def _invoke(self, evt: Event, trig: Trigger, kwargs: Dict) -> None:
+        """Run a trigger's callback for an event, in a span if tracing is enabled.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to pass to the callback.
+        trig: Trigger
+            Trigger whose callback to run.
+        kwargs: dict
+            Keyword arguments of the callback.
+
+        Returns
+        -------
+        None
+
+        """
+        if self._tracer is None:
+            trig.callback(evt.id, evt.row_id, evt.type, **kwargs)
+            return
+
+        with self._tracer.span(evt, trig.callback):
+            trig.callback(evt.id, evt.row_id, evt.type, **kwargs)
+
+    def _invoke_in_context(self, evt: Event, trig: Trigger, kwargs: Dict) -> None:
+        """Run a trigger's callback for an event in a bulkhead's thread, within an application context.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to pass to the callback.
+        trig: Trigger
+            Trigger whose callback to run.
+        kwargs: dict
+            Keyword arguments of the callback.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._app.app_context():  # type: ignore
+            self._invoke(evt, trig, kwargs)
+
+    @staticmethod
+    def _get_callback_kwargs(evt: Event, trig: Trigger) -> Dict:
+        """Get the keyword arguments with which a trigger's callback is called.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to pass to the callback.
+        trig: Trigger
+            Trigger whose callback to call.
+
+        Returns
+        -------
+        dict
+            The captured row data, if the trigger captures any, and the
+            fully-resolved table name, if the trigger listens to a pattern.
+
+        """
+        kwargs = {}  # type: Dict[str, Any]
+        if trig.capture is not None:
+            kwargs["data"] = _project(evt.data, trig.capture)
+        if trig.pattern is not None:
+            kwargs["table"] = "{}.{}".format(evt.schema_name, evt.table_name)
+        return kwargs
+
+    def _flush_groups(
+        self, handled: List[Event], dispatched: List[Event], session: Optional[Session] = None, final: bool = False
+    ) -> None:
+        """Call the callbacks of grouped triggers with the events of each complete transaction.
+
+        A transaction is complete unless some of its events are still in the
+        lanes, or may not have been polled yet because the lanes were full.
+        The groups of incomplete transactions are held until a later call.
+
+        Parameters
+        ----------
+        handled: list
+            Events dispatched by this call, in order. Events of groups held
+            by previous calls are added once their callback was called. If a
+            callback failed and is not retried, its events and all later
+            events are removed, so that they are not acknowledged.
+        dispatched: list
+            Events taken out of the lanes by this call. Events of a failed
+            group that were held by previous calls are added, so that they are
+            not acknowledged.
+        session: sqlalchemy.orm.Session, optional
+            Batch session; if given, each callback runs in its own savepoint.
+        final: bool
+            Whether to call the callbacks of all groups (e.g. at the end of a
+            replay), without adding events to ``handled``.
+
+        Raises
+        ------
+        Exception
+            Re-raises the exception of a failed callback, if retries are
+            disabled.
+
+        Returns
+        -------
+        None
+
+        """
+        pending = set()  # type: Set[Optional[int]]
+        if not final:
+            pending = {evt.txid for lane in self._lanes.values() for evt in lane}
+            pending.add(self._open_txid)
+        pending.discard(None)
+
+        for (key, (trig, events)) in list(self._groups.items()):
+            if key[1] in pending:
+                continue
+            del self._groups[key]
+
+            if all(evt.position is not None for evt in events):
+                events.sort(key=lambda evt: evt.position or 0)
+
+            ids = {id(evt) for evt in handled}
+            try:
+                self._call_group(events, trig, session)
+            except Exception:
+                grouped = {id(evt) for evt in events}
+                first_failed = min((i for (i, evt) in enumerate(handled) if id(evt) in grouped), default=len(handled))
+                del handled[first_failed:]
+                dispatched.extend(evt for evt in events if id(evt) not in ids)
+                raise
+
+            if not final:
+                handled.extend(evt for evt in events if id(evt) not in ids)
+
+    def _hold_groups(self, handled: List[Event], dispatched: List[Event]) -> None:
+        """Keep the events of held groups from being acknowledged or dropped.
+
+        Parameters
+        ----------
+        handled: list
+            Events dispatched by this call.
+        dispatched: list
+            Events taken out of the lanes by this call.
+
+        Returns
+        -------
+        None
+
+        """
+        held = {id(evt) for (_, events) in self._groups.values() for evt in events}
+        if held:
+            handled[:] = [evt for evt in handled if id(evt) not in held]
+            dispatched[:] = [evt for evt in dispatched if id(evt) not in held]
+
+    def _hold_bulkhead_calls(self, handled: List[Event], dispatched: List[Event]) -> None:
+        """Keep the events of callbacks still running in bulkheads from being acknowledged or dropped.
+
+        The events are handled again by the next call, after their callbacks
+        returned or were abandoned.
+
+        Parameters
+        ----------
+        handled: list
+            Events dispatched by this call.
+        dispatched: list
+            Events taken out of the lanes by this call.
+
+        Returns
+        -------
+        None
+
+        """
+        running = {id(evt) for (evt, _, _, _) in self._bulkhead_calls}
+        if running:
+            held = {id(evt): evt for evt in itertools.chain(dispatched, handled) if id(evt) in running}
+            self._bulkhead_events = list(held.values())
+            handled[:] = [evt for evt in handled if id(evt) not in held]
+            dispatched[:] = [evt for evt in dispatched if id(evt) not in held]
+
+    def _call_group(
+        self, events: List[Event], trig: Trigger, session: Optional[Session] = None, attempt: int = 1
+    ) -> None:
+        """Call a grouped trigger's callback for the events of a transaction.
+
+        Parameters
+        ----------
+        events: list
+            Events of the transaction, in order.
+        trig: Trigger
+            Trigger whose callback to call.
+        session: sqlalchemy.orm.Session, optional
+            Batch session; if given, the callback runs in its own savepoint.
+        attempt: int
+            Number of this attempt at calling the callback for the events.
+
+        Returns
+        -------
+        None
+
+        """
+        try:
+            if session is None:
+                self._invoke_group(events, trig)
+            else:
+                with session.begin_nested():
+                    self._invoke_group(events, trig)
+        except Exception as exc:
+            if not self._retry_attempts:
+                raise
+            self._retry(events, trig, attempt, exc)
+
+    def _invoke_group(self, events: List[Event], trig: Trigger) -> None:
+        """Run a grouped trigger's callback for the events of a transaction, in a span if tracing is enabled.
+
+        Parameters
+        ----------
+        events: list
+            Events of the transaction, in order.
+        trig: Trigger
+            Trigger whose callback to run.
+
+        Returns
+        -------
+        None
+
+        """
+        records = [
+            EventRecord(evt.id, evt.type, trig.target, evt.row_id, self._get_callback_kwargs(evt, trig).get("data"))
+            for evt in events
+        ]
+
+        if self._tracer is None:
+            trig.callback(events[0].txid, records)
+            return
+
+        # The events of a transaction share its trace
+        with self._tracer.span(events[0], trig.callback):
+            trig.callback(events[0].txid, records)
+
+    def _retry(self, evt: Union[Event, List[Event]], trig: Trigger, attempt: int, exc: BaseException) -> None:
+        """Schedule a failed callback to be called again, or dead-letter its event.
+
+        Parameters
+        ----------
+        evt: Event or list
+            Event for which the callback failed, or events of the transaction
+            for which a grouped trigger's callback failed.
+        trig: Trigger
+            Trigger whose callback failed.
+        attempt: int
+            Number of the failed attempt.
+        exc: BaseException
+            Exception raised by the callback.
+
+        Returns
+        -------
+        None
+
+        """
+        if attempt >= self._retry_attempts:
+            self._dead_letter(evt, trig, attempt, repr(exc))
+            return
+
+        delay = min(self._retry_backoff * 2 ** (attempt - 1), self._retry_max_backoff)
+        heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_counter), evt, trig, attempt + 1))
+
+    def _dead_letter(self, evt: Union[Event, List[Event]], trig: Trigger, attempts: int, error: str) -> None:
+        """Record an event for which a callback failed in the dead letter table.
+
+        Parameters
+        ----------
+        evt: Event or list
+            Event for which the callback failed, or events of the transaction
+            for which a grouped trigger's callback failed.
+        trig: Trigger
+            Trigger whose callback failed.
+        attempts: int
+            Number of failed attempts.
+        error: str
+            Last error.
+
+        Returns
+        -------
+        None
+
+        """
+        for dead in evt if isinstance(evt, list) else [evt]:
+            self._execute(
+                INSERT_DEAD_LETTER_STATEMENT,
+                event=dead.tojson(),
+                callback=_callback_name(trig.callback),
+                attempts=attempts,
+                error=error,
+            )
+
+    def _run_retries(self, session: Optional[Session] = None) -> None:
+        """Call the failed callbacks whose retries are due.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session, optional
+            Batch session; if given, each callback runs in its own savepoint.
+
+        Returns
+        -------
+        None
+
+        """
+        now = time.monotonic()
+        while self._retries and self._retries[0][0] <= now:
+            (_, _, evt, trig, attempt) = heapq.heappop(self._retries)
+            call = self._call if trig.group is None else self._call_group
+            call(evt, trig, session, attempt)
+
+    def replay(
+        self,
+        table: Optional[str] = None,
+        since: Any = None,
+        until: Any = None,
+        workers: int = 1,
+        callback: Optional[str] = None,
+        chunk_size: int = DEFAULT_REPLAY_CHUNK_SIZE,
+        progress: Optional[Callable[[int, int, int, float], None]] = None,
+    ) -> int:
+        """Replay stored events through the registered listeners, e.g. to backfill a new listener.
+
+        The events are split into ID ranges, which are read through
+        server-side cursors and dispatched by ``workers`` processes in
+        parallel, so events of different ranges are handled out of order.
+        Replayed events are not acknowledged. Requires the polling or compact
+        event source.
+
+        Parameters
+        ----------
+        table: str, optional
+            Fully-resolved name of the only table whose events to replay, in
+            the form "<SCHEMA>.<TABLE>".
+        since: int or datetime, optional
+            ID of the first event to replay, or time from which events are
+            replayed (default: the first event).
+        until: int or datetime, optional
+            ID of the last event to replay, or time until which events are
+            replayed (default: the last event).
+        workers: int
+            Number of processes that replay events. Worker processes are
+            forked, and inherit the registered listeners.
+        callback: str, optional
+            Name, or fully-qualified name, of the only callback to call.
+        chunk_size: int
+            Number of events fetched at once.
+        progress: Callable, optional
+            Called with the number of replayed ranges, the total number of
+            ranges, the number of replayed events and the elapsed seconds,
+            each time a range is replayed.
+
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
+        NotImplementedError
+            Raises if the event source does not store events.
+
+        Returns
+        -------
+        int
+            Number of replayed events.
+
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
+
+        start = self._get_replay_position(since, since_=True)
+        end = self._get_replay_position(until, since_=False)
 
-    target: Callable
-    callback: Callable
-    events: Set = set()
-    installed: bool = False
+        size = max(-(-(end - start) // (workers * REPLAY_RANGES_PER_WORKER)), chunk_size)
+        tasks = [(lower, min(lower + size, end), table, callback, chunk_size) for lower in range(start, end, size)]
 
+        started = time.monotonic()
+        count = 0
 
-class PGEvents:
-    """PGEvents extension."""
+        def replayed(results: Iterable[int]) -> int:
+            total = 0
+            for (done, events) in enumerate(results, 1):
+                total += events
+                if progress is not None:
+                    progress(done, len(tasks), total, time.monotonic() - started)
+            return total
 
-    def __init__(self, app: Optional[Flask] = None) -> None:
-        """Initialize the extension.
+        if workers == 1:
+            return replayed(self._replay_range(*task) for task in tasks)
+
+        # Forked workers must not share the parent's pooled connections
+        with self._app.app_context():  # type: ignore
+            self.session.remove()
+        self._get_engine().dispose()
+
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_replay_worker, initargs=(self,)) as pool:
+            count = replayed(pool.imap_unordered(_replay_range, tasks))
+
+        return count
+
+    def _get_replay_position(self, bound: Any, since_: bool) -> int:
+        """Convert a bound of the events to replay into a position.
 
         Parameters
         ----------
-        app: Flask, optional
-            The application to which this extension will be registered.
+        bound: int or datetime, optional
+            Event ID (inclusive), or time (exclusive, for until).
+        since_: bool
+            Whether the bound is the lower one.
 
-        """
-        self._app = None  # type: Optional[Flask]
-        self._connection = None  # type: Optional[SQLAlchemyConnection]
-        self._psycopg2_connection = None  # type: Optional[Psycopg2Connection]
-        self._triggers = defaultdict(list)  # type: dict
-        self._initialized = False  # type: bool
+        Returns
+        -------
+        int
+            Position after which (lower bound) or up to which (upper bound)
+            events are replayed.
 
-        if app is not None:
-            self.init_app(app)
+        """
+        if bound is None:
+            return 0 if since_ else self._event_source.get_position()  # type: ignore
+        if isinstance(bound, datetime):
+            return self._event_source.get_position(bound)  # type: ignore
+        return bound - 1 if since_ else bound
 
-    def init_app(self, app: Flask) -> None:
-        """Initialize the extension against an application.
+    def _replay_range(
+        self, start: int, end: int, table: Optional[str], callback: Optional[str], chunk_size: int
+    ) -> int:
+        """Replay the events of a range through the registered listeners.
 
         Parameters
         ----------
-        app: Flask
-            The application to which this extension will be registered.
+        start: int
+            Position after which to replay events.
+        end: int
+            Position up to which to replay events.
+        table: str, optional
+            Fully-resolved name of the only table whose events to replay.
+        callback: str, optional
+            Name of the only callback to call.
+        chunk_size: int
+            Number of events fetched at once.
 
         Returns
         -------
-        None
+        int
+            Number of replayed events.
 
         """
-        self._app = app
+        count = 0
+        connection = self._get_engine().raw_connection()
+        try:
+            with self._app.app_context():  # type: ignore
+                events = []
+                source = self._event_source
+                assert source is not None
+                for evt in source.read(connection.connection, start, end, table, chunk_size):
+                    self._dispatch(evt, callback=callback)
+                    events.append(evt)
+                    if len(events) == chunk_size:
+                        self._join_callbacks(events)
+                        (count, events) = (count + len(events), [])
+                self._flush_groups(events, [], final=True)
+                self._join_callbacks(events)
+                count += len(events)
 
-        if "sqlalchemy" not in app.extensions:
-            raise RuntimeError("This extension must be initialized after Flask-SQLAlchemy")
+                # Retries would be lost with the worker
+                while self._retries:
+                    self._sleep(max(self._retries[0][0] - time.monotonic(), 0.0))
+                    self._run_retries()
+        finally:
+            connection.close()
 
-        self._setup_conection()
+        return count
 
-        # Initialize psycopg2-pgevents
-        pgevents_debug = app.config.get("PSYCOPG2_PGEVENTS_DEBUG", False)
-        pgevts.set_debug(pgevents_debug)
+    def replay_dead_letters(self, limit: Optional[int] = None) -> int:
+        """Call the callbacks of dead-lettered events again.
 
-        pgevts.install_trigger_function(self._psycopg2_connection)
+        Events whose callback succeeds are removed from the dead-letter table;
+        the others remain, with their number of attempts incremented.
 
-        # Install any deferred triggers
-        for table_triggers in self._triggers.values():
-            for trigger_ in table_triggers:
-                if not trigger_.installed:
-                    self._install_trigger_for_model(trigger_.target)
-                    trigger_.installed = True
+        Parameters
+        ----------
+        limit: int, optional
+            Maximum number of dead-lettered events to replay, oldest first. All
+            are replayed by default.
 
-        pgevts.register_event_channel(self._psycopg2_connection)
+        Raises
+        ------
+        RuntimeError
+            Raises if the extension has not yet been initialized.
 
-        app.extensions["pgevents"] = self
+        Returns
+        -------
+        int
+            Number of events that were replayed successfully.
 
-        self._initialized = True
+        """
+        if not self._initialized:
+            raise RuntimeError("Extension not initialized.")
 
-        atexit.register(self.teardown)
+        self._execute(INSTALL_DEAD_LETTER_TABLE_STATEMENT)
 
-    def teardown(self) -> None:
-        """Teardown the extension.
+        replayed = []
+        for (dead_letter_ids, events, triggers) in self._read_dead_letters(limit):
+            try:
+                self._replay_dead_letter(events, triggers)
+            except Exception as exc:
+                for dead_letter_id in dead_letter_ids:
+                    self._execute(UPDATE_DEAD_LETTER_STATEMENT, id=dead_letter_id, error=repr(exc))
+            else:
+                if triggers:
+                    replayed.extend(dead_letter_ids)
+
+        if replayed:
+            self._execute(DELETE_DEAD_LETTERS_STATEMENT, ids=replayed)
+
+        return len(replayed)
+
+    def _replay_dead_letter(self, events: List[Event], triggers: List[Trigger]) -> None:
+        """Call the callbacks of dead-lettered events again.
+
+        Parameters
+        ----------
+        events: list
+            Dead-lettered event, or events of a transaction for grouped
+            triggers.
+        triggers: list
+            Triggers whose callback failed.
 
         Returns
         -------
         None
 
         """
-        if self._initialized:
-            pgevts.unregister_event_channel(self._psycopg2_connection)
+        for trig in triggers:
+            if trig.group is not None:
+                self._invoke_group(events, trig)
+                continue
+            for evt in events:
+                trig.callback(evt.id, evt.row_id, evt.type, **self._get_callback_kwargs(evt, trig))
 
-            self._teardown_connection()
-        self._initialized = False
+    def _read_dead_letters(self, limit: Optional[int]) -> List[Tuple[List[int], List[Event], List[Trigger]]]:
+        """Read dead-lettered events, oldest first, with the triggers whose callback failed.
 
-    def _setup_conection(self) -> None:
-        """Set up the database connection.
+        Consecutive dead-lettered events of a transaction, whose callback is
+        grouped, are read together, so that they are replayed as a group.
+
+        Parameters
+        ----------
+        limit: int, optional
+            Maximum number of dead-lettered events to read.
+
+        Returns
+        -------
+        list
+            Dead-letter IDs, events and triggers of each group of events.
+
+        """
+        dead_letters = []  # type: List[Tuple[List[int], List[Event], List[Trigger]]]
+        previous = None  # type: Optional[Tuple[str, str, Optional[int]]]
+        for (dead_letter_id, event_json, callback) in self._execute(SELECT_DEAD_LETTERS_STATEMENT, limit=limit):
+            evt = Event.fromjson(event_json)
+            table = "{}.{}".format(evt.schema_name, evt.table_name)
+            triggers = [trig for trig in self._get_triggers(table) if _callback_name(trig.callback) == callback]
+
+            key = (table, callback, evt.txid)
+            if key == previous and evt.txid is not None and triggers and all(trig.group for trig in triggers):
+                dead_letters[-1][0].append(dead_letter_id)
+                dead_letters[-1][1].append(evt)
+            else:
+                dead_letters.append(([dead_letter_id], [evt], triggers))
+            previous = key
+
+        return dead_letters
+
+
+def _parse_registration(line: bytes) -> Optional[Dict]:
+    """Parse a table registration sent by a worker to the multiplexer.
+
+    Parameters
+    ----------
+    line: bytes
+        JSON-encoded registration.
+
+    Returns
+    -------
+    dict, optional
+        The registration, or None if it is malformed.
+
+    """
+    try:
+        registration = json.loads(line.decode("utf-8"))
+    except ValueError:
+        return None
+
+    if not isinstance(registration, dict):
+        return None
+    if not isinstance(registration.get("schema_name"), str) or not isinstance(registration.get("table_name"), str):
+        return None
+
+    return registration
+
+
+class EventMultiplexer(PGEvents):
+    """Per-host event multiplexer.
+
+    The multiplexer holds a single database connection and forwards events to
+    local worker processes that use the ``multiplexer`` event source, so each
+    event crosses the network once per host instead of once per worker.
+    Workers register the tables they listen to, and only receive events for
+    those tables.
+
+    Run it with ``flask pgevents multiplex``, or call ``serve_forever()``.
+
+    Configuration
+    -------------
+    PGEVENTS_MULTIPLEXER_EVENT_SOURCE: str
+        Event source the multiplexer itself uses (default: "notify").
+    PGEVENTS_MULTIPLEXER_SOCKET: str
+        Path of the socket to serve on
+        (default: "/tmp/flask_sqlalchemy_pgevents.sock").
+    PGEVENTS_MULTIPLEXER_BUFFER_SIZE: int
+        Maximum number of bytes buffered for a worker that does not keep up,
+        beyond which it is disconnected (default: 16 MiB).
+    PGEVENTS_MULTIPLEXER_GRACE_PERIOD: float
+        Number of seconds for which events of tables with no connected worker
+        are held, e.g. while workers restart, before they are dropped
+        (default: 60.0).
+
+    Events are acknowledged to the multiplexer's source once written to a
+    worker's socket, in the order they were received, so delivery to workers
+    is at most once: events a worker received but did not handle before it
+    exited are lost.
+    """
+
+    extension_name = "pgevents_multiplexer"
+    event_source_config = "PGEVENTS_MULTIPLEXER_EVENT_SOURCE"
+    # Workers only register their tables once the multiplexer has started
+    drop_orphaned_triggers_config = None
+
+    def __init__(self, app: Optional[Flask] = None) -> None:
+        """Initialize the multiplexer.
+
+        Parameters
+        ----------
+        app: Flask, optional
+            The application to which this multiplexer will be registered.
+
+        """
+        self._server = None  # type: Optional[socket.socket]
+        self._clients = {}  # type: Dict[socket.socket, bytes]
+        self._outgoing = {}  # type: Dict[socket.socket, bytearray]
+        self._buffer_size = DEFAULT_MULTIPLEXER_BUFFER_SIZE  # type: int
+        self._grace_period = DEFAULT_MULTIPLEXER_GRACE_PERIOD  # type: float
+        self._subscribers = defaultdict(set)  # type: Dict[str, Set[socket.socket]]
+        self._captures = {}  # type: Dict[str, Any]
+        # Received events, with the time they were received and whether they
+        # were written to a worker (or dropped), in the order they were received
+        self._pending = deque()  # type: deque
+        self._serving = False  # type: bool
+
+        super().__init__(app)
+
+    def init_app(self, app: Flask) -> None:
+        if app.config.get(self.event_source_config, DEFAULT_EVENT_SOURCE) == "multiplexer":
+            raise ValueError("The multiplexer cannot use the multiplexer event source")
+
+        super().init_app(app)
+
+        self._buffer_size = app.config.get("PGEVENTS_MULTIPLEXER_BUFFER_SIZE", DEFAULT_MULTIPLEXER_BUFFER_SIZE)
+        self._grace_period = app.config.get("PGEVENTS_MULTIPLEXER_GRACE_PERIOD", DEFAULT_MULTIPLEXER_GRACE_PERIOD)
+
+        path = app.config.get("PGEVENTS_MULTIPLEXER_SOCKET", DEFAULT_MULTIPLEXER_SOCKET)
+        if os.path.exists(path):
+            # Only remove the socket left behind by a multiplexer that is gone
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    os.unlink(path)
+                else:
+                    raise RuntimeError("Another multiplexer is serving on {}".format(path))
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+
+    def teardown(self) -> None:
+        if self._server is not None:
+            # Tables stay installed, so that their events wait for the next multiplexer
+            for client in self._clients:
+                client.close()
+            self._clients.clear()
+            self._outgoing.clear()
+            self._subscribers.clear()
+            self._captures.clear()
+            self._pending.clear()
+
+            path = self._server.getsockname()
+            self._server.close()
+            self._server = None
+            if os.path.exists(path):
+                os.unlink(path)
+
+        super().teardown()
+
+    def _disconnect(self, client: socket.socket) -> None:
+        """Forget a worker and all of its subscriptions.
+
+        Parameters
+        ----------
+        client: socket.socket
+            Worker connection.
 
         Returns
         -------
         None
 
         """
-        with self._app.app_context():  # type: ignore
-            flask_sqlalchemy = self._app.extensions["sqlalchemy"]  # type: ignore
-            self._connection = flask_sqlalchemy.db.engine.connect()
-            connection_proxy = self._connection.connection
-            self._psycopg2_connection = connection_proxy.connection
+        self._clients.pop(client, None)
+        self._outgoing.pop(client, None)
+        for table in [table for (table, subscribers) in self._subscribers.items() if client in subscribers]:
+            self._unsubscribe(client, table)
+        client.close()
 
-    def _teardown_connection(self) -> None:
-        """Teardown the database connection.
+    def _serve_clients(self) -> None:
+        """Accept new workers and process pending table registrations.
 
         Returns
         -------
         None
 
         """
-        if self._connection is not None:
-            with self._app.app_context():  # type: ignore
-                self._psycopg2_connection = None
-                self._connection.close()
-                self._connection = None
+        server = self._server
+        assert server is not None
 
-    @staticmethod
-    def _get_full_table_name(model: Model) -> str:
-        """Parse the SQLAlchemy model for the fully-resolved table name.
+        pending = [client for (client, buf) in self._outgoing.items() if buf]
+        (readable, writable, _) = select.select([server] + list(self._clients), pending, [], 0)
+
+        for client in writable:
+            self._flush(client)
+
+        for sock in readable:
+            if sock is server:
+                (client, _) = server.accept()
+                client.setblocking(False)
+                self._clients[client] = b""
+                self._outgoing[client] = bytearray()
+                continue
+
+            # Workers may have been disconnected while flushing
+            if sock in self._clients:
+                self._read_registrations(sock)
+
+    def _read_registrations(self, client: socket.socket) -> None:
+        """Process the table registrations a worker has sent.
 
         Parameters
         ----------
-        model: flask_sqlalchemy.model.Model
-            Model whose name should be resolved.
+        client: socket.socket
+            Worker connection.
 
         Returns
         -------
-        str
-            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
+        None
 
         """
-        table_args = getattr(model, "__table_args__", {})
-        schema_name = table_args.get("schema", "public")
-        table_name = model.__tablename__
+        try:
+            data = client.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(client)
+            return
 
-        return "{schema}.{table}".format(schema=schema_name, table=table_name)
+        (*lines, self._clients[client]) = (self._clients[client] + data).split(b"\n")
+        for line in lines:
+            registration = _parse_registration(line)
+            if registration is None:
+                # A worker sending garbage is broken, it must not stop the others
+                self._disconnect(client)
+                return
+            if registration.get("unregister"):
+                self._unregister(client, registration)
+            else:
+                self._register(client, registration)
 
-    def _install_trigger_for_model(self, model: Model) -> None:
-        """Install a trigger for the given model.
+    def _send(self, client: socket.socket, message: bytes) -> None:
+        """Queue a message for a worker, disconnecting it if it does not keep up.
 
         Parameters
         ----------
-        model: flask_sqlalchemy.model.Model
-            Model to which a trigger should be installed.
+        client: socket.socket
+            Worker connection.
+        message: bytes
+            Message to send.
 
         Returns
         -------
         None
 
         """
-        table = self._get_full_table_name(model)
-        (schema_name, table_name) = table.split(".")
+        buf = self._outgoing[client]
+        if len(buf) + len(message) > self._buffer_size:
+            self._disconnect(client)
+            return
 
-        pgevts.install_trigger(self._psycopg2_connection, table_name, schema=schema_name)
+        buf += message
+        self._flush(client)
 
-    def listen(self, target: Model, identifiers: Set, fn: Callable) -> None:
-        """Listen to PGEvents events for a given model.
+    def _flush(self, client: socket.socket) -> None:
+        """Send as much of a worker's buffered messages as it accepts without blocking.
 
-        This method's signature mirrors the `sqlalchemy.event.listen` method for
-        consistency.
+        Parameters
+        ----------
+        client: socket.socket
+            Worker connection.
+
+        Returns
+        -------
+        None
+
+        """
+        buf = self._outgoing[client]
+        while buf:
+            try:
+                sent = client.send(buf)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._disconnect(client)
+                return
+            del buf[:sent]
+
+    def _register(self, client: socket.socket, registration: Dict) -> None:
+        """Subscribe a worker to a table, installing the table if needed.
 
         Parameters
         ----------
-        target: flask_sqlalchemy.model.Model
-            SQLAlchemy model class for which to listen.
-        identifiers: set
-            Event or events that this trigger should listen for. Should be one
-            of "insert", "update", or "delete".
-        fn: Callable
-            Method to call when an event matches this trigger.
+        client: socket.socket
+            Worker connection.
+        registration: dict
+            Table registration sent by the worker.
 
         Returns
         -------
         None
 
         """
-        installed = False
+        schema_name = registration["schema_name"]
+        table_name = registration["table_name"]
+        table = "{}.{}".format(schema_name, table_name)
 
-        if not identifiers:
-            raise ValueError("At least one identifier must be provided")
+        capture = registration.get("capture")
+        if isinstance(capture, list):
+            capture = tuple(capture)
 
-        invalid_identifiers = identifiers.difference(IDENTIFIERS)
-        if invalid_identifiers:
-            raise ValueError("Invalid identifiers: {}".format(list(invalid_identifiers)))
+        # Tables of "orm" mode listeners emit their own events
+        if not registration.get("install", True):
+            self._subscribers[table].add(client)
+            return
 
-        if self._initialized:
-            self._install_trigger_for_model(target)
-            installed = True
+        # Workers may capture different columns of the same table
+        merged_capture = _merge_capture(self._captures.get(table), capture)
+        if table not in self._captures or merged_capture != self._captures[table]:
+            self._event_source.install(table_name, schema_name, merged_capture)  # type: ignore
+            self._captures[table] = merged_capture
 
-        trigger_name = self._get_full_table_name(target)
+        self._subscribers[table].add(client)
 
-        self._triggers[trigger_name].append(Trigger(target, fn, identifiers, installed))
+    def _unregister(self, client: socket.socket, registration: Dict) -> None:
+        """Unsubscribe a worker from a table, uninstalling the table once it has no subscribers.
 
-    def listens_for(self, target: Model, identifiers: Set) -> Callable:
-        """Decorate a function as a callback for one or several PGEvents events.
+        Parameters
+        ----------
+        client: socket.socket
+            Worker connection.
+        registration: dict
+            Table registration sent by the worker.
 
-        This method's signature mirrors the `sqlalchemy.event.listen` method for
-        consistency.
+        Returns
+        -------
+        None
+
+        """
+        self._unsubscribe(client, "{}.{}".format(registration["schema_name"], registration["table_name"]))
+
+    def _unsubscribe(self, client: socket.socket, table: str) -> None:
+        """Unsubscribe a worker from a table, uninstalling the table once it has no subscribers.
 
         Parameters
         ----------
-        target: flask_sqlalchemy.model.Model
-            SQLAlchemy model class for which to listen.
-        identifiers: set
-            Event or events that this trigger should listen for. Should be one
-            of "insert", "update", or "delete".
-        fn: Callable
-            Method to call when an event matches this trigger.
+        client: socket.socket
+            Worker connection.
+        table: str
+            Fully-resolved table name, in the form "<SCHEMA>.<TABLE>".
 
         Returns
         -------
         None
 
         """
+        subscribers = self._subscribers.get(table, set())
+        subscribers.discard(client)
+        if subscribers:
+            return
 
-        def decorate(fn):
-            self.listen(target, identifiers, fn)
-            return fn
+        self._subscribers.pop(table, None)
+        if table in self._captures:
+            del self._captures[table]
+            (schema_name, table_name) = table.split(".")
+            self._event_source.uninstall(table_name, schema_name)  # type: ignore
 
-        return decorate
+    def _get_watched_tables(self) -> Set[str]:
+        return super()._get_watched_tables() | set(self._captures)
 
     def handle_events(self, timeout: float = 0.0) -> None:
-        """Handle PGEvents events, according to registered triggers.
+        """Forward events to the workers that registered their tables.
 
         Parameters
         ----------
@@ -257,7 +6831,7 @@ class PGEvents:
         Raises
         ------
         RuntimeError
-            Raises if the extension has not yet been initialized.
+            Raises if the multiplexer has not yet been initialized.
 
         Returns
         -------
@@ -267,15 +6841,121 @@ class PGEvents:
         if not self._initialized:
             raise RuntimeError("Extension not initialized.")
 
-        for evt in pgevts.poll(self._psycopg2_connection, timeout=timeout):
-            table = "{}.{}".format(evt.schema_name, evt.table_name)
+        self._serve_clients()
 
-            triggers = self._triggers.get(table, [])
-            if not triggers:
-                continue
+        now = time.monotonic()
+        self._pending.extend([evt, now, False] for evt in self._event_source.poll(timeout))  # type: ignore
 
-            for trig in triggers:
-                if evt.type.lower() not in trig.events:
-                    continue
+        for entry in self._pending:
+            if not entry[2]:
+                # Events that no worker took are dropped once the grace period is over
+                entry[2] = self._forward(entry[0]) or now - entry[1] >= self._grace_period
+
+        # Events are acknowledged once forwarded, as workers do not report back,
+        # but not past those still held for a worker
+        forwarded = []
+        while self._pending and self._pending[0][2]:
+            forwarded.append(self._pending.popleft()[0])
+        self._ack(forwarded)
+
+    def _forward(self, evt: Event) -> bool:
+        """Write an event to the workers that registered its table.
+
+        Parameters
+        ----------
+        evt: Event
+            Event to forward.
+
+        Returns
+        -------
+        bool
+            Whether or not a worker took the event.
+
+        """
+        clients = list(self._subscribers.get("{}.{}".format(evt.schema_name, evt.table_name), ()))
+
+        message = (evt.tojson() + "\n").encode("utf-8")
+        for client in clients:
+            self._send(client, message)
+
+        # Workers that do not keep up are disconnected rather than sent the event
+        return any(client in self._clients for client in clients)
+
+    def serve_forever(self, timeout: float = 0.1) -> None:
+        """Forward events until stop() is called.
+
+        Parameters
+        ----------
+        timeout: float
+            Number of seconds to block when polling for events in each cycle.
+
+        Returns
+        -------
+        None
+
+        """
+        self._serving = True
+        while self._serving:
+            self.handle_events(timeout=timeout)
+
+    def stop(self) -> None:
+        """Stop serve_forever().
+
+        Returns
+        -------
+        None
+
+        """
+        self._serving = False
+
+
+cli = AppGroup("pgevents", help="PGEvents commands.")
+
+
+@cli.command("multiplex")
+@click.option("--timeout", default=0.1, show_default=True, help="Seconds to block when polling for events.")
+def multiplex_command(timeout: float) -> None:
+    """Run the per-host event multiplexer."""
+    multiplexer = EventMultiplexer(current_app._get_current_object())  # type: ignore
+
+    try:
+        multiplexer.serve_forever(timeout=timeout)
+    finally:
+        multiplexer.teardown()
+
+
+def _parse_replay_bound(ctx: click.Context, param: click.Parameter, value: Optional[str]) -> Any:
+    """Parse an event ID or ISO 8601 time given to the replay command."""
+    if value is None or value.isdigit():
+        return None if value is None else int(value)
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise click.BadParameter("must be an event ID or an ISO 8601 time")
+
+
+@cli.command("replay")
+@click.option("--table", help='Only replay the events of this table ("<SCHEMA>.<TABLE>").')
+@click.option("--since", callback=_parse_replay_bound, help="ID of the first event, or time from which to replay.")
+@click.option("--until", callback=_parse_replay_bound, help="ID of the last event, or time until which to replay.")
+@click.option("--workers", default=1, show_default=True, help="Number of worker processes.")
+@click.option("--callback", help="Only call the callback with this name.")
+@click.option("--chunk-size", default=DEFAULT_REPLAY_CHUNK_SIZE, show_default=True, help="Events fetched at once.")
+def replay_command(
+    table: Optional[str], since: Any, until: Any, workers: int, callback: Optional[str], chunk_size: int
+) -> None:
+    """Replay stored events through the registered listeners."""
+    pgevents = current_app.extensions.get(PGEvents.extension_name)
+    if pgevents is None:
+        raise click.UsageError("PGEvents is not initialized")
+
+    def progress(done: int, total: int, events: int, elapsed: float) -> None:
+        rate = events / elapsed if elapsed else 0.0
+        click.echo("{}/{} ranges, {} events replayed ({:.0f} events/s)".format(done, total, events, rate))
+
+    try:
+        count = pgevents.replay(table, since, until, workers, callback, chunk_size, progress)
+    except NotImplementedError as exc:
+        raise click.UsageError(str(exc))
 
-                trig.callback(evt.id, evt.row_id, evt.type)
+    click.echo("Replayed {} events".format(count))
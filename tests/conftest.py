@@ -54,8 +54,8 @@ def db(app):
     app: Flask
         Test Flask application to which the extension should be registered.
 
-    Returns
-    -------
+    Yields
+    ------
     flask_sqlalchemy.SQLAlchemy
         Flask-SQLAlchemy database controller
 
@@ -68,7 +68,11 @@ def db(app):
     meta.reflect()
     meta.drop_all()
 
-    return db_
+    yield db_
+
+    # Release the pooled connections, so that they don't pile up across tests
+    db_.session.remove()
+    db_.engine.dispose()
 
 
 def patched_visit_create_schema(self_, create):
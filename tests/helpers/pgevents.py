@@ -10,3 +10,10 @@ class create_pgevents:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.pgevents.teardown()
+
+
+def handle_events_until(pg, predicate, attempts=10):
+    for _ in range(attempts):
+        pg.handle_events(timeout=0.5)
+        if predicate():
+            return
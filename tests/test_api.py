@@ -1,10 +1,31 @@
+import threading
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from uuid import uuid4
+
+from flask_sqlalchemy_pgevents import Bulkhead, Tracer
 from helpers.db import create_all, create_connection
-from helpers.pgevents import create_pgevents
-from psycopg2_pgevents import trigger_installed
-from pytest import raises
+from helpers.pgevents import create_pgevents, handle_events_until
+from psycopg2_pgevents import execute, trigger_installed
+from pytest import importorskip, raises
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.schema import CreateSchema
 
 
+class RecordingTracer(Tracer):
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+
+    def current_trace_id(self):
+        return self.trace_id
+
+    def span(self, evt, callback):
+        self.spans.append((evt.trace_id, callback.__name__))
+        return super().span(evt, callback)
+
+
 class TestApi:
     def test_listen_no_identifier(self, app, db):
         class Widget(db.Model):
@@ -527,3 +548,1357 @@ class TestApi:
             pg.handle_events()
 
             assert widget_callback_called == 0
+
+    def test_handle_events_batch_session(self, app, db):
+        app.config["PGEVENTS_BATCH_SESSION"] = True
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            class Log(db.Model):
+                __tablename__ = "log"
+                id = db.Column(db.Integer, primary_key=True)
+                widget_id = db.Column(db.Integer)
+
+            create_all(db)
+
+            sessions = set()
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                sessions.add(id(pg.session))
+                pg.session.add(Log(widget_id=row_id))
+
+            db.session.add(Widget())
+            db.session.add(Widget())
+            db.session.commit()
+
+            # Work the application left pending is not committed by the cycle
+            db.session.add(Log(widget_id=-1))
+
+            pg.handle_events(timeout=0.1)
+            db.session.rollback()
+
+            assert len(sessions) == 1
+            assert sessions != {id(db.session())}
+            assert sorted(log.widget_id for log in Log.query.all()) == [1, 2]
+
+    def test_handle_events_batch_session_callback_error(self, app, db):
+        app.config["PGEVENTS_BATCH_SESSION"] = True
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            class Log(db.Model):
+                __tablename__ = "log"
+                id = db.Column(db.Integer, primary_key=True)
+                widget_id = db.Column(db.Integer)
+
+            create_all(db)
+
+            @pg.listens_for(Widget, {"insert"})
+            def log_callback(event_id, row_id, identifier):
+                pg.session.add(Log(widget_id=row_id))
+
+            @pg.listens_for(Widget, {"insert"})
+            def failing_callback(event_id, row_id, identifier):
+                pg.session.add(Log(widget_id=-1))
+                pg.session.flush()
+                raise ValueError()
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = widget.id
+
+            with raises(ValueError):
+                pg.handle_events()
+
+            assert [log.widget_id for log in Log.query.all()] == [widget_id]
+
+    def test_handle_events_retry(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 3
+        app.config["PGEVENTS_RETRY_BACKOFF"] = 0.01
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            attempts = []
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                attempts.append(row_id)
+                if len(attempts) < 3:
+                    raise ValueError()
+                row_ids.append(row_id)
+
+            @pg.listens_for(Widget, {"insert"})
+            def other_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            # The failure does not escape, nor stop the other callback
+            pg.handle_events(timeout=0.1)
+
+            assert row_ids == [widget.id]
+
+            while len(attempts) < 3:
+                pg.handle_events(timeout=0.1)
+
+            assert row_ids == [widget.id, widget.id]
+            assert not pg._retries
+
+    def test_handle_events_dead_letter(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 2
+        app.config["PGEVENTS_RETRY_BACKOFF"] = 0.01
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+            fail = True
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                if fail:
+                    raise ValueError()
+                row_ids.append(row_id)
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            pg.handle_events(timeout=0.1)
+            while pg._retries:
+                pg.handle_events(timeout=0.1)
+
+            with create_connection(db, raw=True) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT callback, attempts FROM public.flask_sqlalchemy_pgevents_dead_letter")
+                assert cursor.fetchall() == [(widget_callback.__module__ + "." + widget_callback.__qualname__, 2)]
+
+            assert pg.replay_dead_letters() == 0
+
+            fail = False
+
+            assert pg.replay_dead_letters() == 1
+            assert row_ids == [widget.id]
+            assert pg.replay_dead_letters() == 0
+
+    def test_teardown_pending_retries(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 3
+        app.config["PGEVENTS_RETRY_BACKOFF"] = 60.0
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                raise ValueError()
+
+            db.session.add(Widget())
+            db.session.commit()
+
+            pg.handle_events(timeout=0.1)
+
+            assert len(pg._retries) == 1
+
+        # The event was acknowledged, so the pending retry must not be lost
+        with create_connection(db, raw=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT callback, attempts FROM public.flask_sqlalchemy_pgevents_dead_letter")
+            assert cursor.fetchall() == [(widget_callback.__module__ + "." + widget_callback.__qualname__, 1)]
+
+    def test_handle_events_bulkhead(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 3
+        app.config["PGEVENTS_RETRY_BACKOFF"] = 0.01
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            bulkhead = Bulkhead(timeout=0.1)
+            unblocked = threading.Event()
+            attempts = []
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"}, bulkhead=bulkhead)
+            def slow_callback(event_id, row_id, identifier):
+                attempts.append(row_id)
+                unblocked.wait()
+
+            @pg.listens_for(Widget, {"insert"})
+            def fast_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            # The stuck callback is abandoned, without holding up the other
+            started = time.monotonic()
+            handle_events_until(pg, lambda: bulkhead.timeouts)
+
+            assert time.monotonic() - started < 2.0
+            assert row_ids == [widget.id]
+            assert attempts == [widget.id]
+
+            unblocked.set()
+            handle_events_until(pg, lambda: len(attempts) == 2 and not pg._retries)
+
+            assert attempts == [widget.id, widget.id]
+            assert bulkhead.timeouts == 1
+
+    def test_handle_events_bulkhead_full(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 5
+        app.config["PGEVENTS_RETRY_BACKOFF"] = 0.01
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            bulkhead = Bulkhead(max_concurrency=1, max_queue=0)
+            unblocked = threading.Event()
+            attempts = []
+
+            @pg.listens_for(Widget, {"insert"}, bulkhead=bulkhead)
+            def slow_callback(event_id, row_id, identifier):
+                attempts.append(row_id)
+                unblocked.wait()
+
+            widgets = [Widget(), Widget()]
+            db.session.add_all(widgets)
+            db.session.commit()
+            widget_ids = [widget.id for widget in widgets]
+
+            # The second callback finds the only thread taken, and no room to queue
+            handle_events_until(pg, lambda: bulkhead.rejections)
+
+            assert bulkhead.rejections == 1
+            assert len(pg._retries) == 1
+
+            unblocked.set()
+            handle_events_until(pg, lambda: len(attempts) == 2 and not pg._retries and not pg._received)
+
+            assert attempts == widget_ids
+
+    def test_handle_events_bulkhead_wedged(self, app, db):
+        app.config["PGEVENTS_RETRY_ATTEMPTS"] = 1
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            bulkhead = Bulkhead(max_concurrency=1, timeout=0.1)
+            unblocked = threading.Event()
+            attempts = []
+
+            @pg.listens_for(Widget, {"insert"}, bulkhead=bulkhead)
+            def stuck_callback(event_id, row_id, identifier):
+                attempts.append(row_id)
+                unblocked.wait()
+
+            db.session.add_all([Widget(), Widget()])
+            db.session.commit()
+
+            try:
+                # The abandoned callback holds the only thread, so the queued one is cancelled
+                handle_events_until(pg, lambda: bulkhead.timeouts and not pg._bulkhead_calls)
+
+                assert len(attempts) == 1
+                assert bulkhead.wedged
+            finally:
+                unblocked.set()
+
+            with create_connection(db, raw=True) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT error FROM public.flask_sqlalchemy_pgevents_dead_letter ORDER BY id")
+                errors = [error for (error,) in cursor.fetchall()]
+
+            assert len(errors) == 2
+            assert errors[0].startswith("TimeoutError")
+            assert errors[1].startswith("RuntimeError") and "wedged" in errors[1]
+
+    def test_handle_events_bulkhead_running(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            unblocked = threading.Event()
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"}, bulkhead=Bulkhead())
+            def slow_callback(event_id, row_id, identifier):
+                unblocked.wait()
+
+            @pg.listens_for(Widget, {"insert"})
+            def fast_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            # The running callback doesn't hold up the poll cycle, but its event isn't acknowledged
+            started = time.monotonic()
+            handle_events_until(pg, lambda: row_ids)
+
+            assert time.monotonic() - started < 2.0
+            assert row_ids == [widget.id]
+            assert pg._received
+
+            unblocked.set()
+            handle_events_until(pg, lambda: not pg._received)
+
+            assert row_ids == [widget.id]
+
+    def test_listen_bulkhead_batch_session(self, app, db):
+        app.config["PGEVENTS_BATCH_SESSION"] = True
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None, bulkhead=Bulkhead())
+
+        with raises(ValueError):
+            Bulkhead(max_concurrency=0)
+
+        with raises(ValueError):
+            Bulkhead(timeout=None)
+
+    def test_handle_events_group(self, app, db):
+        app.config["PGEVENTS_LANE_CAPACITY"] = 4
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            groups = []
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"}, group="transaction")
+            def group_callback(txid, events):
+                groups.append((txid, [(evt.type, evt.model, evt.row_id) for evt in events]))
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            transactions = []
+            for _ in range(2):
+                widgets = [Widget(), Widget(), Widget()]
+                db.session.add_all(widgets)
+                db.session.commit()
+                transactions.append([widget.id for widget in widgets])
+
+            # The lanes only fit part of the second transaction at first
+            pg.handle_events(timeout=0.1)
+
+            assert row_ids == transactions[0] + transactions[1][:1]
+            assert [events for (_, events) in groups] == [[("INSERT", Widget, row_id) for row_id in transactions[0]]]
+
+            handle_events_until(pg, lambda: len(groups) == 2)
+
+            assert row_ids == transactions[0] + transactions[1]
+            assert [events for (_, events) in groups] == [
+                [("INSERT", Widget, row_id) for row_id in transaction] for transaction in transactions
+            ]
+            assert groups[0][0] != groups[1][0]
+            assert not pg._received
+
+    def test_listen_invalid_group(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, lambda txid, events: None, group="row")
+
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, lambda txid, events: None, group="transaction", bulkhead=Bulkhead())
+
+    def test_listen_invalid_mode(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        def callback(event_id, row_id, identifier):
+            pass
+
+        with create_pgevents(app) as pg:
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, callback, mode="telepathy")
+
+            assert "public.widget" not in pg._triggers
+
+    def test_listen_mixed_modes(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        def callback(event_id, row_id, identifier):
+            pass
+
+        with create_pgevents(app) as pg:
+            pg.listen(Widget, {"insert"}, callback)
+
+            with raises(ValueError):
+                pg.listen(Widget, {"delete"}, callback, mode="orm")
+
+            assert len(pg._triggers["public.widget"]) == 1
+
+    def test_listen_orm_mode(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        def callback(event_id, row_id, identifier):
+            pass
+
+        with create_pgevents(app) as pg:
+            pg.listen(Widget, {"insert"}, callback, mode="orm")
+
+            trigger = pg._triggers["public.widget"][0]
+            assert trigger.installed
+            assert trigger.mode == "orm"
+
+            with create_connection(db, raw=True) as conn:
+                trigger_installed_ = trigger_installed(conn, "widget")
+                assert not trigger_installed_
+
+    def test_handle_events_orm_mode(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            create_all(db)
+
+            events = []
+
+            @pg.listens_for(Widget, {"insert", "update", "delete"}, mode="orm")
+            def widget_callback(event_id, row_id, identifier):
+                events.append((row_id, identifier))
+
+            widgets = [Widget(label="foo"), Widget(label="foo")]
+            db.session.add_all(widgets)
+            db.session.commit()
+
+            widgets[0].label = "bar"
+            db.session.delete(widgets[1])
+            db.session.commit()
+
+            # Rolled back changes produce no events
+            db.session.add(Widget())
+            db.session.flush()
+            db.session.rollback()
+
+            pg.handle_events(timeout=0.1)
+
+            assert events == [
+                (widgets[0].id, "INSERT"),
+                (widgets[1].id, "INSERT"),
+                (widgets[0].id, "UPDATE"),
+                (widgets[1].id, "DELETE"),
+            ]
+
+    def test_handle_events_orm_mode_savepoint(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"}, mode="orm")
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.flush()
+
+            db.session.begin_nested()
+            db.session.add(Widget())
+            db.session.flush()
+            db.session.rollback()
+
+            db.session.commit()
+
+            pg.handle_events(timeout=0.1)
+
+            assert row_ids == [widget.id]
+
+    def test_unlisten(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            def other_callback(event_id, row_id, identifier):
+                pass
+
+            pg.listen(Widget, {"insert", "delete"}, widget_callback)
+            pg.listen(Widget, {"insert"}, other_callback)
+
+            with raises(ValueError):
+                pg.unlisten(Widget, {"update"}, widget_callback)
+            with raises(ValueError):
+                pg.unlisten(Widget, {"upsert"}, widget_callback)
+
+            pg.unlisten(Widget, {"insert"}, widget_callback)
+
+            assert [trig.events for trig in pg._triggers["public.widget"]] == [{"delete"}, {"insert"}]
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+            db.session.delete(widget)
+            db.session.commit()
+
+            handle_events_until(pg, lambda: row_ids)
+
+            assert row_ids == [widget.id]
+
+            # The trigger is dropped with the last listener
+            pg.unlisten(Widget, {"delete"}, widget_callback)
+            with create_connection(db, raw=True) as conn:
+                assert trigger_installed(conn, "widget")
+
+            pg.unlisten(Widget, {"insert"}, other_callback)
+
+            assert "public.widget" not in pg._triggers
+            with create_connection(db, raw=True) as conn:
+                assert not trigger_installed(conn, "widget")
+
+    def test_drop_orphaned_triggers(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        # A previous deploy listened to both tables
+        with create_pgevents(app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+            pg.listen(Gadget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+        app.config["PGEVENTS_DROP_ORPHANED_TRIGGERS"] = True
+
+        with create_pgevents() as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+            pg.init_app(app)
+
+            with create_connection(db, raw=True) as conn:
+                assert trigger_installed(conn, "widget")
+                assert not trigger_installed(conn, "gadget")
+
+            assert pg.drop_orphaned_triggers() == []
+
+    def test_handle_events_pattern(self, app, db):
+        tenants = ("tenant_a", "tenant_b", "tenant_c")
+        with create_connection(db, raw=True) as conn:
+            for tenant in tenants:
+                execute(conn, "DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};".format(tenant))
+            execute(conn, "CREATE TABLE tenant_a.orders (id serial PRIMARY KEY);")
+            execute(conn, "CREATE TABLE tenant_a.invoices (id serial PRIMARY KEY);")
+
+        try:
+            with create_pgevents(app) as pg:
+                events = []
+
+                @pg.listens_for_pattern("tenant_*", "orders*", {"insert"})
+                def orders_callback(event_id, row_id, identifier, table):
+                    events.append((table, row_id))
+
+                with create_connection(db, raw=True) as conn:
+                    assert trigger_installed(conn, "orders", "tenant_a")
+                    assert not trigger_installed(conn, "invoices", "tenant_a")
+
+                    # New matching tables are installed by the database
+                    execute(conn, "CREATE TABLE tenant_b.orders_2024 (id serial PRIMARY KEY);")
+                    assert trigger_installed(conn, "orders_2024", "tenant_b")
+
+                    for table in ("tenant_a.orders", "tenant_b.orders_2024", "tenant_a.invoices"):
+                        execute(conn, "INSERT INTO {} DEFAULT VALUES;".format(table))
+
+                handle_events_until(pg, lambda: len(events) == 2)
+
+                assert sorted(events) == [("tenant_a.orders", 1), ("tenant_b.orders_2024", 1)]
+
+                pg.unlisten_pattern("tenant_*", "orders*", {"insert"}, orders_callback)
+
+                with create_connection(db, raw=True) as conn:
+                    execute(conn, "CREATE TABLE tenant_c.orders (id serial PRIMARY KEY);")
+                    assert not trigger_installed(conn, "orders", "tenant_c")
+
+                assert pg.drop_orphaned_triggers() == ["tenant_a.orders", "tenant_b.orders_2024"]
+        finally:
+            with create_connection(db, raw=True) as conn:
+                for tenant in tenants:
+                    execute(conn, "DROP SCHEMA {} CASCADE;".format(tenant))
+
+    def test_unlisten_pattern_match(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(app) as pg:
+
+            def widget_callback(event_id, row_id, identifier):
+                pass
+
+            pg.listen_pattern("public", "widget*", {"insert"}, lambda event_id, row_id, identifier, table: None)
+            pg.listen(Widget, {"insert"}, widget_callback)
+            pg.unlisten(Widget, {"insert"}, widget_callback)
+
+            # The pattern still matches the table
+            with create_connection(db, raw=True) as conn:
+                assert trigger_installed(conn, "widget")
+
+    def test_listen_capture(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+            size = db.Column(db.Integer)
+
+        create_all(db)
+
+        def callback(event_id, row_id, identifier, data):
+            pass
+
+        with create_pgevents(app) as pg:
+            pg.listen(Widget, {"insert"}, callback, capture=[Widget.size, "label"])
+            pg.listen(Widget, {"update"}, callback, capture=True)
+            pg.listen(Widget, {"delete"}, callback)
+
+            assert [trigger.capture for trigger in pg._triggers["public.widget"]] == [("label", "size"), "*", None]
+            assert pg._get_table_capture("public.widget") == "*"
+
+    def test_handle_events_capture(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+                size = db.Column(db.Integer)
+
+            create_all(db)
+
+            captured = []
+            uncaptured = []
+
+            @pg.listens_for(Widget, {"insert", "update", "delete"}, capture=["label"])
+            def capture_callback(event_id, row_id, identifier, data):
+                captured.append((identifier, data))
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                uncaptured.append(row_id)
+
+            widget = Widget(label="foo", size=1)
+            db.session.add(widget)
+            db.session.commit()
+
+            widget.label = "bar"
+            db.session.commit()
+
+            db.session.delete(widget)
+            db.session.commit()
+
+            handle_events_until(pg, lambda: len(captured) == 3)
+
+            assert captured == [
+                ("INSERT", {"new": {"label": "foo"}, "old": None}),
+                ("UPDATE", {"new": {"label": "bar"}, "old": {"label": "foo"}}),
+                ("DELETE", {"new": None, "old": {"label": "bar"}}),
+            ]
+            assert len(uncaptured) == 1
+
+    def test_handle_events_capture_too_large(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            create_all(db)
+
+            captured = []
+
+            @pg.listens_for(Widget, {"insert"}, capture=["label"])
+            def capture_callback(event_id, row_id, identifier, data):
+                captured.append(data)
+
+            # Too large for a NOTIFY payload, which would fail the transaction
+            db.session.add(Widget(label="x" * 10000))
+            db.session.commit()
+
+            handle_events_until(pg, lambda: captured)
+
+            assert captured == [{"new": None, "old": None, "truncated": True}]
+
+    def test_handle_events_capture_orm_mode(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+                size = db.Column(db.Integer)
+
+            create_all(db)
+
+            captured = []
+
+            @pg.listens_for(Widget, {"insert", "update", "delete"}, mode="orm", capture=True)
+            def capture_callback(event_id, row_id, identifier, data):
+                captured.append((identifier, data))
+
+            widget = Widget(label="foo", size=1)
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = widget.id
+
+            widget.label = "bar"
+            db.session.commit()
+
+            db.session.delete(widget)
+            db.session.commit()
+
+            handle_events_until(pg, lambda: len(captured) == 3)
+
+            assert captured == [
+                ("INSERT", {"new": {"id": widget_id, "label": "foo", "size": 1}, "old": None}),
+                (
+                    "UPDATE",
+                    {
+                        "new": {"id": widget_id, "label": "bar", "size": 1},
+                        "old": {"id": widget_id, "label": "foo", "size": 1},
+                    },
+                ),
+                ("DELETE", {"new": None, "old": {"id": widget_id, "label": "bar", "size": 1}}),
+            ]
+
+    def test_iter_events(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            class Gadget(db.Model):
+                __tablename__ = "gadget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier, data: None, capture=["label"])
+
+            widget = Widget(label="foo")
+            db.session.add(widget)
+            db.session.commit()
+
+            records = list(pg.iter_events(timeout=0.1))
+
+            assert [(r.type, r.model, r.row_id, r.data) for r in records] == [
+                ("INSERT", Widget, widget.id, {"new": {"label": "foo"}, "old": None})
+            ]
+            assert not hasattr(records[0], "__dict__")
+
+    def test_iter_events_tables(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            class Gadget(db.Model):
+                __tablename__ = "gadget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            # Gadget has no listeners; iterating over its events watches it
+            assert list(pg.iter_events(timeout=0.0, tables=[Gadget])) == []
+
+            with create_connection(db, raw=True) as conn:
+                assert trigger_installed(conn, "gadget")
+
+            db.session.add_all([Gadget() for _ in range(3)])
+            db.session.commit()
+            db.session.add(Widget())
+            db.session.commit()
+
+            records = pg.iter_events(max_events=2, tables=[Gadget])
+
+            assert [(r.model, r.type) for r in records] == [(Gadget, "INSERT"), (Gadget, "INSERT")]
+            assert [r.model for r in pg.iter_events(timeout=0.1)] == [Gadget, Widget]
+
+    def test_listen_invalid_priority(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        with create_pgevents(app) as pg:
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None, priority=0)
+
+    def test_listen_invalid_partitioning(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            tenant_id = db.Column(db.Integer)
+
+        create_all(db)
+
+        with create_pgevents(app) as pg:
+            with raises(ValueError):
+                pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None, partition_by="tenant_id")
+            with raises(ValueError):
+                pg.listen(
+                    Widget, {"insert"}, lambda event_id, row_id, identifier: None, partition_by="tenant_id", partitions=0
+                )
+            with raises(ValueError):
+                pg.listen(
+                    Widget,
+                    {"insert"},
+                    lambda event_id, row_id, identifier: None,
+                    mode="orm",
+                    partition_by="tenant_id",
+                    partitions=4,
+                )
+
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+            with raises(ValueError):
+                pg.listen(
+                    Widget, {"insert"}, lambda event_id, row_id, identifier: None, partition_by="tenant_id", partitions=4
+                )
+
+    def test_handle_events_partitions(self, app, db):
+        app.config["PGEVENTS_REBALANCE_INTERVAL"] = 0.0
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            tenant_id = db.Column(db.Integer)
+
+        create_all(db)
+
+        with create_pgevents(app) as pg1, create_pgevents(app) as pg2:
+            row_ids = {pg1: [], pg2: []}
+            for pg in (pg1, pg2):
+                pg.listen(
+                    Widget,
+                    {"insert"},
+                    lambda event_id, row_id, identifier, pg=pg: row_ids[pg].append(row_id),
+                    partition_by=Widget.tenant_id,
+                    partitions=4,
+                )
+
+            # The first consumer takes all partitions, then hands over half of
+            # them to the second one
+            assert pg1.assigned_partitions == {"public.widget": {0, 1, 2, 3}}
+            assert pg2.assigned_partitions == {"public.widget": set()}
+
+            pg1.handle_events()
+            pg2.handle_events()
+
+            assert pg1.assigned_partitions == {"public.widget": {0, 1}}
+            assert pg2.assigned_partitions == {"public.widget": {2, 3}}
+
+            widgets = [Widget(tenant_id=tenant_id) for tenant_id in range(16)]
+            db.session.add_all(widgets)
+            db.session.commit()
+
+            handle_events_until(pg1, lambda: False, attempts=2)
+            handle_events_until(pg2, lambda: False, attempts=2)
+
+            assert row_ids[pg1] and row_ids[pg2]
+            assert sorted(row_ids[pg1] + row_ids[pg2]) == sorted(widget.id for widget in widgets)
+
+            # The partitions of a consumer that leaves are taken over
+            pg2.teardown()
+            pg1.handle_events()
+
+            assert pg1.assigned_partitions == {"public.widget": {0, 1, 2, 3}}
+
+    def test_listens_for_partitions_rebalance(self, app, db):
+        app.config["PGEVENTS_REBALANCE_INTERVAL"] = 0.0
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            tenant_id = db.Column(db.Integer)
+
+        create_all(db)
+
+        def add_widgets():
+            widgets = [Widget(tenant_id=tenant_id) for tenant_id in range(16)]
+            db.session.add_all(widgets)
+            db.session.commit()
+            return sorted(widget.id for widget in widgets)
+
+        with create_pgevents(app) as pg1:
+            row_ids = {pg1: []}
+
+            @pg1.listens_for(Widget, {"insert"}, partition_by="tenant_id", partitions=4)
+            def widget_callback1(event_id, row_id, identifier):
+                row_ids[pg1].append(row_id)
+
+            pg1.handle_events()
+
+            assert pg1.assigned_partitions == {"public.widget": {0, 1, 2, 3}}
+
+            # A second consumer joins, and the partitions are split between them
+            with create_pgevents(app) as pg2:
+                row_ids[pg2] = []
+
+                @pg2.listens_for(Widget, {"insert"}, partition_by="tenant_id", partitions=4)
+                def widget_callback2(event_id, row_id, identifier):
+                    row_ids[pg2].append(row_id)
+
+                pg2.handle_events()
+                pg1.handle_events()
+                pg2.handle_events()
+
+                assert pg1.assigned_partitions == {"public.widget": {0, 1}}
+                assert pg2.assigned_partitions == {"public.widget": {2, 3}}
+
+                widget_ids = add_widgets()
+                handle_events_until(pg1, lambda: False, attempts=2)
+                handle_events_until(pg2, lambda: False, attempts=2)
+
+                assert row_ids[pg1] and row_ids[pg2]
+                assert sorted(row_ids[pg1] + row_ids[pg2]) == widget_ids
+
+            # The first consumer gets the partitions back once the second leaves
+            pg1.handle_events()
+
+            assert pg1.assigned_partitions == {"public.widget": {0, 1, 2, 3}}
+
+            row_ids[pg1].clear()
+            widget_ids = add_widgets()
+            handle_events_until(pg1, lambda: len(row_ids[pg1]) == len(widget_ids))
+
+            assert sorted(row_ids[pg1]) == widget_ids
+
+    def test_handle_events_priority(self, app, db):
+        app.config["PGEVENTS_EVENT_SOURCE"] = "polling"
+        app.config["PGEVENTS_LANE_BUDGET"] = 2
+
+        with create_pgevents(app) as pg:
+
+            class AuditLog(db.Model):
+                __tablename__ = "audit_log"
+                id = db.Column(db.Integer, primary_key=True)
+
+            class Payment(db.Model):
+                __tablename__ = "payment"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            dispatched = []
+
+            @pg.listens_for(AuditLog, {"insert"})
+            def audit_log_callback(event_id, row_id, identifier):
+                dispatched.append("audit_log")
+
+            @pg.listens_for(Payment, {"insert"}, priority=10)
+            def payment_callback(event_id, row_id, identifier):
+                dispatched.append("payment")
+
+            db.session.add_all([AuditLog() for _ in range(3)])
+            db.session.commit()
+
+            pg.handle_events(timeout=0.1)
+
+            assert dispatched == ["audit_log", "audit_log"]
+            assert pg.lane_depths == {1: 1}
+
+            db.session.add(Payment())
+            db.session.add(AuditLog())
+            db.session.commit()
+
+            pg.handle_events(timeout=0.1)
+
+            # The payment overtakes the audit logs received before it
+            assert dispatched[2:] == ["payment", "audit_log"]
+            assert pg.lane_depths == {1: 1, 10: 0}
+
+            pg.handle_events()
+
+            assert dispatched[4:] == ["audit_log"]
+            assert pg.lane_depths == {1: 0, 10: 0}
+
+    def test_cached_invalid_primary_key(self, app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            code = db.Column(db.Text, primary_key=True)
+
+        with create_pgevents(app) as pg:
+            with raises(ValueError):
+                pg.cached(Widget)
+
+    def test_cached(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            create_all(db)
+
+            widgets = [Widget(label=label) for label in ("foo", "bar", "baz")]
+            db.session.add_all(widgets)
+            db.session.commit()
+            ids = [widget.id for widget in widgets]
+
+            cache = pg.cached(Widget, maxsize=2)
+
+            assert {key: widget.label for (key, widget) in cache.get_many(ids[:2] + [0]).items()} == {
+                ids[0]: "foo",
+                ids[1]: "bar",
+            }
+            assert len(cache) == 2
+
+            # Cached rows are not fetched again
+            db.session.execute("UPDATE widget SET label = 'qux' WHERE id = :id", {"id": ids[1]})
+            db.session.execute("ALTER TABLE widget DISABLE TRIGGER USER")
+            db.session.execute("UPDATE widget SET label = 'stale' WHERE id = :id", {"id": ids[0]})
+            db.session.execute("ALTER TABLE widget ENABLE TRIGGER USER")
+            db.session.commit()
+
+            assert cache.get(ids[0]).label == "foo"
+
+            # ...until an event invalidates them
+            handle_events_until(pg, lambda: len(cache) == 1)
+
+            assert cache.get(ids[0]).label == "foo"
+            assert cache.get(ids[1]).label == "qux"
+
+            # The least recently used row is evicted
+            assert cache.get(ids[2]).label == "baz"
+            assert len(cache) == 2
+            assert cache.get(ids[0]).label == "stale"
+
+            db.session.delete(Widget.query.get(ids[2]))
+            db.session.commit()
+
+            handle_events_until(pg, lambda: len(cache) == 1)
+
+            assert cache.get(ids[2]) is None
+
+    def test_cached_ttl(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            create_all(db)
+
+            widget = Widget(label="foo")
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = widget.id
+
+            cache = pg.cached(Widget, ttl=0.05)
+            assert cache.get(widget_id).label == "foo"
+
+            db.session.execute("ALTER TABLE widget DISABLE TRIGGER USER")
+            db.session.execute("UPDATE widget SET label = 'bar'")
+            db.session.execute("ALTER TABLE widget ENABLE TRIGGER USER")
+            db.session.commit()
+
+            time.sleep(0.1)
+
+            assert cache.get(widget_id).label == "bar"
+
+    def test_sync(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                label = db.Column(db.Text)
+
+            create_all(db)
+
+            events = []
+
+            @pg.listens_for(Widget, {"insert", "update"})
+            def widget_callback(event_id, row_id, identifier):
+                events.append((row_id, identifier))
+
+            db.session.add(Widget(id=1, label="before"))
+            db.session.commit()
+
+            with create_connection(db) as conn:
+                # In progress while the snapshot is taken
+                transaction = conn.begin()
+                conn.execute("INSERT INTO widget (id, label) VALUES (2, 'during')")
+
+                rows = [(widget.id, widget.label) for widget in pg.sync(Widget, chunk_size=1)]
+
+                transaction.commit()
+
+            db.session.execute("UPDATE widget SET label = 'after' WHERE id = 1")
+            db.session.commit()
+
+            assert rows == [(1, "before")]
+
+            # The snapshot's insert is not dispatched again; the others are
+            handle_events_until(pg, lambda: len(events) == 2)
+
+            assert sorted(events) == [(1, "UPDATE"), (2, "INSERT")]
+
+    def test_sync_aggregate(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+                size = db.Column(db.Integer)
+
+            create_all(db)
+
+            aggregate = pg.aggregate(Widget, sum="size")
+            row_ids = []
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            db.session.add(Widget(size=2))
+            db.session.commit()
+
+            rows = [widget.id for widget in pg.sync(Widget)]
+
+            handle_events_until(pg, lambda: aggregate.results)
+
+            # The snapshot only applies to the listeners continuing the sync
+            assert len(rows) == 1
+            assert row_ids == []
+            assert aggregate.results == {None: {"count": 1, "sum": {"size": 2}}}
+
+    def test_aggregate(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Order(db.Model):
+                __tablename__ = "order"
+                id = db.Column(db.Integer, primary_key=True)
+                status = db.Column(db.Text)
+                total = db.Column(db.Numeric(10, 2))
+
+            create_all(db)
+
+            orders = [Order(status="open", total=Decimal("1.50")), Order(status="open", total=Decimal("2.00"))]
+            db.session.add_all(orders)
+            db.session.commit()
+
+            aggregate = pg.aggregate(Order, group_by=Order.status, count=True, sum=Order.total)
+
+            assert aggregate.results == {"open": {"count": 2, "sum": {"total": Decimal("3.50")}}}
+
+            orders[0].status = "paid"
+            db.session.add(Order(status="open", total=Decimal("0.25")))
+            db.session.commit()
+            db.session.delete(orders[1])
+            db.session.commit()
+
+            expected = {
+                "open": {"count": 1, "sum": {"total": Decimal("0.25")}},
+                "paid": {"count": 1, "sum": {"total": Decimal("1.50")}},
+            }
+            handle_events_until(pg, lambda: aggregate.results == expected)
+
+            assert aggregate.results == expected
+            assert aggregate.results == {
+                status: {"count": count, "sum": {"total": total}}
+                for (status, count, total) in db.session.execute(aggregate.query)
+            }
+
+    def test_aggregate_group_types(self, app, db):
+        with create_pgevents(app) as pg:
+
+            class Visit(db.Model):
+                __tablename__ = "visit"
+                id = db.Column(db.Integer, primary_key=True)
+                day = db.Column(db.Date)
+                at = db.Column(db.DateTime(timezone=True))
+                site = db.Column(postgresql.UUID(as_uuid=True))
+                tags = db.Column(db.ARRAY(db.Text))
+
+            create_all(db)
+
+            site = uuid4()
+            at = datetime(2024, 1, 1, 12, 30, 0, 500000, tzinfo=timezone.utc)
+            db.session.add(Visit(day=date(2024, 1, 1), at=at, site=site))
+            db.session.commit()
+
+            with raises(ValueError):
+                pg.aggregate(Visit, group_by=Visit.tags)
+
+            aggregate = pg.aggregate(Visit, group_by=[Visit.day, Visit.at, Visit.site])
+
+            db.session.add(Visit(day=date(2024, 1, 1), at=at, site=site))
+            db.session.commit()
+
+            # Captured values are grouped with the queried ones
+            expected = {(date(2024, 1, 1), at, site): {"count": 2, "sum": {}}}
+            handle_events_until(pg, lambda: aggregate.results == expected)
+
+            assert aggregate.results == expected
+
+    def test_handle_events_tracer(self, app, db):
+        tracer = RecordingTracer("00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01")
+        app.config["PGEVENTS_TRACER"] = tracer
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            # Only writes made while handling a request are traced
+            db.session.add(Widget())
+            db.session.commit()
+            with app.test_request_context():
+                db.session.add(Widget())
+                db.session.commit()
+
+            handle_events_until(pg, lambda: len(row_ids) == 2)
+
+            assert tracer.spans == [(None, "widget_callback"), (tracer.trace_id, "widget_callback")]
+
+    def test_handle_events_opentelemetry_tracer(self, app, db):
+        importorskip("opentelemetry.sdk")
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+        from flask_sqlalchemy_pgevents import OpenTelemetryTracer
+
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        app.config["PGEVENTS_TRACER"] = OpenTelemetryTracer(provider)
+
+        with create_pgevents(app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            with app.test_request_context():
+                with provider.get_tracer(__name__).start_as_current_span("request") as request_span:
+                    db.session.add(Widget())
+                    db.session.commit()
+
+            handle_events_until(pg, lambda: len(row_ids) == 1)
+
+            spans = {span.name: span for span in exporter.get_finished_spans()}
+            callback_span = next(span for (name, span) in spans.items() if name.endswith("widget_callback"))
+
+            assert callback_span.parent.span_id == request_span.get_span_context().span_id
+            assert callback_span.context.trace_id == request_span.get_span_context().trace_id
+            assert callback_span.attributes["pgevents.table"] == "public.widget"
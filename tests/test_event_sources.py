@@ -0,0 +1,1263 @@
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy_pgevents import Deduplicator, Event, EventMultiplexer, PGEvents, Tracer
+from helpers.db import create_all, create_connection
+from helpers.pgevents import create_pgevents, handle_events_until
+from psycopg2_pgevents import execute, trigger_installed
+from pytest import fixture, raises, skip
+
+
+@fixture
+def logical_app(app, db):
+    with create_connection(db, raw=True) as conn:
+        (wal_level,) = execute(conn, "SHOW wal_level;")[0]
+    if wal_level != "logical":
+        skip("Logical decoding requires wal_level = logical")
+
+    app.config["PGEVENTS_EVENT_SOURCE"] = "logical"
+    app.config["PGEVENTS_REPLICATION_SLOT"] = "test_pgevents"
+    app.config["PGEVENTS_REPLICATION_SLOT_TEMPORARY"] = True
+    app.config["PGEVENTS_PUBLICATION"] = "test_pgevents"
+
+    return app
+
+
+class TestEventSources:
+    def test_init_app_invalid_event_source(self, app, db):
+        app.config["PGEVENTS_EVENT_SOURCE"] = "carrier-pigeon"
+
+        pg = PGEvents()
+
+        with raises(ValueError):
+            pg.init_app(app)
+
+        assert not pg._initialized
+
+
+class TestLogicalReplicationEventSource:
+    def test_listen(self, logical_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(logical_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            with create_connection(db, raw=True) as conn:
+                assert not trigger_installed(conn, "widget")
+
+                published = execute(
+                    conn,
+                    "SELECT 1 FROM pg_publication_tables WHERE pubname = 'test_pgevents' AND tablename = 'widget';",
+                )
+                assert published
+
+    def test_handle_events(self, logical_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+
+        create_all(db)
+
+        with create_pgevents(logical_app) as pg:
+            events = []
+
+            @pg.listens_for(Widget, {"insert", "update", "delete"})
+            def widget_callback(event_id, row_id, identifier):
+                events.append((row_id, identifier))
+
+            widget = Widget(label="foo")
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = str(widget.id)
+
+            widget.label = "bar"
+            db.session.commit()
+
+            db.session.delete(widget)
+            db.session.commit()
+
+            handle_events_until(pg, lambda: len(events) == 3)
+
+            assert events == [(widget_id, "INSERT"), (widget_id, "UPDATE"), (widget_id, "DELETE")]
+
+    def test_handle_events_capture(self, logical_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+
+        create_all(db)
+
+        with create_pgevents(logical_app) as pg:
+            captured = []
+
+            @pg.listens_for(Widget, {"insert"}, capture=["label"])
+            def widget_callback(event_id, row_id, identifier, data):
+                captured.append(data)
+
+            db.session.add(Widget(label="foo"))
+            db.session.commit()
+
+            handle_events_until(pg, lambda: captured)
+
+            assert captured == [{"new": {"label": "foo"}, "old": None}]
+
+            with create_connection(db, raw=True) as conn:
+                ((replica_identity,),) = execute(conn, "SELECT relreplident FROM pg_class WHERE relname = 'widget';")
+                assert replica_identity == "f"
+
+    def test_handle_events_capture_types(self, logical_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+            active = db.Column(db.Boolean)
+            price = db.Column(db.Numeric)
+            created = db.Column(db.DateTime(timezone=True))
+            tags = db.Column(db.ARRAY(db.Text))
+            attributes = db.Column(db.JSON)
+
+        create_all(db)
+
+        with create_pgevents(logical_app) as pg:
+            captured = []
+
+            @pg.listens_for(Widget, {"insert"}, capture=True)
+            def widget_callback(event_id, row_id, identifier, data):
+                captured.append((row_id, data["new"]))
+
+            widget = Widget(
+                label="foo",
+                active=True,
+                price=1.5,
+                created=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                tags=["a", "b,c", None],
+                attributes={"color": "red"},
+            )
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = widget.id
+
+            handle_events_until(pg, lambda: captured)
+
+            # As captured by the other event sources
+            with create_connection(db, raw=True) as conn:
+                ((expected,),) = execute(conn, "SELECT to_jsonb(widget) FROM widget;")
+
+            assert captured == [(str(widget_id), expected)]
+
+
+@fixture
+def polling_app(app):
+    app.config["PGEVENTS_EVENT_SOURCE"] = "polling"
+    app.config["PGEVENTS_POLL_BATCH_SIZE"] = 2
+
+    return app
+
+
+class TestPollingEventSource:
+    def test_listen(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            with create_connection(db, raw=True) as conn:
+                assert trigger_installed(conn, "widget")
+
+    def test_handle_events(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widgets = [Widget() for _ in range(5)]
+            db.session.add_all(widgets)
+            db.session.commit()
+
+            pg.handle_events()
+
+            # Full batches are drained without waiting for the next poll
+            assert row_ids == [str(widget.id) for widget in widgets]
+
+            pg.handle_events()
+
+            assert len(row_ids) == 5
+
+    def test_ack_batch(self, polling_app, db):
+        polling_app.config["PGEVENTS_ACK_BATCH_SIZE"] = 3
+        polling_app.config["PGEVENTS_ACK_INTERVAL"] = 60.0
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            acks = []
+            source_ack = pg._event_source.ack
+
+            def ack(events):
+                acks.append(len(events))
+                source_ack(events)
+
+            pg._event_source.ack = ack
+
+            db.session.add_all([Widget() for _ in range(2)])
+            db.session.commit()
+            pg.handle_events()
+
+            assert acks == []
+
+            db.session.add_all([Widget() for _ in range(2)])
+            db.session.commit()
+            pg.handle_events()
+
+            # The queued events are acknowledged together, once enough are queued
+            assert acks == [4]
+
+            db.session.add(Widget())
+            db.session.commit()
+            pg.handle_events()
+
+            assert acks == [4]
+
+        # Teardown acknowledges the rest
+        assert acks == [4, 1]
+
+    def test_ack_in_received_order(self, polling_app, db):
+        polling_app.config["PGEVENTS_LANE_BUDGET"] = 1
+
+        class AuditLog(db.Model):
+            __tablename__ = "audit_log"
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Payment(db.Model):
+            __tablename__ = "payment"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(AuditLog, {"insert"}, lambda event_id, row_id, identifier: None)
+            pg.listen(Payment, {"insert"}, lambda event_id, row_id, identifier: None, priority=10)
+
+            db.session.add(AuditLog())
+            db.session.commit()
+            db.session.add(Payment())
+            db.session.commit()
+
+            pg.handle_events()
+
+            # The payment was handled first, but may not be acknowledged
+            # before the audit log received ahead of it
+            assert pg._acks == []
+
+            pg.handle_events()
+
+            assert [evt.table_name for evt in pg._acks] == ["audit_log", "payment"]
+
+    def test_resume_after_restart(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        def run(callback):
+            with create_pgevents(polling_app) as pg:
+                pg.listen(Widget, {"insert"}, callback)
+                pg.handle_events()
+
+        run(lambda event_id, row_id, identifier: None)
+
+        widget = Widget()
+        db.session.add(widget)
+        db.session.commit()
+        widget_id = str(widget.id)
+
+        # The failed event is not acknowledged, and is received again
+        with raises(ValueError):
+            run(lambda event_id, row_id, identifier: int("not a number"))
+
+        row_ids = []
+        run(lambda event_id, row_id, identifier: row_ids.append(row_id))
+        run(lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+        assert row_ids == [widget_id]
+
+    def test_resume_after_failure(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        row_ids = []
+
+        def callback(event_id, row_id, identifier):
+            if not row_ids:
+                row_ids.append(None)
+                raise ValueError("First event failed")
+            row_ids.append(row_id)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, callback)
+            pg.handle_events()
+
+            widgets = [Widget(), Widget()]
+            db.session.add(widgets[0])
+            db.session.commit()
+            widget_ids = [str(widgets[0].id)]
+
+            with raises(ValueError):
+                pg.handle_events()
+
+            db.session.add(widgets[1])
+            db.session.commit()
+            widget_ids.append(str(widgets[1].id))
+            pg.handle_events()
+
+            assert row_ids == [None, widget_ids[1]]
+
+        # The later event's acknowledgement doesn't skip the failed one
+        row_ids[:] = [None]
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, callback)
+            pg.handle_events()
+
+        assert row_ids == [None] + widget_ids
+
+    def test_handle_events_late_commit(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            with create_connection(db, raw=True) as conn:
+                # Allocates the lower event ID, but commits last
+                cursor = conn.cursor()
+                cursor.execute("INSERT INTO public.widget (id) VALUES (1);")
+
+                db.session.add(Widget(id=2))
+                db.session.commit()
+
+                pg.handle_events()
+
+                assert row_ids == []
+
+                conn.commit()
+
+            pg.handle_events()
+
+            assert row_ids == ["1", "2"]
+
+    def test_sync(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            db.session.add_all([Widget(), Widget()])
+            db.session.commit()
+
+            # The table is only watched once synced
+            rows = [widget.id for widget in pg.sync(Widget)]
+
+            assert len(rows) == 2
+
+            row_ids = []
+            pg.listen(Widget, {"insert", "delete"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            rows = [widget.id for widget in pg.sync(Widget)]
+            Widget.query.filter(Widget.id == rows[0]).delete()
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert len(rows) == 3
+            assert row_ids == [str(rows[0])]
+
+    def test_aggregate(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            size = db.Column(db.Integer)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            db.session.add_all([Widget(size=1), Widget(size=2)])
+            db.session.commit()
+
+            aggregate = pg.aggregate(Widget, count=False, sum=["size"])
+
+            db.session.add(Widget(size=4))
+            db.session.commit()
+
+            pg.handle_events()
+
+            # The inserts counted by the initial query are not applied again
+            assert aggregate.results == {None: {"sum": {"size": 7}}}
+
+    def test_handle_events_trace_id(self, polling_app, db):
+        class TraceIdTracer(Tracer):
+            def current_trace_id(self):
+                return "trace"
+
+        polling_app.config["PGEVENTS_TRACER"] = TraceIdTracer()
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            db.session.add(Widget())
+            db.session.commit()
+            with polling_app.test_request_context():
+                db.session.add(Widget())
+                db.session.commit()
+
+            with create_connection(db, raw=True) as conn:
+                rows = execute(conn, "SELECT trace_id FROM public.flask_sqlalchemy_pgevents_event ORDER BY id;")
+
+            assert rows == [(None,), ("trace",)]
+
+    def test_handle_events_partitions(self, polling_app, db):
+        polling_app.config["PGEVENTS_REBALANCE_INTERVAL"] = 0.0
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            tenant_id = db.Column(db.Integer)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg1, create_pgevents(polling_app) as pg2:
+            row_ids = {pg1: [], pg2: []}
+            for pg in (pg1, pg2):
+                pg.listen(
+                    Widget,
+                    {"insert"},
+                    lambda event_id, row_id, identifier, pg=pg: row_ids[pg].append(row_id),
+                    partition_by=Widget.tenant_id,
+                    partitions=4,
+                )
+                pg.listen(Gadget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            widgets = [Widget(tenant_id=tenant_id) for tenant_id in range(16)]
+            db.session.add_all(widgets)
+            db.session.commit()
+            db.session.add(Gadget())
+            db.session.commit()
+            widget_ids = sorted(str(widget.id) for widget in widgets)
+
+            # The second consumer reads past the widgets before it is assigned
+            # any partition
+            pg2.handle_events()
+
+            assert pg2.assigned_partitions == {"public.widget": set()}
+            assert not row_ids[pg2]
+
+            pg1.handle_events()
+            pg2.handle_events()
+
+            # It then catches up on the partitions it was assigned
+            assert pg1.assigned_partitions == {"public.widget": {0, 1}}
+            assert pg2.assigned_partitions == {"public.widget": {2, 3}}
+            assert row_ids[pg1] and row_ids[pg2]
+            assert sorted(row_ids[pg1] + row_ids[pg2]) == widget_ids
+
+    def test_handle_events_dedup(self, polling_app, db):
+        polling_app.config["PGEVENTS_DEDUP_SIZE"] = 2
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            db.session.add_all([Widget() for _ in range(5)])
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert len(row_ids) == 5
+
+            # Redeliver all events: the last two are remembered, the others
+            # are below the watermark
+            pg._event_source._high_water_mark = 0
+            pg.handle_events()
+
+            assert len(row_ids) == 5
+            assert pg.suppressed_duplicates == 5
+            assert len(pg._deduplicator) == 2
+
+    def test_deduplicator_unordered_positions(self):
+        events = [Event(uuid4(), "INSERT", "public", "widget", str(i), position) for (i, position) in enumerate([5, 6, 3])]
+
+        # e.g. LSNs of transactions committed in a different order than they wrote
+        deduplicator = Deduplicator(1)
+        assert [deduplicator.seen(evt) for evt in events] == [False, False, False]
+
+        deduplicator = Deduplicator(1, ordered_positions=True)
+        assert [deduplicator.seen(evt) for evt in events] == [False, False, True]
+
+    def test_handle_events_adaptive(self, polling_app, db):
+        polling_app.config["PGEVENTS_ADAPTIVE"] = True
+        polling_app.config["PGEVENTS_TARGET_LAG_MS"] = 200
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                time.sleep(0.005)
+                row_ids.append(row_id)
+
+            assert pg.adaptive_settings["dispatch_budget"] is None
+
+            db.session.add_all([Widget() for _ in range(50)])
+            db.session.commit()
+
+            pg.handle_events()
+
+            # Callbacks of a call fit in half the target lag from now on
+            settings = pg.adaptive_settings
+            assert len(row_ids) == 50
+            assert 1 <= settings["dispatch_budget"] < 50
+            assert settings["arrival_rate"] > 0
+            assert pg._event_source._batch_size == settings["fetch_size"]
+            assert pg._event_source._max_interval == 0.1
+
+            db.session.add_all([Widget() for _ in range(50)])
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert len(row_ids) < 100
+            assert pg.adaptive_settings["queue_depth"] == 100 - len(row_ids)
+
+            # A backlog is not waited on
+            while len(row_ids) < 100:
+                pg.handle_events(timeout=5.0)
+                assert pg.adaptive_settings["poll_timeout"] == 0.0
+
+            pg.handle_events()
+
+            assert pg.adaptive_settings["queue_depth"] == 0
+
+    def test_replay(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            @pg.listens_for(Gadget, {"insert"})
+            def gadget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widgets = [Widget() for _ in range(3)]
+            db.session.add_all(widgets + [Gadget()])
+            db.session.commit()
+            widget_ids = [str(widget.id) for widget in widgets]
+
+            pg.handle_events()
+            row_ids.clear()
+
+            progress = []
+            count = pg.replay("public.widget", chunk_size=2, progress=lambda *args: progress.append(args))
+
+            assert count == 3
+            assert row_ids == widget_ids
+            assert progress[-1][:3] == (2, 2, 3)
+
+            row_ids.clear()
+            with create_connection(db, raw=True) as conn:
+                ((since,),) = execute(
+                    conn, "SELECT min(id) + 1 FROM public.flask_sqlalchemy_pgevents_event WHERE table_name = 'widget';"
+                )
+
+            assert pg.replay(table="public.widget", since=since, callback="widget_callback") == 2
+            assert row_ids == widget_ids[1:]
+
+    def test_replay_command(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+
+            db.session.add_all([Widget() for _ in range(5)])
+            db.session.commit()
+
+            runner = polling_app.test_cli_runner()
+            result = runner.invoke(args=["pgevents", "replay", "--workers", "2", "--chunk-size", "2"])
+
+            assert result.exit_code == 0, result.output
+            assert "Replayed 5 events" in result.output
+
+            result = runner.invoke(args=["pgevents", "replay", "--since", "yesterday"])
+
+            assert result.exit_code != 0
+
+    def test_poll_backs_off_while_idle(self, polling_app, db):
+        polling_app.config["PGEVENTS_POLL_MAX_INTERVAL"] = 0.04
+
+        with create_pgevents(polling_app) as pg:
+            source = pg._event_source
+
+            pg.handle_events(timeout=0.1)
+
+            assert source._interval == 0.04
+
+    def test_handle_events_orm_mode(self, polling_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(polling_app) as pg:
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"}, mode="orm")
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            widgets = [Widget() for _ in range(3)]
+            db.session.add_all(widgets)
+            db.session.commit()
+
+            with create_connection(db, raw=True) as conn:
+                assert not trigger_installed(conn, "widget")
+
+            pg.handle_events()
+
+            assert row_ids == [str(widget.id) for widget in widgets]
+
+
+@fixture
+def compact_app(app):
+    app.config["PGEVENTS_EVENT_SOURCE"] = "compact"
+
+    return app
+
+
+class TestCompactPollingEventSource:
+    def test_handle_events(self, compact_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(compact_app) as pg:
+            events = []
+
+            @pg.listens_for(Widget, {"insert", "update", "delete"})
+            def widget_callback(event_id, row_id, identifier):
+                events.append(("widget", row_id, identifier))
+
+            @pg.listens_for(Gadget, {"insert"})
+            def gadget_callback(event_id, row_id, identifier):
+                events.append(("gadget", row_id, identifier))
+
+            widget = Widget(label="foo")
+            db.session.add(widget)
+            db.session.commit()
+            gadget = Gadget()
+            db.session.add(gadget)
+            db.session.commit()
+            (widget_id, gadget_id) = (str(widget.id), str(gadget.id))
+
+            widget.label = "bar"
+            db.session.commit()
+            db.session.delete(widget)
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert events == [
+                ("widget", widget_id, "INSERT"),
+                ("gadget", gadget_id, "INSERT"),
+                ("widget", widget_id, "UPDATE"),
+                ("widget", widget_id, "DELETE"),
+            ]
+
+            with create_connection(db, raw=True) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT event_type, table_oid = 'public.widget'::regclass "
+                    "FROM public.flask_sqlalchemy_pgevents_compact_event ORDER BY id"
+                )
+                assert cursor.fetchall() == [("I", True), ("I", False), ("U", True), ("D", True)]
+
+    def test_replay(self, compact_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(compact_app) as pg:
+            events = []
+            pg.listen(Widget, {"insert", "delete"}, lambda event_id, row_id, identifier: events.append(row_id))
+
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+            widget_id = str(widget.id)
+            db.session.delete(widget)
+            db.session.commit()
+
+            assert pg.replay("public.widget") == 2
+            assert events == [widget_id] * 2
+
+            with raises(NotImplementedError):
+                pg.replay(since=datetime.now())
+
+    def test_handle_events_orm_mode(self, compact_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            label = db.Column(db.Text)
+
+        create_all(db)
+
+        with create_pgevents(compact_app) as pg:
+            events = []
+
+            @pg.listens_for(Widget, {"insert"}, mode="orm", capture=["label"])
+            def widget_callback(event_id, row_id, identifier, data):
+                events.append((row_id, identifier, data))
+
+            widget = Widget(label="foo")
+            db.session.add(widget)
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert events == [(str(widget.id), "INSERT", {"new": {"label": "foo"}, "old": None})]
+
+
+@fixture
+def multiplexer_app(app, tmp_path):
+    app.config["PGEVENTS_EVENT_SOURCE"] = "multiplexer"
+    app.config["PGEVENTS_MULTIPLEXER_SOCKET"] = str(tmp_path / "pgevents.sock")
+
+    return app
+
+
+class TestMultiplexerEventSource:
+    def test_init_app(self, multiplexer_app, db):
+        with create_pgevents(multiplexer_app) as pg:
+            assert pg._initialized
+            assert pg._connection is None
+            assert pg._psycopg2_connection is None
+
+    def test_init_app_multiplexer_source(self, multiplexer_app, db):
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_EVENT_SOURCE"] = "multiplexer"
+
+        with raises(ValueError):
+            EventMultiplexer(multiplexer_app)
+
+    def test_handle_events(self, multiplexer_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with create_pgevents(multiplexer_app) as pg:
+                row_ids = []
+
+                @pg.listens_for(Widget, {"insert"})
+                def widget_callback(event_id, row_id, identifier):
+                    row_ids.append(row_id)
+
+                # Connect to the multiplexer, which then installs the trigger
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                with create_connection(db, raw=True) as conn:
+                    assert trigger_installed(conn, "widget")
+                    assert not trigger_installed(conn, "gadget")
+
+                widget = Widget()
+                db.session.add(widget)
+                db.session.commit()
+
+                multiplexer.handle_events(timeout=0.5)
+                pg.handle_events(timeout=0.5)
+
+                assert row_ids == [widget.id]
+        finally:
+            multiplexer.teardown()
+
+        assert not os.path.exists(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+
+    def test_handle_events_compact_orm(self, multiplexer_app, db):
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_EVENT_SOURCE"] = "compact"
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with create_pgevents(multiplexer_app) as pg:
+                row_ids = []
+                pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: row_ids.append(row_id), mode="orm")
+
+                # Subscribe to the table, without the multiplexer installing it
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                # The worker has no connection of its own to resolve the table with
+                widget = Widget()
+                db.session.add(widget)
+                db.session.commit()
+                widget_id = widget.id
+
+                multiplexer.handle_events(timeout=0.5)
+                pg.handle_events(timeout=0.5)
+
+                assert row_ids == [str(widget_id)]
+
+                with create_connection(db, raw=True) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        "SELECT table_oid = 'public.widget'::regclass, row_id "
+                        "FROM public.flask_sqlalchemy_pgevents_compact_event"
+                    )
+                    assert cursor.fetchall() == [(True, str(widget_id))]
+                    assert not trigger_installed(conn, "widget")
+        finally:
+            multiplexer.teardown()
+
+    def test_init_app_live_socket(self, multiplexer_app, db):
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with raises(RuntimeError):
+                EventMultiplexer(multiplexer_app)
+        finally:
+            multiplexer.teardown()
+
+        # A socket left behind by a multiplexer that is gone is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+        stale.close()
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        multiplexer.teardown()
+
+    def test_malformed_registration(self, multiplexer_app, db):
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+                multiplexer.handle_events()
+                assert len(multiplexer._clients) == 1
+
+                client.sendall(b"not json\n")
+                multiplexer.handle_events()
+
+                assert multiplexer._clients == {}
+        finally:
+            multiplexer.teardown()
+
+    def test_slow_worker(self, multiplexer_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_BUFFER_SIZE"] = 1024
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+                client.sendall(b'{"schema_name": "public", "table_name": "widget", "capture": null}\n')
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                # The worker never reads, so its buffer overflows instead of blocking the multiplexer
+                db.session.add_all(Widget() for _ in range(5000))
+                db.session.commit()
+
+                handle_events_until(multiplexer, lambda: not multiplexer._clients)
+
+                assert multiplexer._clients == {}
+        finally:
+            multiplexer.teardown()
+
+    def test_unlisten(self, multiplexer_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with create_pgevents(multiplexer_app) as pg:
+
+                def widget_callback(event_id, row_id, identifier):
+                    pass
+
+                pg.listen(Widget, {"insert"}, widget_callback)
+
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                with create_connection(db, raw=True) as conn:
+                    assert trigger_installed(conn, "widget")
+
+                # The multiplexer drops the trigger once no worker listens
+                pg.unlisten(Widget, {"insert"}, widget_callback)
+                multiplexer.handle_events()
+
+                with create_connection(db, raw=True) as conn:
+                    assert not trigger_installed(conn, "widget")
+        finally:
+            multiplexer.teardown()
+
+    def test_worker_disconnect(self, multiplexer_app, db):
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_EVENT_SOURCE"] = "polling"
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        registration = b'{"schema_name": "public", "table_name": "widget", "capture": null}\n'
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+                client.sendall(registration)
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                widget = Widget()
+                db.session.add(widget)
+                db.session.commit()
+
+            # The worker restarts before the event is forwarded: the table is
+            # uninstalled, but the event is held for the worker
+            multiplexer.handle_events(timeout=0.5)
+
+            with create_connection(db, raw=True) as conn:
+                assert not trigger_installed(conn, "widget")
+            assert len(multiplexer._pending) == 1
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(multiplexer_app.config["PGEVENTS_MULTIPLEXER_SOCKET"])
+                client.sendall(registration)
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                client.settimeout(1.0)
+                assert Event.fromjson(client.recv(65536).decode("utf-8")).row_id == str(widget.id)
+                assert not multiplexer._pending
+        finally:
+            multiplexer.teardown()
+
+    def test_grace_period(self, multiplexer_app, db):
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_EVENT_SOURCE"] = "polling"
+        multiplexer_app.config["PGEVENTS_MULTIPLEXER_GRACE_PERIOD"] = 0.0
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with create_pgevents(multiplexer_app) as pg:
+                pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: None)
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+            db.session.add(Widget())
+            db.session.commit()
+
+            # Nobody took the event in time, so it no longer holds back acknowledgements
+            handle_events_until(multiplexer, lambda: multiplexer._event_source._high_water_mark)
+            assert not multiplexer._pending
+        finally:
+            multiplexer.teardown()
+
+    def test_multiplexer_gone(self, multiplexer_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Gadget(db.Model):
+            __tablename__ = "gadget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        def callback(event_id, row_id, identifier):
+            pass
+
+        multiplexer = EventMultiplexer(multiplexer_app)
+        try:
+            with create_pgevents(multiplexer_app) as pg:
+                pg.listen(Widget, {"insert"}, callback)
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                multiplexer.teardown()
+
+                # Listening doesn't fail while the multiplexer is gone
+                pg.listen(Gadget, {"insert"}, callback)
+                pg.unlisten(Widget, {"insert"}, callback)
+                pg.handle_events()
+
+                # Tables are registered again with the next multiplexer
+                multiplexer = EventMultiplexer(multiplexer_app)
+                pg.handle_events()
+                multiplexer.handle_events()
+                multiplexer.handle_events()
+
+                assert set(multiplexer._subscribers) == {"public.gadget"}
+        finally:
+            multiplexer.teardown()
+
+    def test_multiplex_command(self, multiplexer_app, db):
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        create_all(db)
+
+        with create_pgevents(multiplexer_app) as pg:
+            row_ids = []
+            pg.listen(Widget, {"insert"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            runner = multiplexer_app.test_cli_runner()
+            results = []
+            thread = threading.Thread(
+                target=lambda: results.append(runner.invoke(args=["pgevents", "multiplex", "--timeout", "0.05"]))
+            )
+            thread.start()
+            def installed():
+                multiplexer = multiplexer_app.extensions.get("pgevents_multiplexer")
+                return multiplexer is not None and "public.widget" in multiplexer._captures
+
+            try:
+                # Wait for the multiplexer to start, and install the worker's table
+                handle_events_until(pg, installed)
+
+                widget = Widget()
+                db.session.add(widget)
+                db.session.commit()
+                widget_id = widget.id
+
+                handle_events_until(pg, lambda: row_ids)
+
+                assert row_ids == [widget_id]
+            finally:
+                multiplexer_app.extensions["pgevents_multiplexer"].stop()
+                thread.join()
+
+        assert results[0].exit_code == 0, results[0].output
+
+
+@fixture
+def memory_app(app):
+    app.config["PGEVENTS_EVENT_SOURCE"] = "memory"
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+    return app
+
+
+@fixture
+def memory_db(memory_app):
+    db_ = SQLAlchemy(memory_app)
+
+    yield db_
+
+    db_.session.remove()
+    db_.engine.dispose()
+
+
+class TestMemoryEventSource:
+    def test_handle_events(self, memory_app, memory_db):
+        db = memory_db
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String)
+
+        db.create_all()
+
+        with create_pgevents(memory_app) as pg:
+            events = []
+
+            @pg.listens_for(Widget, {"insert", "update"}, capture=["name"])
+            def widget_callback(event_id, row_id, identifier, data):
+                events.append((identifier, row_id, data["new"]))
+
+            widget = Widget(name="sprocket")
+            db.session.add(widget)
+            db.session.commit()
+
+            db.session.add(Widget(name="discarded"))
+            db.session.flush()
+            db.session.rollback()
+
+            widget.name = "cog"
+            db.session.commit()
+
+            pg.handle_events()
+
+            assert events == [("INSERT", "1", {"name": "sprocket"}), ("UPDATE", "1", {"name": "cog"})]
+
+    def test_publish(self, memory_app, memory_db):
+        db = memory_db
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        with create_pgevents(memory_app) as pg:
+            row_ids = []
+            pg.listen(Widget, {"delete"}, lambda event_id, row_id, identifier: row_ids.append(row_id))
+
+            pg.event_source.publish("DELETE", Widget, 1)
+            pg.event_source.publish("delete", "public.gadget", 2)
+
+            pg.handle_events()
+
+            assert row_ids == ["1"]
+
+            with raises(ValueError):
+                pg.event_source.publish("TRUNCATE", Widget)
+
+    def test_handle_events_group(self, memory_app, memory_db):
+        db = memory_db
+
+        class Widget(db.Model):
+            __tablename__ = "widget"
+            id = db.Column(db.Integer, primary_key=True)
+
+        db.create_all()
+
+        with create_pgevents(memory_app) as pg:
+            groups = []
+
+            @pg.listens_for(Widget, {"insert", "delete"}, group="transaction")
+            def widget_callback(txid, events):
+                groups.append([(evt.type, evt.row_id) for evt in events])
+
+            db.session.add_all([Widget(id=1), Widget(id=2)])
+            db.session.commit()
+
+            pg.event_source.publish("DELETE", Widget, 1, txid=100)
+            pg.event_source.publish("DELETE", Widget, 2, txid=100)
+            pg.event_source.publish("DELETE", Widget, 3)
+
+            pg.handle_events()
+
+            assert groups == [
+                [("INSERT", "1"), ("INSERT", "2")],
+                [("DELETE", "1"), ("DELETE", "2")],
+                [("DELETE", "3")],
+            ]
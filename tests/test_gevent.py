@@ -0,0 +1,148 @@
+import time
+
+import psycopg2.extensions
+import psycopg2.extras
+from helpers.db import create_all
+from helpers.pgevents import create_pgevents
+from pytest import fixture, importorskip, raises
+
+gevent = importorskip("gevent")
+
+
+@fixture
+def gevent_app(app):
+    app.config["PGEVENTS_GEVENT"] = True
+
+    return app
+
+
+class TestGevent:
+    def test_init_app(self, gevent_app, db):
+        with create_pgevents(gevent_app) as pg:
+            assert pg._gevent_pool is not None
+            assert psycopg2.extensions.get_wait_callback() is not None
+
+        assert psycopg2.extensions.get_wait_callback() is None
+
+    def test_teardown_previous_wait_callback(self, gevent_app, db):
+        def wait_callback(conn):
+            psycopg2.extras.wait_select(conn)
+
+        psycopg2.extensions.set_wait_callback(wait_callback)
+        try:
+            with create_pgevents(gevent_app):
+                assert psycopg2.extensions.get_wait_callback() is not wait_callback
+
+            assert psycopg2.extensions.get_wait_callback() is wait_callback
+        finally:
+            psycopg2.extensions.set_wait_callback(None)
+
+    def test_init_app_batch_session(self, gevent_app, db):
+        gevent_app.config["PGEVENTS_BATCH_SESSION"] = True
+
+        with raises(ValueError):
+            with create_pgevents(gevent_app):
+                pass
+
+    def test_handle_events_cooperative_wait(self, gevent_app, db):
+        with create_pgevents(gevent_app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                row_ids.append(row_id)
+
+            start = time.monotonic()
+            consumer = gevent.spawn(pg.handle_events, timeout=5.0)
+
+            # Runs while the consumer is waiting for events
+            gevent.sleep(0.05)
+            widget = Widget()
+            db.session.add(widget)
+            db.session.commit()
+
+            consumer.join()
+
+            assert row_ids == [widget.id]
+            assert time.monotonic() - start < 5.0
+
+    def test_handle_events_concurrent_callbacks(self, gevent_app, db):
+        with create_pgevents(gevent_app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            called = 0
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                nonlocal called
+                gevent.sleep(0.2)
+                called += 1
+
+            db.session.add_all([Widget() for _ in range(3)])
+            db.session.commit()
+
+            start = time.monotonic()
+            pg.handle_events(timeout=0.1)
+
+            assert called == 3
+            assert time.monotonic() - start < 0.5
+
+    def test_handle_events_callback_error(self, gevent_app, db):
+        with create_pgevents(gevent_app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                raise ValueError()
+
+            db.session.add(Widget())
+            db.session.commit()
+
+            with raises(ValueError):
+                pg.handle_events(timeout=0.1)
+
+    def test_handle_events_callback_error_ack(self, gevent_app, db):
+        gevent_app.config["PGEVENTS_EVENT_SOURCE"] = "polling"
+
+        with create_pgevents(gevent_app) as pg:
+
+            class Widget(db.Model):
+                __tablename__ = "widget"
+                id = db.Column(db.Integer, primary_key=True)
+
+            create_all(db)
+
+            row_ids = []
+
+            @pg.listens_for(Widget, {"insert"})
+            def widget_callback(event_id, row_id, identifier):
+                if row_id == row_ids[1]:
+                    raise ValueError()
+
+            widgets = [Widget() for _ in range(3)]
+            db.session.add_all(widgets)
+            db.session.commit()
+            row_ids.extend(str(widget.id) for widget in widgets)
+
+            with raises(ValueError):
+                pg.handle_events()
+
+            # Events are only acknowledged up to the first failure
+            assert [evt.row_id for evt in pg._acks] == row_ids[:1]